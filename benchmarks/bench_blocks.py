@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+""" CPU time and peak memory of cutting an image into write_flash blocks
+
+iter_blocks() slices memoryviews of the image, the loop it replaced
+(tests/legacy.py) copied the rest of the image after every block. The
+uncompressed image is padded like the flash_block path does.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tasmotizer_esptool as esptool  # noqa: E402
+from tests import legacy  # noqa: E402
+
+
+def consume(blocks):
+    sent = 0
+    for block in blocks:
+        sent += len(block)
+    return sent
+
+
+def measure(producer, image, block_size):
+    """ (seconds, peak bytes allocated) for sending 'image' in blocks from 'producer' """
+    t = time.process_time()
+    consume(producer(image, block_size, b'\xff'))
+    t = time.process_time() - t
+    tracemalloc.start()
+    consume(producer(image, block_size, b'\xff'))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return t, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', help='Image sizes in MB (default 1 4 16)', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    print('%6s %7s %22s %22s' % ('image', 'block', 'old CPU s / peak MB', 'new CPU s / peak MB'))
+    for size in args.sizes:
+        image = os.urandom(size << 20)
+        for block_size in (esptool.ESP8266ROM.FLASH_WRITE_SIZE, esptool.ESP8266StubLoader.FLASH_WRITE_SIZE):
+            old = measure(legacy.iter_blocks, image, block_size)
+            new = measure(esptool.iter_blocks, image, block_size)
+            print('%4dMB %7d %12.3f / %7.2f %12.3f / %7.2f' % (size, block_size, old[0], old[1] / 1e6, new[0], new[1] / 1e6))
+
+
+if __name__ == '__main__':
+    main()
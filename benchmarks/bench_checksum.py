@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+""" Speed of ESPLoader.checksum() against the per-byte loop it replaced
+
+The blocks have the sizes of the ROM and stub flash_block / flash_defl_block
+data and of mem_block, whose largest user is the stub upload.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tasmotizer_esptool as esptool  # noqa: E402
+from tests import legacy  # noqa: E402
+
+
+def bench(fn, blocks, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for block in blocks:
+            fn(block)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', help='Bytes checksummed per block size (default 1 MB)', type=esptool.arg_auto_int,
+                        default=1 << 20)
+    parser.add_argument('--repeat', help='Best of this many runs', type=int, default=3)
+    args = parser.parse_args()
+
+    data = os.urandom(args.size)
+    print('%-26s %13s %10s %8s' % ('block', 'per-byte MB/s', 'fold MB/s', 'speedup'))
+    for name, block_size in [('ROM flash_block', esptool.ESP8266ROM.FLASH_WRITE_SIZE),
+                             ('mem_block', esptool.ESPLoader.ESP_RAM_BLOCK),
+                             ('stub flash_block', esptool.ESP8266StubLoader.FLASH_WRITE_SIZE)]:
+        blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+        old = bench(legacy.checksum, blocks, args.repeat)
+        new = bench(esptool.ESPLoader.checksum, blocks, args.repeat)
+        print('%-26s %13.2f %10.2f %7.0fx' % ('%s (%d)' % (name, block_size), args.size / old / 1e6,
+                                              args.size / new / 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
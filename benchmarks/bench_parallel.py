@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+""" Wall time of write_flash_ports() flashing simulated devices at the same time
+
+Every device is a SimulatedESP served over TCP with the link speed emulated,
+the chips are taken in turn from --chips. --refused adds ports nobody listens
+on, which must fail without holding up the others.
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tasmotizer_esptool as esptool  # noqa: E402
+from tests.helpers import simulated_devices  # noqa: E402
+
+
+def refused_port():
+    """ socket:// URL of a local TCP port which refuses connections """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'socket://127.0.0.1:%d' % s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--devices', help='Number of simulated devices (default 32)', type=int, default=32)
+    parser.add_argument('--chips', help='Chips of the devices, in turn (default esp8266 esp32)', nargs='+',
+                        choices=['esp8266', 'esp32'], default=['esp8266', 'esp32'])
+    parser.add_argument('--refused', help='Number of ports refusing the connection (default 1)', type=int, default=1)
+    parser.add_argument('--size', help='Image size (default 0x80000)', type=esptool.arg_auto_int, default=0x80000)
+    parser.add_argument('--baud', help='Baud rate (default 921600)', type=int, default=921600)
+    args = parser.parse_args()
+
+    image = os.urandom(args.size // 2) + b'\xff' * (args.size - args.size // 2)
+    chips = [args.chips[i % len(args.chips)] for i in range(args.devices)]
+    with simulated_devices(chips, throttle=True) as devices:
+        ports = [url for _, url in devices] + [refused_port() for _ in range(args.refused)]
+        t = time.time()
+        results = esptool.write_flash_ports(ports, 0, image, args.baud)
+        t = time.time() - t
+        written = sum(bytes(device.flash[:len(image)]) == image for device, _ in devices)
+        failed = sum(err is not None for err in results.values())
+
+    print('%d devices (%s) + %d refused, 0x%x bytes: %.2f s, %d written, %d failed'
+          % (args.devices, ' '.join(args.chips), args.refused, args.size, t, written, failed))
+    for port, err in results.items():
+        if err is not None:
+            print('   %s: %s' % (port, err))
+
+
+if __name__ == '__main__':
+    main()
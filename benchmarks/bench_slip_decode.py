@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+""" SLIP decoding speed of slip_reader() against the per-byte decoder it replaced
+
+The frame stream is the read_flash reply of the stub, for flash of random data
+and for flash made only of bytes SLIP escapes, or a capture of a real serial
+port given with --stream. It is fed to the decoders in reads of --chunk bytes,
+as a serial port returns it.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tasmotizer_esptool as esptool  # noqa: E402
+from tests import legacy  # noqa: E402
+from tests.helpers import slip_decode, slip_encode  # noqa: E402
+
+
+def read_flash_stream(contents):
+    """ The frames the stub sends to read back 'contents': one per flash sector, then the MD5 """
+    sector = esptool.ESPLoader.FLASH_SECTOR_SIZE
+    frames = [contents[i:i + sector] for i in range(0, len(contents), sector)]
+    frames.append(hashlib.md5(contents).digest())
+    return b''.join(slip_encode(frame) for frame in frames)
+
+
+def bench(name, reader, stream, chunk):
+    chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+    t = time.perf_counter()
+    packets, error = slip_decode(reader, chunks)
+    t = time.perf_counter() - t
+    print('  %-12s %8.2f MB/s  (%d packets)' % (name, len(stream) / t / 1e6, len(packets)))
+    return packets, t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', help='Flash bytes read back (default 4 MB)', type=esptool.arg_auto_int, default=4 << 20)
+    parser.add_argument('--chunk', help='Bytes per serial port read', type=esptool.arg_auto_int, default=4096)
+    parser.add_argument('--stream', help='Decode this recorded frame stream instead', type=argparse.FileType('rb'))
+    parser.add_argument('--record', help='Save the random data stream to this file', type=argparse.FileType('wb'))
+    args = parser.parse_args()
+
+    if args.stream:
+        streams = [(args.stream.name, args.stream.read())]
+    else:
+        streams = [('random data', read_flash_stream(os.urandom(args.size))),
+                   ('all escaped', read_flash_stream(b'\xc0\xdb' * (args.size // 2)))]
+        if args.record:
+            args.record.write(streams[0][1])
+
+    for name, stream in streams:
+        print('%s, %.1f MB stream in %d byte reads:' % (name, len(stream) / 1e6, args.chunk))
+        old, old_time = bench('per-byte', legacy.slip_reader, stream, args.chunk)
+        new, new_time = bench('slip_reader', esptool.slip_reader, stream, args.chunk)
+        if old != new:
+            raise SystemExit('The decoders returned different packets')
+        print('  %.1fx faster' % (old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
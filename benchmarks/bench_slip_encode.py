@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+""" Cost per MB of encoding flash_block, flash_defl_block and mem_block requests
+
+Each request is encoded by command() into a SlipEncoder, with and without
+batch_writes(), and by concatenating its parts as before (tests/legacy.py). The
+frames are written to /dev/null, so every port write costs a system call. The
+checksums are computed up front.
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tasmotizer_esptool as esptool  # noqa: E402
+from tests import legacy  # noqa: E402
+from tests.helpers import NullPort  # noqa: E402
+
+
+def requests(name, data, block_size):
+    """ (op, header, block, chk) of the requests sending 'data' in blocks of 'block_size' """
+    op = {'flash_block': esptool.ESPLoader.ESP_FLASH_DATA,
+          'flash_defl_block': esptool.ESPLoader.ESP_FLASH_DEFL_DATA,
+          'mem_block': esptool.ESPLoader.ESP_MEM_DATA}[name]
+    view = memoryview(data)
+    for seq, offset in enumerate(range(0, len(view), block_size)):
+        block = view[offset:offset + block_size]
+        yield op, struct.pack('<IIII', len(block), seq, 0, 0), block, esptool.ESPLoader.checksum(block)
+
+
+class DevNullPort(NullPort):
+    """ Port stand-in writing to /dev/null """
+    def __init__(self):
+        NullPort.__init__(self, keep=False)
+        self._fd = os.open(os.devnull, os.O_WRONLY)
+
+    def write(self, data):
+        self.writes += 1
+        return os.write(self._fd, data)
+
+
+def bench(fn, reqs, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(reqs)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def encode_legacy(reqs):
+    esp = esptool.ESP8266ROM(DevNullPort())
+    for op, header, block, chk in reqs:
+        # the block methods concatenated header and data before calling command()
+        legacy.send_command(esp._port, esp.trace, op, header + bytes(block), chk)
+
+
+def encode_command(reqs):
+    esp = esptool.ESP8266ROM(DevNullPort())
+    for op, header, block, chk in reqs:
+        esp.command(op, header, chk, wait_response=False, payload=block)
+
+
+def encode_batched(reqs):
+    esp = esptool.ESP8266ROM(DevNullPort())
+    with esp.batch_writes():
+        for op, header, block, chk in reqs:
+            esp.command(op, header, chk, wait_response=False, payload=block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', help='Bytes sent per request type (default 4 MB)', type=esptool.arg_auto_int, default=4 << 20)
+    parser.add_argument('--repeat', help='Best of this many runs', type=int, default=5)
+    args = parser.parse_args()
+
+    image = os.urandom(args.size // 2) + b'\xff' * (args.size - args.size // 2)
+    stub = esptool.ESP8266ROM.STUB_CODE['text']
+    cases = [
+        ('flash_block', image, esptool.ESP8266StubLoader.FLASH_WRITE_SIZE),
+        ('flash_block', image, esptool.ESP8266ROM.FLASH_WRITE_SIZE),
+        ('flash_defl_block', zlib.compress(image, 9), esptool.ESP8266StubLoader.FLASH_WRITE_SIZE),
+        ('mem_block', stub * (args.size // len(stub) + 1), esptool.ESPLoader.ESP_RAM_BLOCK),
+    ]
+    print('%-18s %7s %14s %14s %14s' % ('request', 'block', 'legacy ms/MB', 'command ms/MB', 'batched ms/MB'))
+    for name, data, block_size in cases:
+        reqs = list(requests(name, data, block_size))
+        mb = len(data) / 1e6
+        old = bench(encode_legacy, reqs, args.repeat) / mb * 1000
+        new = bench(encode_command, reqs, args.repeat) / mb * 1000
+        batched = bench(encode_batched, reqs, args.repeat) / mb * 1000
+        print('%-18s %7d %14.2f %14.2f %14.2f' % (name, block_size, old, new, batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,7 @@ setup(
     name='tasmotizer',
     version=find_version(),
     url='https://github.com/tasmota/tasmotizer',
-    py_modules=['tasmotizer', 'gui', 'tasmotizer_esptool', 'banner', 'utils'],
+    py_modules=['tasmotizer', 'gui', 'tasmotizer_esptool', 'tasmotizer_simulator', 'banner', 'utils'],
     license='GPLv3',
     author='jziolkowski',
     author_email='jacek@ziolkowscy.com',
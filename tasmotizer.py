@@ -1,6 +1,9 @@
 #!/usr/bin/env python
+import os
 import re
 import sys
+import tempfile
+import time
 from time import sleep
 
 import serial
@@ -15,7 +18,8 @@ from PyQt5.QtGui import QPixmap
 from PyQt5.QtNetwork import QNetworkRequest, QNetworkAccessManager, QNetworkReply
 from PyQt5.QtSerialPort import QSerialPortInfo, QSerialPort
 from PyQt5.QtWidgets import QApplication, QDialog, QLineEdit, QPushButton, QComboBox, QWidget, QCheckBox, QRadioButton, \
-    QButtonGroup, QFileDialog, QProgressBar, QLabel, QMessageBox, QDialogButtonBox, QGroupBox, QFormLayout, QStatusBar
+    QButtonGroup, QFileDialog, QProgressBar, QLabel, QMessageBox, QDialogButtonBox, QGroupBox, QFormLayout, QStatusBar, \
+    QListWidget, QListWidgetItem
 
 import banner
 
@@ -31,45 +35,136 @@ class ESPWorker(QObject):
     error = pyqtSignal(Exception)
     waiting = pyqtSignal()
     done = pyqtSignal()
+    baud_found = pyqtSignal(int)
+    progress = pyqtSignal(str, int)
+    connection_state = pyqtSignal(str)
+
+    # tried from the starting rate down, a link failure at one rate retries at the next
+    BAUD_RATES = [2000000, 1500000, 921600, 460800, 115200]
+
+    # starting rate of an adapter which has no rate saved yet
+    DEFAULT_BAUD = 921600
+
+    # seconds the flashed firmware gets to boot before the configuration is sent
+    CONFIG_BOOT_TIME = 5
 
     def __init__(self, port, actions, **params):
         super().__init__()
+        self.port = port
         self.command = [
                       '--chip', 'esp8266',
                       '--port', port,
-                      '--baud', '115200'
+                      '--hash-cache', 'tasmotizer_hashes.json'
             ]
 
         self._actions = actions
         self._params = params
         self._continue = False
 
+        baud = params.get('baud') or self.DEFAULT_BAUD
+        self._bauds = [baud] + [b for b in self.BAUD_RATES if b < baud]
+
+        # per-command counters and latencies of all esptool runs of this worker
+        self.stats = esptool.CommandStats()
+
+        # progress and cancellation of this worker's esptool runs only
+        self.session = esptool.Session()
+        self.session.progress.connect(self.progress)
+        self.session.connection_state.connect(self.connection_state)
+
     @pyqtSlot()
     def run(self):
-        esptool.sw.setContinueFlag(True)
-
         try:
             if 'backup' in self._actions:
-                command_backup = ['read_flash', '0x00000', self._params['backup_size'],
-                                  'backup_{}.bin'.format(datetime.now().strftime('%Y%m%d_%H%M%S'))]
-                esptool.main(self.command + command_backup)
+                backup_dir = self._params.get('backup_dir') or os.getcwd()
+                os.makedirs(backup_dir, exist_ok=True)
+                archive = self._params.get('backup_archive')
+                backup_name = 'backup_{}'.format(datetime.now().strftime('%Y%m%d_%H%M%S'))
+                if self._params.get('backup_tag'):
+                    # tells apart the backups of devices flashed at the same time
+                    backup_name += '_' + re.sub(r'[^\w.-]', '_', self._params['backup_tag'])
+                backup_file = os.path.join(backup_dir, '{}.{}'.format(backup_name, 'tzb' if archive else 'bin'))
+                command_backup = ['read_flash', '--resume', '0x00000', self._params['backup_size'], backup_file]
+                if archive:
+                    command_backup.append('--archive')
+                self.run_esptool(command_backup)
 
                 auto_reset = self._params['auto_reset']
                 if not auto_reset:
                     self.wait_for_user()
 
-            if esptool.sw.continueFlag() and 'write' in self._actions:
+            if self.session.continueFlag() and 'write' in self._actions:
                 file_path = self._params['file_path']
-                command_write = ['write_flash', '--flash_mode', 'dout', '0x00000', file_path]
+                command_write = ['write_flash', '--flash_mode', 'dout', '--compress-level', 'auto', '0x00000', file_path]
 
                 if 'erase' in self._actions:
                     command_write.append('--erase-all')
-                esptool.main(self.command + command_write)
+                else:
+                    command_write.append('--diff-flash')
+
+                pipeline_window = self._params.get('pipeline_window', 1)
+                if pipeline_window > 1:
+                    command_write.extend(['--pipeline-window', str(pipeline_window)])
+                self.run_esptool(command_write)
+
+            if self.session.continueFlag():
+                self.baud_found.emit(self._bauds[0])
+
+            if self.session.continueFlag() and 'config' in self._actions:
+                if not self._params['auto_reset']:
+                    self.wait_for_user()
+                self.send_config(self._params['config'])
 
         except (esptool.FatalError, serial.SerialException) as e:
             self.error.emit(e)
         self.done.emit()
 
+    def run_esptool(self, command):
+        """ Run esptool with 'command', falling back to the next lower baud rate when the link fails
+
+        Only failures after the baud rate was changed are retried. A retried backup resumes
+        from what was already read and a retried write only writes the sectors that still
+        differ, so a fallback mid-job continues where it stopped. A write which already erased
+        the whole flash retries with --diff-flash instead of erasing it again.
+        """
+        baud_changes = self.stats.entry(esptool.ESPLoader.ESP_CHANGE_BAUDRATE)
+        erases = self.stats.entry(esptool.ESPLoader.ESP_ERASE_FLASH)
+        while True:
+            changes = baud_changes['count']
+            erased = erases['count'] - erases['failed']
+            try:
+                esptool.main(self.command + ['--baud', str(self._bauds[0])] + command, stats=self.stats, session=self.session)
+                return
+            except (esptool.FatalError, serial.SerialException) as e:
+                if baud_changes['count'] == changes or len(self._bauds) == 1 or not self.session.continueFlag():
+                    raise
+                print('Failed at {} baud ({}), retrying at {} baud'.format(self._bauds[0], e, self._bauds[1]))
+                self._bauds.pop(0)
+                self.connection_state.emit(f'Link failed, retrying at {self._bauds[0]} baud')
+                if '--erase-all' in command and erases['count'] - erases['failed'] > erased:
+                    command = [arg if arg != '--erase-all' else '--diff-flash' for arg in command]
+
+            if not self._params['auto_reset']:
+                self.wait_for_user()
+
+    def send_config(self, commands):
+        """ Send the 'commands' backlog to the flashed firmware once it had time to boot """
+        self.connection_state.emit('Waiting for the firmware to boot...')
+        port = serial.serial_for_url(self.port, 115200, do_not_open=True)
+        port.dtr = False
+        port.rts = False
+        port.open()
+        try:
+            deadline = time.time() + self.CONFIG_BOOT_TIME
+            while time.time() < deadline and self.session.continueFlag():
+                sleep(.1)
+            if self.session.continueFlag():
+                port.write(bytes(commands, 'utf8'))
+                port.flush()
+                self.connection_state.emit('Configuration sent')
+        finally:
+            port.close()
+
     def wait_for_user(self):
         self._continue = False
         self.waiting.emit()
@@ -80,7 +175,9 @@ class ESPWorker(QObject):
         self._continue = True
 
     def abort(self):
-        esptool.sw.setContinueFlag(False)
+        """ Stop this worker, without affecting other workers """
+        self.session.setContinueFlag(False)
+        self._continue = True
 
 
 class SendConfigDialog(QDialog):
@@ -292,8 +389,6 @@ class ProcessDialog(QDialog):
 
         self.exception = None
 
-        esptool.sw.progress.connect(self.update_progress)
-
         self.nam = QNetworkAccessManager()
         self.nrBinFile = QNetworkRequest()
         self.bin_data = b''
@@ -319,11 +414,17 @@ class ProcessDialog(QDialog):
         if self.backup:
             self._actions.append('backup')
             self.backup_size = kwargs.get('backup_size')
+            self.backup_dir = kwargs.get('backup_dir')
+            self.backup_archive = kwargs.get('backup_archive', False)
 
         self.erase = kwargs.get('erase')
         if self.erase:
             self._actions.append('erase')
 
+        self.pipeline_window = kwargs.get('pipeline_window', 1)
+
+        self.baud = kwargs.get('baud', 0)
+
         if self.file_path:
             self._actions.append('write')
 
@@ -373,12 +474,16 @@ class ProcessDialog(QDialog):
         params = {
             'file_path': self.file_path,
             'auto_reset': self.auto_reset,
-            'erase': self.erase
+            'erase': self.erase,
+            'pipeline_window': self.pipeline_window,
+            'baud': self.baud
         }
 
         if self.backup:
             backup_size = f'0x{2 ** self.backup_size}00000'
             params['backup_size'] = backup_size
+            params['backup_dir'] = self.backup_dir
+            params['backup_archive'] = self.backup_archive
 
         self.esp_thread = QThread()
         self.esp = ESPWorker(
@@ -386,8 +491,10 @@ class ProcessDialog(QDialog):
             self._actions,
             **params
         )
-        esptool.sw.connection_state.connect(self.show_connection_state)
+        self.esp.progress.connect(self.update_progress)
+        self.esp.connection_state.connect(self.show_connection_state)
         self.esp.waiting.connect(self.wait_for_user)
+        self.esp.baud_found.connect(self.set_baud)
         self.esp.done.connect(self.accept)
         self.esp.error.connect(self.error)
         self.esp.moveToThread(self.esp_thread)
@@ -401,6 +508,9 @@ class ProcessDialog(QDialog):
         else:
             self.run_esp()
 
+    def set_baud(self, baud):
+        self.baud = baud
+
     def update_progress(self, action, value):
         self._action_widgets[action].setValue(value)
 
@@ -440,6 +550,398 @@ class ProcessDialog(QDialog):
         self.stop_thread()
 
 
+class ParallelFlasher(QObject):
+    """ Writes one image to several ports at once
+
+    The image is downloaded and packed into a backup archive once, so padding and
+    compression aren't repeated per port: every ESPWorker sends the same compressed blocks.
+    Each port gets its own worker thread and loader session. At most 'limit' ports are
+    flashed at the same time, so a USB hub isn't given more than it can carry, the others
+    wait for a free slot.
+
+    With 'keep_running' the flasher doesn't finish when all ports are done but waits for
+    more from add_port() until it is aborted.
+    """
+    progress = pyqtSignal(str, str, int)  # port, action, percent
+    connection_state = pyqtSignal(str, str)  # port, state
+    waiting = pyqtSignal(str)
+    baud_found = pyqtSignal(str, int)
+    port_done = pyqtSignal(str, object)  # port, exception or None
+    image_progress = pyqtSignal(int)
+    throughput = pyqtSignal(float)  # bytes of the image written per second, all ports together
+    error = pyqtSignal(Exception)
+    finished = pyqtSignal()
+
+    def __init__(self, ports, actions, limit, bauds=None, keep_running=False, **params):
+        super().__init__()
+        self._pending = list(ports)
+        self._actions = actions
+        self._limit = max(1, limit)
+        self._bauds = dict(bauds or {})
+        self._keep_running = keep_running
+        self._params = params
+
+        self._workers = {}  # port -> (ESPWorker, QThread) of the ports being flashed
+        self._errors = {}
+        self._written = {}  # port -> bytes of the image written so far
+        self._written_done = 0  # bytes written to the ports which are done
+        self._image_path = None
+        self._image_size = 0
+        self._temp_path = None
+        self._started = None
+        self.aborted = False
+
+        self.nam = QNetworkAccessManager()
+        self.bin_reply = None
+        self.bin_data = b''
+
+    def start(self):
+        file_path = self._params['file_path']
+        if file_path.startswith('http'):
+            self.bin_reply = self.nam.get(QNetworkRequest(QUrl(file_path)))
+            self.bin_reply.readyRead.connect(self.appendBinFile)
+            self.bin_reply.downloadProgress.connect(self.updateBinProgress)
+            self.bin_reply.finished.connect(self.saveBinFile)
+        else:
+            try:
+                with open(file_path, 'rb') as f:
+                    if esptool.BackupArchive.is_archive(f):
+                        self._image_size = esptool.BackupArchive(f).size
+                        self._image_path = file_path
+                    else:
+                        self.prepare_image(f.read())
+            except (OSError, esptool.FatalError) as e:
+                self.fail(e)
+                return
+            self.start_workers()
+
+    def appendBinFile(self):
+        self.bin_data += self.bin_reply.readAll()
+
+    def updateBinProgress(self, recv, total):
+        if total > 0:
+            self.image_progress.emit(recv * 100 // total)
+
+    def saveBinFile(self):
+        if self.aborted:
+            return
+        if self.bin_reply.error() != QNetworkReply.NoError:
+            self.fail(NetworkError(self.bin_reply.errorString()))
+            return
+        try:
+            self.prepare_image(self.bin_data)
+        except OSError as e:
+            self.fail(e)
+            return
+        self.start_workers()
+
+    def prepare_image(self, data):
+        """ Pad 'data' like write_flash does and pack it into a temporary archive for all ports """
+        image = esptool.pad_to(data, 4)
+        fd, self._temp_path = tempfile.mkstemp(prefix='tasmotizer_', suffix='.tzb')
+        with os.fdopen(fd, 'wb') as f:
+            esptool.BackupArchive.write(f, 0, len(image), [image])
+        self._image_path = self._temp_path
+        self._image_size = len(image)
+
+    def start_workers(self):
+        self.image_progress.emit(100)
+        self._started = time.time()
+        for _ in range(self._limit):
+            self.start_next()
+
+    def add_port(self, port, baud=0):
+        """ Flash 'port' too, once a slot is free """
+        if self.aborted or port in self._pending:
+            return
+        self._pending.append(port)
+        self._bauds[port] = baud
+        if self._image_path:
+            self.start_next()
+
+    def remove_port(self, port):
+        """ Drop 'port' if it is still waiting, or cancel its worker without affecting the others """
+        if port in self._pending:
+            self._pending.remove(port)
+            self.port_done.emit(port, None)
+        elif port in self._workers:
+            self._workers[port][0].abort()
+
+    def start_next(self):
+        if self.aborted or len(self._workers) >= self._limit:
+            return
+        # a port plugged in again waits until the worker of its previous device has stopped
+        port = next((port for port in self._pending if port not in self._workers), None)
+        if port is None:
+            return
+        self._pending.remove(port)
+        self._errors.pop(port, None)
+        params = dict(self._params, file_path=self._image_path, baud=self._bauds.get(port, 0),
+                      backup_tag=QSerialPortInfo(port).portName() or port)
+        worker = ESPWorker(port, self._actions, **params)
+        thread = QThread()
+        worker.progress.connect(lambda action, value: self.update_progress(port, action, value))
+        worker.connection_state.connect(lambda state: self.connection_state.emit(port, state))
+        worker.waiting.connect(lambda: self.waiting.emit(port))
+        worker.baud_found.connect(lambda baud: self.baud_found.emit(port, baud))
+        worker.error.connect(lambda e: self._errors.__setitem__(port, e))
+        worker.done.connect(lambda: self.worker_done(port))
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        self._workers[port] = (worker, thread)
+        thread.start()
+
+    def update_progress(self, port, action, value):
+        self.progress.emit(port, action, value)
+        if action == 'write':
+            self._written[port] = self._image_size * value // 100
+            elapsed = time.time() - self._started
+            if elapsed > 0:
+                self.throughput.emit((self._written_done + sum(self._written.values())) / elapsed)
+
+    def worker_done(self, port):
+        worker, thread = self._workers.pop(port)
+        thread.quit()
+        thread.wait()
+        self._written_done += self._written.pop(port, 0)
+        self.port_done.emit(port, self._errors.get(port))
+        self.start_next()
+        if not self._workers and not (self._pending and not self.aborted) and not self._keep_running:
+            self.finish()
+
+    def continue_ok(self, port):
+        self._workers[port][0].continue_ok()
+
+    def abort(self):
+        self.aborted = True
+        self._keep_running = False
+        self._pending.clear()
+        for worker, thread in self._workers.values():
+            worker.abort()
+        if not self._workers:
+            if self.bin_reply and self.bin_reply.isRunning():
+                self.bin_reply.abort()
+            self.finish()
+
+    def fail(self, e):
+        self.error.emit(e)
+        self.finish()
+
+    def finish(self):
+        if self._temp_path:
+            os.remove(self._temp_path)
+            self._temp_path = None
+        self.finished.emit()
+
+
+class ParallelProcessDialog(QDialog):
+    def __init__(self, ports, limit, keep_running=False, **kwargs):
+        super().__init__()
+
+        self.setWindowTitle('Tasmotizing...')
+        self.setFixedWidth(400)
+
+        self.exception = None
+        self.failures = {}  # port -> exception
+        self.bauds = {}  # port -> baud rate which worked
+
+        self._bars = {}
+        self._running = True
+        self._jobs = 0
+        self._done = 0
+        self._failed = 0
+        self._throughput = 0
+
+        actions = []
+        params = {
+            'file_path': kwargs.get('file_path'),
+            'auto_reset': kwargs.get('auto_reset', False),
+            'erase': kwargs.get('erase'),
+            'pipeline_window': kwargs.get('pipeline_window', 1)
+        }
+        if kwargs.get('backup'):
+            actions.append('backup')
+            params['backup_size'] = f'0x{2 ** kwargs.get("backup_size", 0)}00000'
+            params['backup_dir'] = kwargs.get('backup_dir')
+            params['backup_archive'] = kwargs.get('backup_archive', False)
+        actions.append('write')
+        if kwargs.get('erase'):
+            actions.append('erase')
+        if kwargs.get('config'):
+            actions.append('config')
+            params['config'] = kwargs['config']
+
+        self.flasher = ParallelFlasher(ports, actions, limit, bauds=kwargs.get('bauds'), keep_running=keep_running, **params)
+        self.flasher.progress.connect(self.update_progress)
+        self.flasher.connection_state.connect(self.show_connection_state)
+        self.flasher.waiting.connect(self.wait_for_user)
+        self.flasher.baud_found.connect(self.bauds.__setitem__)
+        self.flasher.port_done.connect(self.port_done)
+        self.flasher.image_progress.connect(lambda value: self.pbImage.setValue(value))
+        self.flasher.throughput.connect(self.update_throughput)
+        self.flasher.error.connect(self.error)
+        self.flasher.finished.connect(self.flashing_finished)
+
+        self.create_ui()
+        for port in ports:
+            self.add_row(port)
+        QTimer.singleShot(0, self.flasher.start)
+
+    def create_ui(self):
+        self.setLayout(VLayout(5, 5))
+        self.actions_layout = QFormLayout()
+        self.actions_layout.setSpacing(5)
+        self.layout().addLayout(self.actions_layout)
+
+        self.pbImage = QProgressBar()
+        self.pbImage.setFixedHeight(35)
+        self.actions_layout.addRow('Image', self.pbImage)
+
+        self.btns = QDialogButtonBox(QDialogButtonBox.Abort)
+        self.btns.rejected.connect(self.abort)
+        self.layout().addWidget(self.btns)
+
+        self.sb = QStatusBar()
+        self.layout().addWidget(self.sb)
+
+    def add_row(self, port):
+        """ Show the progress of a job on 'port', reusing the row of an earlier job on it """
+        pb = self._bars.get(port)
+        if pb is None:
+            pb = self._bars[port] = QProgressBar()
+            pb.setFixedHeight(35)
+            self.actions_layout.addRow(QSerialPortInfo(port).portName() or port, pb)
+        pb.setValue(0)
+        pb.setFormat('Waiting')
+        pb.setToolTip('')
+        self._jobs += 1
+        self.show_status()
+
+    def show_connection_state(self, port, state):
+        self._bars[port].setFormat(f'{state} %p%')
+
+    def update_progress(self, port, action, value):
+        self._bars[port].setFormat(f'{action.capitalize()} %p%')
+        self._bars[port].setValue(value)
+
+    def update_throughput(self, throughput):
+        self._throughput = throughput
+        self.show_status()
+
+    def show_status(self):
+        self.sb.showMessage(f'{self._done} of {self._jobs} done, {self._failed} failed, '
+                            f'{self._throughput / 1024:.1f} kB/s', 0)
+
+    def port_done(self, port, e):
+        pb = self._bars[port]
+        if e:
+            self._failed += 1
+            self.failures[port] = e
+            pb.setFormat('Failed')
+            pb.setToolTip(str(e))
+        elif self.flasher.aborted:
+            pb.setFormat('Aborted')
+        else:
+            self._done += 1
+            pb.setFormat('Done')
+            pb.setValue(100)
+        self.show_status()
+
+    @pyqtSlot(str)
+    def wait_for_user(self, port):
+        dlg = QMessageBox.information(self,
+                                      'User action required',
+                                      f'Please power cycle the device on {port}, wait a moment and press OK',
+                                      QMessageBox.Ok | QMessageBox.Cancel)
+        if dlg == QMessageBox.Cancel:
+            self.abort()
+        else:
+            self.flasher.continue_ok(port)
+
+    def flashing_finished(self):
+        self._running = False
+        if self.exception or self.failures or self.flasher.aborted:
+            self.reject()
+        else:
+            self.accept()
+
+    def abort(self):
+        self.sb.showMessage('Aborting...', 0)
+        self.flasher.abort()
+
+    def reject(self):
+        # closing the dialog aborts, it is closed when the workers have stopped
+        if self._running:
+            self.abort()
+        else:
+            super().reject()
+
+    def error(self, e):
+        self.exception = e
+
+
+class StationDialog(ParallelProcessDialog):
+    """ Runs the job on every serial port which appears while the dialog is open
+
+    Ports present when the station starts are left alone. A port which disappears
+    mid-job has its worker cancelled, the other jobs carry on.
+    """
+    POLL_INTERVAL = 500  # ms between looks at the serial ports
+
+    def __init__(self, limit, baud_for_port, **kwargs):
+        self._ports = self.available_ports()
+        self._active = set()  # ports with a job waiting or running
+        self._unplugged = set()
+        self.baud_for_port = baud_for_port
+        super().__init__([], limit, keep_running=True, **kwargs)
+        self.setWindowTitle('Tasmotizer station')
+        self.btns.button(QDialogButtonBox.Abort).setText('Stop')
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.poll_ports)
+        self.poll_timer.start(self.POLL_INTERVAL)
+
+    def create_ui(self):
+        super().create_ui()
+        lbHint = QLabel('Plug in devices to flash them, unplug them when they are done.')
+        lbHint.setWordWrap(True)
+        self.layout().insertWidget(0, lbHint)
+
+    @staticmethod
+    def available_ports():
+        return {port.systemLocation() for port in QSerialPortInfo.availablePorts()}
+
+    def poll_ports(self):
+        ports = self.available_ports()
+        for port in sorted(self._ports - ports):
+            if port in self._active:
+                self._unplugged.add(port)
+                self.flasher.remove_port(port)
+        for port in sorted(ports - self._ports):
+            if port not in self._active:
+                self._active.add(port)
+                self.add_row(port)
+                self.flasher.add_port(port, self.baud_for_port(port))
+        self._ports = ports
+
+    def port_done(self, port, e):
+        self._active.discard(port)
+        if port in self._unplugged:
+            self._unplugged.discard(port)
+            self._failed += 1
+            self._bars[port].setFormat('Unplugged')
+            self.show_status()
+        else:
+            super().port_done(port, e)
+
+    def abort(self):
+        self.poll_timer.stop()
+        super().abort()
+
+    def summary(self):
+        return f'{self._done} devices flashed, {self._failed} failed or unplugged.'
+
+
 class DeviceIP(QDialog):
     def __init__(self, port: QSerialPort):
         super(DeviceIP, self).__init__()
@@ -524,10 +1026,42 @@ class Tasmotizer(QDialog):
         gbPort = GroupBoxH('Select port', 3)
         self.cbxPort = QComboBox()
         pbRefreshPorts = QPushButton('Refresh')
+        self.cbxBaud = QComboBox()
+        self.cbxBaud.addItem('Auto', 0)
+        for baud in ESPWorker.BAUD_RATES:
+            self.cbxBaud.addItem(str(baud), baud)
+        self.cbxBaud.setCurrentIndex(self.cbxBaud.findData(self.settings.value('baud', 0, int)))
+        self.cbxBaud.setToolTip('Baud rate used after connecting. Auto starts at the fastest rate which worked with the USB adapter before, or at 921600 for a new one.\n'
+                                'If the link fails, the next lower rate is tried.')
         gbPort.addWidget(self.cbxPort)
+        gbPort.addWidget(self.cbxBaud)
         gbPort.addWidget(pbRefreshPorts)
         gbPort.layout().setStretch(0, 4)
-        gbPort.layout().setStretch(1, 1)
+        gbPort.layout().setStretch(1, 2)
+        gbPort.layout().setStretch(2, 1)
+
+        # Parallel flashing groupbox
+        self.gbParallel = GroupBoxV('Flash several ports at once')
+        self.gbParallel.setCheckable(True)
+        self.gbParallel.setChecked(False)
+        self.gbParallel.setToolTip('Write the image to every checked port, the image is prepared only once.')
+
+        self.wParallel = QWidget()
+        self.wParallel.setVisible(False)
+        vl_parallel = VLayout(0)
+        self.lwPorts = QListWidget()
+        self.lwPorts.setFixedHeight(100)
+        self.sbParallelLimit = SpinBox(minimum=1, maximum=16)
+        self.sbParallelLimit.setValue(self.settings.value('parallel_limit', 4, int))
+        self.sbParallelLimit.setToolTip('Ports flashed at the same time, lower it if a USB hub can not keep up')
+        hl_limit = HLayout(0)
+        hl_limit.addWidgets([QLabel('At the same time:'), self.sbParallelLimit])
+        hl_limit.setStretch(0, 3)
+        hl_limit.setStretch(1, 1)
+        vl_parallel.addWidget(self.lwPorts)
+        vl_parallel.addLayout(hl_limit)
+        self.wParallel.setLayout(vl_parallel)
+        self.gbParallel.addWidget(self.wParallel)
 
         # Firmware groupbox
         gbFW = GroupBoxV('Select image', 3)
@@ -576,14 +1110,42 @@ class Tasmotizer(QDialog):
         hl_backup_size.setStretch(0, 3)
         hl_backup_size.setStretch(1, 1)
 
+        self.wBackupDir = QWidget()
+        self.wBackupDir.setEnabled(False)
+        hl_backup_dir = HLayout(0)
+        self.backup_dir = QLineEdit()
+        self.backup_dir.setReadOnly(True)
+        self.backup_dir.setText(self.settings.value('backup_dir', os.getcwd()))
+        pbBackupDir = QPushButton('Browse')
+        hl_backup_dir.addWidgets([QLabel('Folder:'), self.backup_dir, pbBackupDir])
+        self.wBackupDir.setLayout(hl_backup_dir)
+
+        self.cbBackupArchive = QCheckBox('Compress backup')
+        self.cbBackupArchive.setToolTip('Save the backup as a compressed .tzb archive instead of a raw .bin file.\n'
+                                        'Unused flash takes next to no space. Select the archive as BIN file to restore it.')
+        self.cbBackupArchive.setChecked(self.settings.value('backup_archive', False, bool))
+        self.cbBackupArchive.setEnabled(False)
+
         gbBackup.addWidget(self.cbBackup)
         gbBackup.addLayout(hl_backup_size)
+        gbBackup.addWidget(self.wBackupDir)
+        gbBackup.addWidget(self.cbBackupArchive)
 
         self.cbErase = QCheckBox('Erase before flashing')
         self.cbErase.setToolTip('Erasing previous firmware ensures all flash regions are clean for Tasmota, which prevents many unexpected issues.\nIf unsure, leave enabled.')
         self.cbErase.setChecked(True)
 
+        self.sbPipelineWindow = SpinBox(minimum=1, maximum=esptool.ESPLoader.FLASH_PIPELINE_MAX_WINDOW)
+        self.sbPipelineWindow.setValue(self.settings.value('pipeline_window', 1, int))
+        self.sbPipelineWindow.setToolTip('Image blocks sent ahead without waiting for the device to confirm the previous one.\n'
+                                         'More than 1 speeds up writing, the transfer falls back to 1 if the device can not keep up.')
+        hl_pipeline = HLayout(0)
+        hl_pipeline.addWidgets([QLabel('Blocks in flight:'), self.sbPipelineWindow])
+        hl_pipeline.setStretch(0, 3)
+        hl_pipeline.setStretch(1, 1)
+
         gbFW.addWidgets([self.wFile, self.cbHackboxBin, self.cbSelfReset, self.cbErase])
+        gbFW.addLayout(hl_pipeline)
 
         # Buttons
         self.pbTasmotize = QPushButton('Tasmotize!')
@@ -594,6 +1156,11 @@ class Tasmotizer(QDialog):
         self.pbConfig.setStyleSheet('background-color: #571054;')
         self.pbConfig.setFixedHeight(50)
 
+        self.pbStation = QPushButton('Station')
+        self.pbStation.setFixedSize(QSize(75, 50))
+        self.pbStation.setStyleSheet('background-color: #223579;')
+        self.pbStation.setToolTip('Flash every device plugged in from now on with the settings above, several at the same time')
+
         self.pbGetIP = QPushButton('Get IP')
         self.pbGetIP.setFixedSize(QSize(75, 50))
         self.pbGetIP.setStyleSheet('background-color: #2a8a26;')
@@ -603,30 +1170,56 @@ class Tasmotizer(QDialog):
         self.pbQuit.setFixedSize(QSize(50, 50))
 
         hl_btns = HLayout([50, 3, 50, 3])
-        hl_btns.addWidgets([self.pbTasmotize, self.pbConfig, self.pbGetIP, self.pbQuit])
+        hl_btns.addWidgets([self.pbTasmotize, self.pbStation, self.pbConfig, self.pbGetIP, self.pbQuit])
 
-        vl.addWidgets([gbPort, gbBackup, gbFW])
+        vl.addWidgets([gbPort, self.gbParallel, gbBackup, gbFW])
         vl.addLayout(hl_btns)
 
         pbRefreshPorts.clicked.connect(self.refreshPorts)
+        self.gbParallel.toggled.connect(self.wParallel.setVisible)
+        self.gbParallel.toggled.connect(lambda checked: self.cbxPort.setEnabled(not checked))
         self.rbgFW.buttonClicked[int].connect(self.setBinMode)
         rbFile.setChecked(True)
         pbFile.clicked.connect(self.openBinFile)
 
         self.cbBackup.toggled.connect(self.cbxBackupSize.setEnabled)
+        self.cbBackup.toggled.connect(self.wBackupDir.setEnabled)
+        self.cbBackup.toggled.connect(self.cbBackupArchive.setEnabled)
+        pbBackupDir.clicked.connect(self.openBackupDir)
 
         self.pbTasmotize.clicked.connect(self.start_process)
+        self.pbStation.clicked.connect(self.start_station)
         self.pbConfig.clicked.connect(self.send_config)
         self.pbGetIP.clicked.connect(self.get_ip)
         self.pbQuit.clicked.connect(self.reject)
 
     def refreshPorts(self):
         self.cbxPort.clear()
+        checked = set(self.checkedPorts())
+        self.lwPorts.clear()
         ports = reversed(sorted(port.portName() for port in QSerialPortInfo.availablePorts()))
         for p in ports:
             port = QSerialPortInfo(p)
             self.cbxPort.addItem(port.portName(), port.systemLocation())
 
+            item = QListWidgetItem(port.portName())
+            item.setData(Qt.UserRole, port.systemLocation())
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if port.systemLocation() in checked else Qt.Unchecked)
+            self.lwPorts.addItem(item)
+
+    def checkedPorts(self):
+        """ System locations of the ports checked for parallel flashing """
+        items = (self.lwPorts.item(i) for i in range(self.lwPorts.count()))
+        return [item.data(Qt.UserRole) for item in items if item.checkState() == Qt.Checked]
+
+    def adapterKey(self, port_name=None):
+        """ Identifies the USB adapter of the selected port, or of 'port_name', by VID:PID and serial number """
+        port = QSerialPortInfo(port_name or self.cbxPort.currentText())
+        if port.hasVendorIdentifier() and port.hasProductIdentifier():
+            return f'{port.vendorIdentifier():04x}_{port.productIdentifier():04x}_{port.serialNumber()}'
+        return port.portName()
+
     def setBinMode(self, radio):
         self.mode = radio
         self.wFile.setVisible(self.mode == 0)
@@ -678,10 +1271,16 @@ class Tasmotizer(QDialog):
 
     def openBinFile(self):
         previous_file = self.settings.value('bin_file')
-        file, ok = QFileDialog.getOpenFileName(self, 'Select Tasmota image', previous_file, filter='BIN files (*.bin)')
+        file, ok = QFileDialog.getOpenFileName(self, 'Select Tasmota image', previous_file, filter='BIN files and backup archives (*.bin *.tzb)')
         if ok:
             self.file.setText(file)
 
+    def openBackupDir(self):
+        directory = QFileDialog.getExistingDirectory(self, 'Select backup folder', self.backup_dir.text())
+        if directory:
+            self.backup_dir.setText(directory)
+            self.settings.setValue('backup_dir', directory)
+
     def get_ip(self):
         self.port = QSerialPort(self.cbxPort.currentData())
         self.port.setBaudRate(115200)
@@ -732,28 +1331,56 @@ class Tasmotizer(QDialog):
             else:
                 QMessageBox.information(self, 'Done', 'Nothing to send')
 
+    def select_image(self):
+        if self.mode == 0:
+            if len(self.file.text()) > 0:
+                self.file_path = self.file.text()
+                self.settings.setValue('bin_file', self.file_path)
+            else:
+                raise NoBinFile
+
+        elif self.mode in (1, 2):
+            self.file_path = self.cbHackboxBin.currentData()
+
+        self.settings.setValue('baud', self.cbxBaud.currentData())
+        self.settings.setValue('backup_archive', self.cbBackupArchive.isChecked())
+        self.settings.setValue('pipeline_window', self.sbPipelineWindow.value())
+        self.settings.setValue('parallel_limit', self.sbParallelLimit.value())
+
+    def adapterBaud(self, port):
+        """ Starting baud rate for 'port', the one selected or the one which worked with its adapter before """
+        return self.cbxBaud.currentData() or self.settings.value(f'adapter_baud/{self.adapterKey(QSerialPortInfo(port).portName())}', 0, int)
+
     def start_process(self):
         try:
-            if self.mode == 0:
-                if len(self.file.text()) > 0:
-                    self.file_path = self.file.text()
-                    self.settings.setValue('bin_file', self.file_path)
-                else:
-                    raise NoBinFile
+            self.select_image()
 
-            elif self.mode in (1, 2):
-                self.file_path = self.cbHackboxBin.currentData()
+            if self.gbParallel.isChecked():
+                self.start_parallel()
+                return
+
+            baud = self.cbxBaud.currentData()
+            baud_key = f'adapter_baud/{self.adapterKey()}'
+            if not baud:
+                baud = self.settings.value(baud_key, 0, int)
 
             process_dlg = ProcessDialog(
                 self.cbxPort.currentData(),
                 file_path=self.file_path,
                 backup=self.cbBackup.isChecked(),
                 backup_size=self.cbxBackupSize.currentIndex(),
+                backup_dir=self.backup_dir.text(),
+                backup_archive=self.cbBackupArchive.isChecked(),
                 erase=self.cbErase.isChecked(),
-                auto_reset=self.cbSelfReset.isChecked()
+                pipeline_window=self.sbPipelineWindow.value(),
+                auto_reset=self.cbSelfReset.isChecked(),
+                baud=baud
             )
             result = process_dlg.exec_()
             if result == QDialog.Accepted:
+                if process_dlg.baud and not self.cbxBaud.currentData():
+                    self.settings.setValue(baud_key, process_dlg.baud)
+
                 message = 'Process successful!'
                 if not self.cbSelfReset.isChecked():
                     message += ' Power cycle the device.'
@@ -770,6 +1397,87 @@ class Tasmotizer(QDialog):
         except NetworkError as e:
             QMessageBox.critical(self, 'Network error', e.message)
 
+    def start_parallel(self):
+        ports = self.checkedPorts()
+        if not ports:
+            QMessageBox.critical(self, 'No ports checked', 'Check the ports to flash in the list.')
+            return
+
+        process_dlg = ParallelProcessDialog(
+            ports,
+            self.sbParallelLimit.value(),
+            file_path=self.file_path,
+            backup=self.cbBackup.isChecked(),
+            backup_size=self.cbxBackupSize.currentIndex(),
+            backup_dir=self.backup_dir.text(),
+            backup_archive=self.cbBackupArchive.isChecked(),
+            erase=self.cbErase.isChecked(),
+            pipeline_window=self.sbPipelineWindow.value(),
+            auto_reset=self.cbSelfReset.isChecked(),
+            bauds={port: self.adapterBaud(port) for port in ports}
+        )
+        result = process_dlg.exec_()
+        self.saveAdapterBauds(process_dlg.bauds)
+
+        if result == QDialog.Accepted:
+            message = f'Flashed {len(ports)} devices successfully!'
+            if not self.cbSelfReset.isChecked():
+                message += ' Power cycle the devices.'
+            QMessageBox.information(self, 'Done', message)
+        elif process_dlg.exception:
+            QMessageBox.critical(self, 'Error', str(process_dlg.exception))
+        elif process_dlg.failures:
+            failures = '\n'.join(f'{QSerialPortInfo(port).portName() or port}: {e}' for port, e in process_dlg.failures.items())
+            QMessageBox.critical(self, 'Error', f'{len(process_dlg.failures)} of {len(ports)} devices failed:\n{failures}')
+        else:
+            QMessageBox.critical(self, 'Process aborted', 'The process has been aborted by the user.')
+
+    def saveAdapterBauds(self, bauds):
+        """ Remember the rates negotiated with Auto, a rate picked by hand says nothing about the adapter """
+        if self.cbxBaud.currentData():
+            return
+        for port, baud in bauds.items():
+            self.settings.setValue(f'adapter_baud/{self.adapterKey(QSerialPortInfo(port).portName())}', baud)
+
+    def start_station(self):
+        try:
+            self.select_image()
+        except NoBinFile:
+            QMessageBox.critical(self, 'Image path missing', 'Select a binary to write, or select a different mode.')
+            return
+
+        config = None
+        answer = QMessageBox.question(self, 'Station', 'Send a configuration to every device after flashing?',
+                                      QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.No)
+        if answer == QMessageBox.Cancel:
+            return
+        if answer == QMessageBox.Yes:
+            dlg = SendConfigDialog()
+            if dlg.exec_() != QDialog.Accepted or not dlg.commands:
+                return
+            config = dlg.commands
+
+        station_dlg = StationDialog(
+            self.sbParallelLimit.value(),
+            self.adapterBaud,
+            file_path=self.file_path,
+            backup=self.cbBackup.isChecked(),
+            backup_size=self.cbxBackupSize.currentIndex(),
+            backup_dir=self.backup_dir.text(),
+            backup_archive=self.cbBackupArchive.isChecked(),
+            erase=self.cbErase.isChecked(),
+            pipeline_window=self.sbPipelineWindow.value(),
+            auto_reset=self.cbSelfReset.isChecked(),
+            config=config
+        )
+        station_dlg.exec_()
+        self.saveAdapterBauds(station_dlg.bauds)
+
+        if station_dlg.exception:
+            QMessageBox.critical(self, 'Error', str(station_dlg.exception))
+        else:
+            QMessageBox.information(self, 'Station stopped', station_dlg.summary())
+
 
 def main():
     app = QApplication(sys.argv)
@@ -19,16 +19,24 @@
 from __future__ import division, print_function
 
 import argparse
+import asyncio
 import base64
 import binascii
+import bisect
+import collections
+import contextlib
 import copy
 import hashlib
 import inspect
 import io
+import json
 import os
+import queue
 import shlex
 import struct
 import sys
+import tempfile
+import threading
 import time
 import zlib
 import string
@@ -36,8 +44,14 @@ import string
 from PyQt5.QtCore import pyqtSignal, QObject, pyqtSlot
 
 
-class SignalWrapper(QObject):
+class Session(QObject):
+    """ Cancellation and progress reporting of the loaders of one job
 
+    A loader reports connection state and progress through the signals of its session
+    and stops between blocks once the session's continue flag is cleared. Loaders of
+    different sessions can run in one process without one job stopping or reporting
+    for another.
+    """
     connection_state = pyqtSignal(str)
     progress = pyqtSignal(str, int)
 
@@ -52,7 +66,7 @@ class SignalWrapper(QObject):
         self._continue_flag = state
 
 
-sw = SignalWrapper()
+sw = Session()  # session of the loaders created without one
 
 try:
     import serial
@@ -93,7 +107,10 @@ MAX_TIMEOUT = CHIP_ERASE_TIMEOUT * 2  # longest any command can run
 SYNC_TIMEOUT = 0.1                    # timeout for syncing with bootloader
 MD5_TIMEOUT_PER_MB = 8                # timeout (per megabyte) for calculating md5sum
 ERASE_REGION_TIMEOUT_PER_MB = 30      # timeout (per megabyte) for erasing a region
+ERASE_WRITE_TIMEOUT_PER_MB = 40       # timeout (per megabyte) for erasing and writing data
+VERIFY_BISECT_MAX_HASHES = 256        # flash_md5sum calls verify_flash spends finding differing sectors
 MEM_END_ROM_TIMEOUT = 0.05            # special short timeout for ESP_MEM_END, as it may never respond
+PROBE_TIMEOUT = 5                     # seconds a port gets to answer when probing all ports for a chip
 DEFAULT_SERIAL_WRITE_TIMEOUT = 10     # timeout for serial port write
 
 
@@ -218,6 +235,10 @@ class ESPLoader(object):
 
     FLASH_WRITE_SIZE = 0x400
 
+    # The flasher stub receives commands into two alternating buffers, so no more than
+    # two flash data blocks can be waiting for their response without data being dropped
+    FLASH_PIPELINE_MAX_WINDOW = 2
+
     # Default baudrate. The ROM auto-bauds, so we can use more or less whatever we want.
     ESP_ROM_BAUD    = 115200
 
@@ -242,7 +263,10 @@ class ESPLoader(object):
     # The number of bytes in the UART response that signify command status
     STATUS_BYTES_LENGTH = 2
 
-    def __init__(self, port=DEFAULT_PORT, baud=ESP_ROM_BAUD, trace_enabled=False):
+    # Commands carrying at least this much data are timed to measure the link throughput
+    LINK_SAMPLE_MIN_SIZE = 0x400
+
+    def __init__(self, port=DEFAULT_PORT, baud=ESP_ROM_BAUD, trace_enabled=False, stats=None, session=None):
         """Base constructor for ESPLoader bootloader interaction
 
         Don't call this constructor, either instantiate ESP8266ROM
@@ -253,18 +277,23 @@ class ESPLoader(object):
         loaders. Subclasses replace the functions they don't support
         with ones which throw NotImplementedInROMError().
 
+        If 'stats' is a CommandStats instance every command is accounted in it. 'session'
+        is the Session the loader reports to and checks for cancellation, sw if not given.
         """
         if isinstance(port, basestring):
             self._port = serial.serial_for_url(port)
         else:
             self._port = port
-        self._slip_reader = slip_reader(self._port, self.trace)
+        self._slip_reader = slip_reader(self._port, self.trace, self._flush_writes)
+        self._slip_encoder = SlipEncoder()
         # setting baud rate in a separate step is a workaround for
         # CH341 driver on some Linux versions (this opens at 9600 then
         # sets), shouldn't matter for other platforms/drivers. See
         # https://github.com/espressif/esptool/issues/44#issuecomment-107094446
         self._set_port_baudrate(baud)
         self._trace_enabled = trace_enabled
+        self._stats = stats
+        self.session = session or sw
         # set write timeout, to prevent esptool blocked at write forever.
         try:
             self._port.write_timeout = DEFAULT_SERIAL_WRITE_TIMEOUT
@@ -279,9 +308,24 @@ class ESPLoader(object):
         except IOError:
             FatalError
             raise FatalError("Failed to set baud rate %d. The driver may not support this rate." % baud)
+        # throughput measured at the previous baud rate no longer applies
+        self._link_bytes = 0
+        self._link_time = 0.0
+
+    def link_throughput(self):
+        """ Bytes per second the chip accepted in data commands at the current baud rate
+
+        This includes the time the chip needs to handle the data, as measured by command()
+        and flash_blocks_pipelined(). Until data has been sent it is estimated from the
+        baud rate (10 bits per byte on the wire).
+        """
+        if self._link_time > 0:
+            return self._link_bytes / self._link_time
+        return self._port.baudrate / 10.0
 
     @staticmethod
-    def detect_chip(port=DEFAULT_PORT, baud=ESP_ROM_BAUD, connect_mode='default_reset', trace_enabled=False):
+    def detect_chip(port=DEFAULT_PORT, baud=ESP_ROM_BAUD, connect_mode='default_reset', trace_enabled=False, stats=None, deadline=None,
+                    session=None):
         """ Use serial access to detect the chip type.
 
         We use the UART's datecode register for this, it's mapped at
@@ -290,11 +334,12 @@ class ESPLoader(object):
         type.
 
         This routine automatically performs ESPLoader.connect() (passing
-        connect_mode parameter) as part of querying the chip.
+        connect_mode and deadline parameters) as part of querying the chip.
+        The port is closed again if that fails.
         """
-        detect_port = ESPLoader(port, baud, trace_enabled=trace_enabled)
-        detect_port.connect(connect_mode)
+        detect_port = ESPLoader(port, baud, trace_enabled=trace_enabled, stats=stats, session=session)
         try:
+            detect_port.connect(connect_mode, deadline)
             print('Detecting chip type...', end='')
             sys.stdout.flush()
             date_reg = detect_port.read_reg(ESPLoader.UART_DATA_REG_ADDR)
@@ -302,24 +347,54 @@ class ESPLoader(object):
             for cls in [ESP8266ROM, ESP32ROM]:
                 if date_reg == cls.DATE_REG_VALUE:
                     # don't connect a second time
-                    inst = cls(detect_port._port, baud, trace_enabled=trace_enabled)
+                    inst = cls(detect_port._port, baud, trace_enabled=trace_enabled, stats=stats, session=session)
                     print(' %s' % inst.CHIP_NAME, end='')
                     return inst
+        except (FatalError, OSError):
+            detect_port._port.close()
+            raise
         finally:
             print('')  # end line
+        detect_port._port.close()
         raise FatalError("Unexpected UART datecode value 0x%08x. Failed to autodetect chip type." % date_reg)
 
     """ Read a SLIP packet from the serial port """
     def read(self):
         return next(self._slip_reader)
 
-    """ Write bytes to the serial port while performing SLIP escaping """
-    def write(self, packet):
-        buf = b'\xc0' \
-              + (packet.replace(b'\xdb',b'\xdb\xdd').replace(b'\xc0',b'\xdb\xdc')) \
-              + b'\xc0'
-        self.trace("Write %d bytes: %s", len(buf), HexFormatter(buf))
-        self._port.write(buf)
+    """ Write bytes to the serial port while performing SLIP escaping
+
+    'payload' is appended to 'packet' inside the same frame, this lets callers
+    send a command header and a data block without concatenating them first.
+    """
+    def write(self, packet, payload=b''):
+        encoder = self._slip_encoder
+        frame = encoder.encode(packet, payload)
+        if self._trace_enabled:
+            self.trace("Write %d bytes: %s", len(frame), HexFormatter(frame))
+        if not encoder.batching or encoder.pending() >= encoder.FLUSH_THRESHOLD:
+            encoder.flush(self._port)
+
+    def _flush_writes(self):
+        """ Send the frames batch_writes() holds back, before waiting for data from the chip """
+        self._slip_encoder.flush(self._port)
+
+    @contextlib.contextmanager
+    def batch_writes(self):
+        """ Coalesce the frames written inside the 'with' block into as few serial port writes as possible
+
+        They are sent when the block ends, or once a response has to be read: the reader
+        flushes them before it waits for the port, so the chip always has what it is
+        expected to answer.
+        """
+        encoder = self._slip_encoder
+        encoder.batching += 1
+        try:
+            yield
+        finally:
+            encoder.batching -= 1
+            if not encoder.batching:
+                encoder.flush(self._port)
 
     def trace(self, message, *format_args):
         if self._trace_enabled:
@@ -336,60 +411,107 @@ class ESPLoader(object):
     """ Calculate checksum of a blob, as it is defined by the ROM """
     @staticmethod
     def checksum(data, state=ESP_CHECKSUM_MAGIC):
-        for b in data:
-            if type(b) is int:  # python 2/3 compat
-                state ^= b
-            else:
-                state ^= ord(b)
-
-        return state
+        # The checksum is the XOR of all bytes. Rather than looping over them in Python,
+        # load the data as one integer and fold its upper half onto its lower half until
+        # a single byte is left, so each step XORs many machine words at once.
+        value = int.from_bytes(data, 'little')
+        width = len(data)
+        while width > 1:
+            width = (width + 1) // 2
+            shift = width * 8
+            value = (value >> shift) ^ (value & ((1 << shift) - 1))
+        return state ^ value
 
     """ Send a request and read the response """
-    def command(self, op=None, data=b"", chk=0, wait_response=True, timeout=DEFAULT_TIMEOUT):
+    def command(self, op=None, data=b"", chk=0, wait_response=True, timeout=DEFAULT_TIMEOUT, payload=b""):
         saved_timeout = self._port.timeout
         new_timeout = min(timeout, MAX_TIMEOUT)
         if new_timeout != saved_timeout:
             self._port.timeout = new_timeout
 
+        timed = op is not None and wait_response
+        if timed:
+            started = time.perf_counter()
+        response = None
+        data_len = 0
         try:
             if op is not None:
-                self.trace("command op=0x%02x data len=%s wait_response=%d timeout=%.3f data=%s",
-                           op, len(data), 1 if wait_response else 0, timeout, HexFormatter(data))
-                pkt = struct.pack(b'<BBHI', 0x00, op, len(data), chk) + data
-                self.write(pkt)
+                data_len = len(data) + len(payload)
+                self.write(self._command_packet(op, data, chk, payload, wait_response, timeout), payload)
 
             if not wait_response:
                 return
 
-            # tries to get a response until that response has the
-            # same operation as the request or a retries limit has
-            # exceeded. This is needed for some esp8266s that
-            # reply with more sync responses than expected.
-            for retry in range(100):
-                p = self.read()
-                if len(p) < 8:
-                    continue
-                (resp, op_ret, len_ret, val) = struct.unpack('<BBHI', p[:8])
-                if resp != 1:
-                    continue
-                data = p[8:]
-                if op is None or op_ret == op:
-                    return val, data
+            response = self._read_response(op)
+            return response
         finally:
             if new_timeout != saved_timeout:
                 self._port.timeout = saved_timeout
+            if timed:
+                self._record_command(op, started, data_len, response)
 
-        raise FatalError("Response doesn't match request")
-
-    def check_command(self, op_description, op=None, data=b'', chk=0, timeout=DEFAULT_TIMEOUT):
+    def _command_packet(self, op, data, chk, payload, wait_response, timeout):
+        """ Header and 'data' of the frame of command 'op', 'payload' follows them in the same frame """
+        data_len = len(data) + len(payload)
+        if self._trace_enabled:
+            self.trace("command op=0x%02x data len=%s wait_response=%d timeout=%.3f data=%s",
+                       op, data_len, 1 if wait_response else 0, timeout, HexFormatter(data + payload))
+        return struct.pack(b'<BBHI', 0x00, op, data_len, chk) + data
+
+    def _record_command(self, op, started, data_len, response):
+        """ Account command 'op' sent at 'started' (a time.perf_counter() value), 'response' is None if it failed """
+        elapsed = time.perf_counter() - started
+        if self._stats is not None:
+            self._stats.record(op, elapsed, data_len, len(response[1]) if response else 0, failed=response is None)
+        if response is not None and data_len >= self.LINK_SAMPLE_MIN_SIZE:
+            self._link_bytes += data_len
+            self._link_time += elapsed
+
+    def _read_response(self, op=None, retries=100):
+        """ Read responses until one matches 'op', returns its (val, data) """
+        # tries to get a response until that response has the
+        # same operation as the request or a retries limit has
+        # exceeded. This is needed for some esp8266s that
+        # reply with more sync responses than expected.
+        for retry in range(retries):
+            response = self._match_response(op, self.read(), retry)
+            if response is not None:
+                return response
+        raise self._unmatched_response(op, retries)
+
+    def _match_response(self, op, p, retry):
+        """ (val, data) of the frame 'p' if it is the response to 'op', None if it is to be skipped
+
+        'retry' is the number of frames skipped before this one, which are accounted once
+        the response is found.
+        """
+        if len(p) < 8:
+            return None
+        (resp, op_ret, len_ret, val) = struct.unpack('<BBHI', p[:8])
+        if resp != 1 or (op is not None and op_ret != op):
+            return None
+        if retry and op is not None and self._stats is not None:
+            self._stats.entry(op)['retries'] += retry
+        return val, p[8:]
+
+    def _unmatched_response(self, op, retries):
+        """ The FatalError to raise when none of 'retries' frames was the response to 'op' """
+        if op is not None and self._stats is not None:
+            self._stats.entry(op)['retries'] += retries
+        return FatalError("Response doesn't match request")
+
+    def check_command(self, op_description, op=None, data=b'', chk=0, timeout=DEFAULT_TIMEOUT, payload=b''):
         """
         Execute a command with 'command', check the result code and throw an appropriate
         FatalError if it fails.
 
         Returns the "result" of a successful command.
         """
-        val, data = self.command(op, data, chk, timeout=timeout)
+        val, data = self.command(op, data, chk, timeout=timeout, payload=payload)
+        return self._check_response(op_description, val, data)
 
+    def _check_response(self, op_description, val, data):
+        """ Check the status bytes of a command response, see check_command() """
         # things are a bit weird here, bear with us
 
         # the status bytes are the last 2/4 bytes in the data (depending on chip)
@@ -409,7 +531,7 @@ class ESPLoader(object):
 
     def flush_input(self):
         self._port.flushInput()
-        self._slip_reader = slip_reader(self._port, self.trace)
+        self._slip_reader = slip_reader(self._port, self.trace, self._flush_writes)
 
     def sync(self):
         self.command(self.ESP_SYNC, b'\x07\x07\x12\x20' + 32 * b'\x55',
@@ -427,8 +549,8 @@ class ESPLoader(object):
         # request is sent with the updated RTS state and the same DTR state
         self._port.setDTR(self._port.dtr)
 
-    def _connect_attempt(self, mode='default_reset', esp32r0_delay=False):
-        """ A single connection attempt, with esp32r0 workaround options """
+    def _connect_attempt(self, mode='default_reset', esp32r0_delay=False, deadline=None):
+        """ A single connection attempt, with esp32r0 workaround options, syncing until 'deadline' at most """
         # esp32r0_delay is a workaround for bugs with the most common auto reset
         # circuit and Windows, if the EN pin on the dev board does not have
         # enough capacitance.
@@ -445,30 +567,9 @@ class ESPLoader(object):
         if mode == "no_reset_no_sync":
             return last_error
 
-        # issue reset-to-bootloader:
-        # RTS = either CH_PD/EN or nRESET (both active low = chip in reset
-        # DTR = GPIO0 (active low = boot to flasher)
-        #
-        # DTR & RTS are active low signals,
-        # ie True = pin @ 0V, False = pin @ VCC.
         if mode != 'no_reset':
-            self._setDTR(False)  # IO0=HIGH
-            self._setRTS(True)   # EN=LOW, chip in reset
-            time.sleep(0.1)
-            if esp32r0_delay:
-                # Some chips are more likely to trigger the esp32r0
-                # watchdog reset silicon bug if they're held with EN=LOW
-                # for a longer period
-                time.sleep(1.2)
-            self._setDTR(True)   # IO0=LOW
-            self._setRTS(False)  # EN=HIGH, chip out of reset
-            if esp32r0_delay:
-                # Sleep longer after reset.
-                # This workaround only works on revision 0 ESP32 chips,
-                # it exploits a silicon bug spurious watchdog reset.
-                time.sleep(0.4)  # allow watchdog reset to occur
-            time.sleep(0.05)
-            self._setDTR(False)  # IO0=HIGH, done
+            for delay in self._reset_to_bootloader(esp32r0_delay):
+                time.sleep(delay)
 
         for _ in range(5):
             try:
@@ -482,26 +583,61 @@ class ESPLoader(object):
                 else:
                     print('.', end='')
                 sys.stdout.flush()
-                time.sleep(0.05)
                 last_error = e
+                if deadline is not None and time.time() > deadline:
+                    break
+                time.sleep(0.05)
         return last_error
 
-    def connect(self, mode='default_reset'):
-        """ Try connecting repeatedly until successful, or giving up """
+    def _reset_to_bootloader(self, esp32r0_delay=False):
+        """ Reset the chip into the bootloader, yields the seconds to wait between the steps """
+        # issue reset-to-bootloader:
+        # RTS = either CH_PD/EN or nRESET (both active low = chip in reset
+        # DTR = GPIO0 (active low = boot to flasher)
+        #
+        # DTR & RTS are active low signals,
+        # ie True = pin @ 0V, False = pin @ VCC.
+        self._setDTR(False)  # IO0=HIGH
+        self._setRTS(True)   # EN=LOW, chip in reset
+        yield 0.1
+        if esp32r0_delay:
+            # Some chips are more likely to trigger the esp32r0
+            # watchdog reset silicon bug if they're held with EN=LOW
+            # for a longer period
+            yield 1.2
+        self._setDTR(True)   # IO0=LOW
+        self._setRTS(False)  # EN=HIGH, chip out of reset
+        if esp32r0_delay:
+            # Sleep longer after reset.
+            # This workaround only works on revision 0 ESP32 chips,
+            # it exploits a silicon bug spurious watchdog reset.
+            yield 0.4  # allow watchdog reset to occur
+        yield 0.05
+        self._setDTR(False)  # IO0=HIGH, done
+
+    def connect(self, mode='default_reset', deadline=None):
+        """ Try connecting repeatedly until successful, or giving up
+
+        If 'deadline' (a time.time() value) is given, no new attempt is started after it.
+        """
         print('Connecting...', end='')
         sys.stdout.flush()
         last_error = None
-        sw.connection_state[str].emit('Connecting...')
+        self.session.connection_state.emit('Connecting...')
 
         try:
             for _ in range(7):
-                if sw.continueFlag():
-                    last_error = self._connect_attempt(mode=mode, esp32r0_delay=False)
+                if self.session.continueFlag():
+                    last_error = self._connect_attempt(mode=mode, esp32r0_delay=False, deadline=deadline)
                     if last_error is None:
                         return
-                    last_error = self._connect_attempt(mode=mode, esp32r0_delay=True)
+                    if deadline is not None and time.time() > deadline:
+                        break
+                    last_error = self._connect_attempt(mode=mode, esp32r0_delay=True, deadline=deadline)
                     if last_error is None:
                         return
+                    if deadline is not None and time.time() > deadline:
+                        break
         finally:
             print('')  # end 'Connecting...' line
         raise FatalError('Failed to connect to %s: %s' % (self.CHIP_NAME, last_error))
@@ -558,8 +694,8 @@ class ESPLoader(object):
     """ Send a block of an image to RAM """
     def mem_block(self, data, seq):
         return self.check_command("write to target RAM", self.ESP_MEM_DATA,
-                                  struct.pack('<IIII', len(data), seq, 0, 0) + data,
-                                  self.checksum(data))
+                                  struct.pack('<IIII', len(data), seq, 0, 0),
+                                  self.checksum(data), payload=data)
 
     """ Leave download mode and run the application """
     def mem_finish(self, entrypoint=0):
@@ -582,36 +718,50 @@ class ESPLoader(object):
     Returns number of blocks (of size self.FLASH_WRITE_SIZE) to write.
     """
     def flash_begin(self, size, offset):
+        num_blocks, data, timeout = self._flash_begin_command(size, offset)
+        t = time.time()
+        self.check_command("enter Flash download mode", self.ESP_FLASH_BEGIN, data, timeout=timeout)
+        if size != 0 and not self.IS_STUB:
+            print("Took %.2fs to erase flash block" % (time.time() - t))
+        return num_blocks
+
+    def _flash_begin_command(self, size, offset):
+        """ (number of blocks, data, timeout) of the ESP_FLASH_BEGIN command for 'size' bytes at 'offset' """
         num_blocks = (size + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
         erase_size = self.get_erase_size(offset, size)
-
-        t = time.time()
         if self.IS_STUB:
             timeout = DEFAULT_TIMEOUT
         else:
             timeout = timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, size)  # ROM performs the erase up front
-        self.check_command("enter Flash download mode", self.ESP_FLASH_BEGIN,
-                           struct.pack('<IIII', erase_size, num_blocks, self.FLASH_WRITE_SIZE, offset),
-                           timeout=timeout)
-        if size != 0 and not self.IS_STUB:
-            print("Took %.2fs to erase flash block" % (time.time() - t))
-        return num_blocks
+        return num_blocks, struct.pack('<IIII', erase_size, num_blocks, self.FLASH_WRITE_SIZE, offset), timeout
 
     """ Write block to flash """
     def flash_block(self, data, seq, timeout=DEFAULT_TIMEOUT):
         self.check_command("write to target Flash after seq %d" % seq,
                            self.ESP_FLASH_DATA,
-                           struct.pack('<IIII', len(data), seq, 0, 0) + data,
+                           struct.pack('<IIII', len(data), seq, 0, 0),
                            self.checksum(data),
-                           timeout=timeout)
+                           timeout=timeout,
+                           payload=data)
+
+    def flash_block_timeout(self, block_size, write_size):
+        """ Timeout for the response to a data block of 'block_size' bytes making the loader
+        erase and write 'write_size' bytes of flash
+
+        The serial port takes the block before it has crossed the wire, so the time to send it
+        (escaped, in the worst case) at the current baud rate is added. A stub block of 16 KB
+        needs up to 2.8 seconds of that at 115200 baud.
+        """
+        return timeout_per_mb(ERASE_WRITE_TIMEOUT_PER_MB, write_size) + block_size * 2 * 10.0 / self._port.baudrate
 
     """ Encrypt before writing to flash """
     def flash_encrypt_block(self, data, seq, timeout=DEFAULT_TIMEOUT):
         self.check_command("Write encrypted to target Flash after seq %d" % seq,
                            self.ESP_FLASH_ENCRYPT_DATA,
-                           struct.pack('<IIII', len(data), seq, 0, 0) + data,
+                           struct.pack('<IIII', len(data), seq, 0, 0),
                            self.checksum(data),
-                           timeout=timeout)
+                           timeout=timeout,
+                           payload=data)
 
     """ Leave flash mode and run/reboot """
     def flash_finish(self, reboot=False):
@@ -645,16 +795,10 @@ class ESPLoader(object):
 
         # Upload
         print("Uploading stub...")
-        for field in ['text', 'data']:
-            if field in stub:
-                offs = stub[field + "_start"]
-                length = len(stub[field])
-                blocks = (length + self.ESP_RAM_BLOCK - 1) // self.ESP_RAM_BLOCK
-                self.mem_begin(length, blocks, self.ESP_RAM_BLOCK, offs)
-                for seq in range(blocks):
-                    from_offs = seq * self.ESP_RAM_BLOCK
-                    to_offs = from_offs + self.ESP_RAM_BLOCK
-                    self.mem_block(stub[field][from_offs:to_offs], seq)
+        for offs, length, blocks in self._stub_segments(stub):
+            self.mem_begin(length, len(blocks), self.ESP_RAM_BLOCK, offs)
+            for seq, block in enumerate(blocks):
+                self.mem_block(block, seq)
         print("Running stub...")
         self.mem_finish(stub['entry'])
 
@@ -664,36 +808,142 @@ class ESPLoader(object):
         print("Stub running...")
         return self.STUB_CLASS(self)
 
+    def _stub_segments(self, stub):
+        """ Yields (address, size, blocks) of the text and data of 'stub', cut into RAM blocks """
+        for field in ['text', 'data']:
+            if field in stub:
+                offs = stub[field + "_start"]
+                length = len(stub[field])
+                blocks = (length + self.ESP_RAM_BLOCK - 1) // self.ESP_RAM_BLOCK
+                yield offs, length, [stub[field][seq * self.ESP_RAM_BLOCK:(seq + 1) * self.ESP_RAM_BLOCK] for seq in range(blocks)]
+
     @stub_and_esp32_function_only
     def flash_defl_begin(self, size, compsize, offset):
         """ Start downloading compressed data to Flash (performs an erase)
 
+        'compsize' may be None if the data is compressed while it is sent. The stub only
+        uses the block count to tell its inflater whether more input is to come, and the
+        inflater stops at the end of the zlib stream, so the most zlib can ever produce
+        for 'size' bytes is announced then. Don't do this with the ESP32 ROM loader.
+
         Returns number of blocks (size self.FLASH_WRITE_SIZE) to write.
         """
-        num_blocks = (compsize + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
+        num_blocks, data, timeout = self._flash_defl_begin_command(size, compsize, offset)
+        t = time.time()
+        if compsize is None:
+            print("Compressing %d bytes while writing..." % size)
+        else:
+            print("Compressed %d bytes to %d..." % (size, compsize))
+        self.check_command("enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN, data, timeout=timeout)
+        if size != 0 and not self.IS_STUB:
+            # (stub erases as it writes, but ROM loaders erase on begin)
+            print("Took %.2fs to erase flash block" % (time.time() - t))
+        return num_blocks
+
+    def _flash_defl_begin_command(self, size, compsize, offset):
+        """ (number of blocks, data, timeout) of the ESP_FLASH_DEFL_BEGIN command, see flash_defl_begin() """
+        if compsize is None:
+            num_blocks = div_roundup(zlib_compress_bound(size), self.FLASH_WRITE_SIZE)
+        else:
+            num_blocks = (compsize + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
         erase_blocks = (size + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
 
-        t = time.time()
         if self.IS_STUB:
             write_size = size  # stub expects number of bytes here, manages erasing internally
             timeout = DEFAULT_TIMEOUT
         else:
             write_size = erase_blocks * self.FLASH_WRITE_SIZE  # ROM expects rounded up to erase block size
             timeout = timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, write_size)  # ROM performs the erase up front
-        print("Compressed %d bytes to %d..." % (size, compsize))
-        self.check_command("enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN,
-                           struct.pack('<IIII', write_size, num_blocks, self.FLASH_WRITE_SIZE, offset),
-                           timeout=timeout)
-        if size != 0 and not self.IS_STUB:
-            # (stub erases as it writes, but ROM loaders erase on begin)
-            print("Took %.2fs to erase flash block" % (time.time() - t))
-        return num_blocks
+        return num_blocks, struct.pack('<IIII', write_size, num_blocks, self.FLASH_WRITE_SIZE, offset), timeout
 
     """ Write block to flash, send compressed """
     @stub_and_esp32_function_only
     def flash_defl_block(self, data, seq, timeout=DEFAULT_TIMEOUT):
         self.check_command("write compressed data to flash after seq %d" % seq,
-                           self.ESP_FLASH_DEFL_DATA, struct.pack('<IIII', len(data), seq, 0, 0) + data, self.checksum(data), timeout=timeout)
+                           self.ESP_FLASH_DEFL_DATA, struct.pack('<IIII', len(data), seq, 0, 0), self.checksum(data), timeout=timeout,
+                           payload=data)
+
+    @stub_function_only
+    def flash_blocks_pipelined(self, op, blocks, window):
+        """ Send flash data blocks while keeping up to 'window' of them unacknowledged
+
+        'op' is ESP_FLASH_DATA, ESP_FLASH_DEFL_DATA or ESP_FLASH_ENCRYPT_DATA and 'blocks'
+        yields (seq, data, timeout) tuples, 'timeout' being how long the response to that
+        block may take. The window is capped to what the stub can buffer, see
+        FlashWritePipeline for what happens when a response is late or a block is rejected.
+
+        Returns the number of data bytes sent.
+        """
+        pipeline = FlashWritePipeline(op, min(window, self.FLASH_PIPELINE_MAX_WINDOW))
+
+        def collect():
+            seq, block, timeout, started, pipelined = pipeline.in_flight[0]
+            self._port.timeout = min(pipeline.deadline(self._port.baudrate), MAX_TIMEOUT)
+            try:
+                try:
+                    val, data = self._read_response(op)
+                except FatalError as e:
+                    if not pipeline.late():
+                        raise
+                    print('\nWARNING: %s while waiting for block %d, continuing in lock-step' % (e, seq))
+                    self._restart_reader()
+                    self._port.timeout = min(timeout, MAX_TIMEOUT)
+                    val, data = self._read_response(op)
+                self._check_response("write to target Flash after seq %d" % seq, val, data)
+            except FatalError as e:
+                self._record_block(op, started, len(block))
+                if not pipelined:
+                    raise
+                print('\nWARNING: %s, sending the blocks from %d on again' % (e, seq))
+                # the responses to the other blocks in flight are discarded
+                self._restart_reader()
+                self._port.timeout = pipeline.RESPONSE_TIMEOUT
+                try:
+                    for _ in range(len(pipeline.in_flight) - 1):
+                        self._read_response(op)
+                except FatalError:
+                    pass
+                self.flush_input()
+                pipeline.resend()
+                return
+            pipeline.acknowledged()
+            self._record_block(op, started, len(block), data)
+
+        saved_timeout = self._port.timeout
+        started_transfer = time.perf_counter()
+        try:
+            # blocks sent back to back, e.g. while the window fills, go out in one port write
+            with self.batch_writes():
+                for item in pipeline.schedule(blocks):
+                    if item is None:
+                        collect()
+                        continue
+                    seq, block, timeout = item
+                    self.command(op, struct.pack('<IIII', len(block), seq, 0, 0), self.checksum(block),
+                                 wait_response=False, timeout=timeout, payload=block)
+        finally:
+            self._port.timeout = saved_timeout
+        self._record_transfer(pipeline.written, started_transfer)
+        return pipeline.written
+
+    def _restart_reader(self):
+        """ Start a new slip_reader if the last one stopped, as it does after a timeout """
+        if inspect.getgeneratorstate(self._slip_reader) == inspect.GEN_CLOSED:
+            self._slip_reader = slip_reader(self._port, self.trace, self._flush_writes)
+
+    def _record_block(self, op, started, block_len, data=None):
+        """ Account a data block of 'block_len' bytes sent at 'started' without waiting for its
+        response, 'data' is the data of the response or None if there was none
+        """
+        if self._stats is not None:
+            self._stats.record(op, time.perf_counter() - started, block_len + 16, len(data) if data is not None else 0,
+                               failed=data is None)
+
+    def _record_transfer(self, written, started):
+        """ Account 'written' bytes of data blocks sent since 'started' for link_throughput() """
+        # blocks overlap on the wire, so only the transfer as a whole tells the throughput
+        self._link_bytes += written
+        self._link_time += time.perf_counter() - started
 
     """ Leave compressed flash mode and run/reboot """
     @stub_and_esp32_function_only
@@ -713,7 +963,11 @@ class ESPLoader(object):
         timeout = timeout_per_mb(MD5_TIMEOUT_PER_MB, size)
         res = self.check_command('calculate md5sum', self.ESP_SPI_FLASH_MD5, struct.pack('<IIII', addr, size, 0, 0),
                                  timeout=timeout)
+        return self._md5sum_result(res)
 
+    @staticmethod
+    def _md5sum_result(res):
+        """ The hex digest in the result of ESP_SPI_FLASH_MD5 """
         if len(res) == 32:
             return res.decode("utf-8")  # already hex formatted
         elif len(res) == 16:
@@ -732,6 +986,20 @@ class ESPLoader(object):
         time.sleep(0.05)  # get rid of crap sent during baud rate change
         self.flush_input()
 
+    @stub_function_only
+    def check_link(self, size=0x1000):
+        """ Read 'size' bytes of flash and compare them with the flash's MD5
+
+        Raises FatalError if the link doesn't work at the current baud rate, which adapters
+        and cables often only show above some rate.
+        """
+        try:
+            data = self.read_flash(0, size)
+            if hashlib.md5(data).hexdigest() != self.flash_md5sum(0, size):
+                raise FatalError('Data read does not match the flash MD5')
+        except FatalError as e:
+            raise FatalError('Serial link does not work at %d baud: %s' % (self._port.baudrate, e))
+
     @stub_function_only
     def erase_flash(self):
         # depending on flash chip model the erase may take this long (maybe longer!)
@@ -748,37 +1016,48 @@ class ESPLoader(object):
         self.check_command("erase region", self.ESP_ERASE_REGION, struct.pack('<II', offset, size), timeout=timeout)
 
     @stub_function_only
-    def read_flash(self, offset, length, progress_fn=None):
-        # issue a standard bootloader command to trigger the read
-        self.check_command("read flash", self.ESP_READ_FLASH,
-                           struct.pack('<IIII',
-                                       offset,
-                                       length,
-                                       self.FLASH_SECTOR_SIZE,
-                                       64))
-        # now we expect (length // block_size) SLIP frames with the data
-        data = b''
-        while sw.continueFlag() and len(data) < length:
-            p = self.read()
-            data += p
-            if len(data) < length and len(p) < self.FLASH_SECTOR_SIZE:
-                raise FatalError('Corrupt data, expected 0x%x bytes but received 0x%x bytes' % (self.FLASH_SECTOR_SIZE, len(p)))
-            self.write(struct.pack('<I', len(data)))
-            if progress_fn and (len(data) % 1024 == 0 or len(data) == length):
-                progress_fn(len(data), length)
+    def read_flash(self, offset, length, progress_fn=None, buffer=None, sink=None):
+        """ Read 'length' bytes of flash at 'offset', checked against the MD5 digest sent by the stub
+
+        The data is received into a preallocated bytearray, or into the writable 'buffer'
+        of at least 'length' bytes if one is given, which is returned. If 'sink' is given
+        each received chunk is passed to sink(chunk) instead, nothing is kept in memory and
+        None is returned; the chunks are only verified once read_flash() returns.
+        """
+        if sink is None:
+            if buffer is None:
+                buffer = bytearray(length)
+            elif len(buffer) < length:
+                raise FatalError('Buffer of 0x%x bytes is too small to read 0x%x bytes' % (len(buffer), length))
+            view = memoryview(buffer)
+        reader = FlashReadProtocol(offset, length, self.FLASH_SECTOR_SIZE)
+        try:
+            # issue a standard bootloader command to trigger the read
+            self.check_command("read flash", self.ESP_READ_FLASH, reader.request)
+            # now we expect (length // block_size) SLIP frames with the data. The frames
+            # which arrived in one port read are acknowledged with a single write
+            with self.batch_writes():
+                while self.session.continueFlag() and reader.received < length:
+                    p = self.read()
+                    start = reader.received
+                    ack = reader.frame(p)
+                    if sink is None:
+                        view[start:start + len(p)] = p
+                    else:
+                        sink(p)
+                    self.write(ack)
+                    if progress_fn and (reader.received % 1024 == 0 or reader.received == length):
+                        progress_fn(reader.received, length)
+        finally:
+            if sink is None:
+                view.release()
         if progress_fn:
-            progress_fn(len(data), length)
-        if len(data) > length:
-            raise FatalError('Read more than expected')
+            progress_fn(reader.received, length)
+        if self._stats is not None:
+            self._stats.entry(self.ESP_READ_FLASH)['bytes_in'] += reader.received
 
-        digest_frame = self.read()
-        if len(digest_frame) != 16:
-            raise FatalError('Expected digest, got: %s' % hexify(digest_frame))
-        expected_digest = hexify(digest_frame).upper()
-        digest = hashlib.md5(data).hexdigest().upper()
-        if digest != expected_digest:
-            raise FatalError('Digest mismatch: expected %s, got %s' % (expected_digest, digest))
-        return data
+        reader.check_digest(self.read())
+        return buffer
 
     def flash_spi_attach(self, hspi_arg):
         """Send SPI attach command to enable the SPI flash pins
@@ -981,8 +1260,13 @@ class ESPLoader(object):
         return norm_xtal
 
     def hard_reset(self):
+        for delay in self._reset_chip():
+            time.sleep(delay)
+
+    def _reset_chip(self):
+        """ Reset the chip, yields the seconds to hold it in reset """
         self._setRTS(True)  # EN->LOW
-        time.sleep(0.1)
+        yield 0.1
         self._setRTS(False)
 
     def soft_reset(self, stay_in_bootloader):
@@ -1131,6 +1415,11 @@ class ESP8266StubLoader(ESP8266ROM):
     def __init__(self, rom_loader):
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._stats = rom_loader._stats
+        self.session = rom_loader.session
+        self._slip_encoder = rom_loader._slip_encoder
+        self._link_bytes = rom_loader._link_bytes
+        self._link_time = rom_loader._link_time
         self.flush_input()  # resets _slip_reader
 
     def get_erase_size(self, offset, size):
@@ -1375,12 +1664,351 @@ class ESP32StubLoader(ESP32ROM):
     def __init__(self, rom_loader):
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._stats = rom_loader._stats
+        self.session = rom_loader.session
+        self._slip_encoder = rom_loader._slip_encoder
+        self._link_bytes = rom_loader._link_bytes
+        self._link_time = rom_loader._link_time
         self.flush_input()  # resets _slip_reader
 
 
 ESP32ROM.STUB_CLASS = ESP32StubLoader
 
 
+class AsyncESPLoader(object):
+    """ The bootloader protocol of ESPLoader as coroutines, for an asyncio event loop
+
+    Talks to the chip through an AsyncSerialTransport, so a single thread can flash
+    as many ports as its loop serves, and a transfer is stopped by cancelling its
+    task. The constants and stub code are those of 'chip' (ESP8266ROM, ESP32ROM, or
+    their STUB_CLASS once run_stub() has succeeded), which is found by detect_chip()
+    if not given. Only what flashing needs is implemented, and nothing is printed
+    as loaders for several ports share the terminal; errors raise FatalError.
+    Packing commands, matching responses, block sizes, timeouts, accounting and
+    the reset sequences are ESPLoader's, only the waiting is done differently.
+
+    Create the loader from a coroutine running on the loop.
+    """
+    def __init__(self, port, chip=None, baud=ESPLoader.ESP_ROM_BAUD, trace_enabled=False, stats=None):
+        opened = isinstance(port, basestring)
+        if opened:
+            port = serial.serial_for_url(port)
+        self._port = port
+        self._trace_enabled = trace_enabled
+        self._stats = stats
+        self._slip_encoder = SlipEncoder()
+        self.chip = chip or ESPLoader
+        try:
+            self._set_port_baudrate(baud)
+            self._transport = AsyncSerialTransport(port, self.trace)
+        except FatalError:
+            if opened:
+                port.close()
+            raise
+
+    def __getattr__(self, name):
+        # command opcodes, sizes and the stub code are those of the chip class
+        if name.isupper():
+            return getattr(self.chip, name)
+        raise AttributeError(name)
+
+    # everything but the waiting is shared with ESPLoader
+    trace = ESPLoader.trace
+    link_throughput = ESPLoader.link_throughput
+    flash_block_timeout = ESPLoader.flash_block_timeout
+    _set_port_baudrate = ESPLoader._set_port_baudrate
+    _command_packet = ESPLoader._command_packet
+    _record_command = ESPLoader._record_command
+    _match_response = ESPLoader._match_response
+    _unmatched_response = ESPLoader._unmatched_response
+    _check_response = ESPLoader._check_response
+    _setDTR = ESPLoader._setDTR
+    _setRTS = ESPLoader._setRTS
+    _reset_to_bootloader = ESPLoader._reset_to_bootloader
+    _reset_chip = ESPLoader._reset_chip
+    _stub_segments = ESPLoader._stub_segments
+    _flash_begin_command = ESPLoader._flash_begin_command
+    _flash_defl_begin_command = ESPLoader._flash_defl_begin_command
+    _record_block = ESPLoader._record_block
+    _record_transfer = ESPLoader._record_transfer
+
+    def get_erase_size(self, offset, size):
+        return self.chip.get_erase_size(self, offset, size)
+
+    async def close(self):
+        await self._transport.close()
+
+    def write(self, packet, payload=b''):
+        """ Send one SLIP frame containing 'packet' and 'payload' """
+        encoder = self._slip_encoder
+        frame = encoder.encode(packet, payload)
+        if self._trace_enabled:
+            self.trace("Write %d bytes: %s", len(frame), HexFormatter(frame))
+        encoder.flush(self._transport)
+
+    async def command(self, op=None, data=b"", chk=0, wait_response=True, timeout=DEFAULT_TIMEOUT, payload=b""):
+        """ Send a request and read the response, see ESPLoader.command() """
+        timed = op is not None and wait_response
+        if timed:
+            started = time.perf_counter()
+        response = None
+        data_len = 0
+        try:
+            if op is not None:
+                data_len = len(data) + len(payload)
+                self.write(self._command_packet(op, data, chk, payload, wait_response, timeout), payload)
+            if not wait_response:
+                return
+            response = await self._read_response(op, min(timeout, MAX_TIMEOUT))
+            return response
+        finally:
+            if timed:
+                self._record_command(op, started, data_len, response)
+
+    async def _read_response(self, op, timeout, retries=100):
+        """ Read responses until one matches 'op', returns its (val, data) """
+        for retry in range(retries):
+            response = self._match_response(op, await self._transport.read(timeout), retry)
+            if response is not None:
+                return response
+        raise self._unmatched_response(op, retries)
+
+    async def check_command(self, op_description, op=None, data=b'', chk=0, timeout=DEFAULT_TIMEOUT, payload=b''):
+        """ Execute a command, raise FatalError if it fails and return its result, see ESPLoader.check_command() """
+        val, data = await self.command(op, data, chk, timeout=timeout, payload=payload)
+        return self._check_response(op_description, val, data)
+
+    def flush_input(self):
+        self._transport.flush_input()
+
+    async def sync(self):
+        await self.command(self.ESP_SYNC, b'\x07\x07\x12\x20' + 32 * b'\x55', timeout=SYNC_TIMEOUT)
+        for i in range(7):
+            await self.command()
+
+    async def _connect_attempt(self, mode='default_reset', esp32r0_delay=False, deadline=None):
+        """ A single connection attempt, see ESPLoader._connect_attempt() """
+        last_error = None
+        if mode == "no_reset_no_sync":
+            return last_error
+
+        if mode != 'no_reset':
+            for delay in self._reset_to_bootloader(esp32r0_delay):
+                await asyncio.sleep(delay)
+
+        for _ in range(5):
+            try:
+                self.flush_input()
+                self._port.reset_output_buffer()
+                await self.sync()
+                return None
+            except FatalError as e:
+                last_error = e
+                if deadline is not None and time.time() > deadline:
+                    break
+                await asyncio.sleep(0.05)
+        return last_error
+
+    async def connect(self, mode='default_reset', deadline=None):
+        """ Reset the chip into the bootloader and sync, retrying like ESPLoader.connect() """
+        last_error = None
+        for _ in range(7):
+            for esp32r0_delay in (False, True):
+                last_error = await self._connect_attempt(mode, esp32r0_delay, deadline)
+                if last_error is None:
+                    return
+                if deadline is not None and time.time() > deadline:
+                    raise FatalError('Failed to connect to %s: %s' % (self.CHIP_NAME, last_error))
+        raise FatalError('Failed to connect to %s: %s' % (self.CHIP_NAME, last_error))
+
+    async def read_reg(self, addr):
+        """ Read memory address in target """
+        val, data = await self.command(self.ESP_READ_REG, struct.pack('<I', addr))
+        if byte(data, 0) != 0:
+            raise FatalError.WithResult("Failed to read register address %08x" % addr, data)
+        return val
+
+    async def detect_chip(self):
+        """ Set the chip class from the UART datecode register, see ESPLoader.detect_chip() """
+        date_reg = await self.read_reg(ESPLoader.UART_DATA_REG_ADDR)
+        for cls in [ESP8266ROM, ESP32ROM]:
+            if date_reg == cls.DATE_REG_VALUE:
+                self.chip = cls
+                return cls
+        raise FatalError("Unexpected UART datecode value 0x%08x. Failed to autodetect chip type." % date_reg)
+
+    async def mem_begin(self, size, blocks, blocksize, offset):
+        return await self.check_command("enter RAM download mode", self.ESP_MEM_BEGIN,
+                                        struct.pack('<IIII', size, blocks, blocksize, offset))
+
+    async def mem_block(self, data, seq):
+        return await self.check_command("write to target RAM", self.ESP_MEM_DATA,
+                                        struct.pack('<IIII', len(data), seq, 0, 0),
+                                        ESPLoader.checksum(data), payload=data)
+
+    async def mem_finish(self, entrypoint=0):
+        # the ROM may not answer before running the code, see ESPLoader.mem_finish()
+        timeout = DEFAULT_TIMEOUT if self.IS_STUB else MEM_END_ROM_TIMEOUT
+        data = struct.pack('<II', int(entrypoint == 0), entrypoint)
+        try:
+            return await self.check_command("leave RAM download mode", self.ESP_MEM_END, data=data, timeout=timeout)
+        except FatalError:
+            if self.IS_STUB:
+                raise
+
+    async def run_stub(self):
+        """ Upload and start the chip's flasher stub, the loader talks to it from then on """
+        if self.IS_STUB:
+            raise FatalError("Not possible for a stub to load another stub (memory likely to overlap.)")
+        stub = self.STUB_CODE
+        for offs, length, blocks in self._stub_segments(stub):
+            await self.mem_begin(length, len(blocks), self.ESP_RAM_BLOCK, offs)
+            for seq, block in enumerate(blocks):
+                await self.mem_block(block, seq)
+        await self.mem_finish(stub['entry'])
+
+        p = await self._transport.read(DEFAULT_TIMEOUT)
+        if p != b'OHAI':
+            raise FatalError("Failed to start stub. Unexpected response: %s" % p)
+        self.chip = self.STUB_CLASS
+        self.flush_input()
+
+    async def change_baud(self, baud):
+        if not self.IS_STUB and self.chip is not ESP32ROM:
+            raise NotImplementedInROMError(self, self.change_baud)
+        second_arg = self._port.baudrate if self.IS_STUB else 0
+        await self.command(self.ESP_CHANGE_BAUDRATE, struct.pack('<II', baud, second_arg))
+        self._set_port_baudrate(baud)
+        await asyncio.sleep(0.05)  # get rid of crap sent during baud rate change
+        self.flush_input()
+
+    async def flash_begin(self, size, offset):
+        """ Start downloading to Flash, returns the number of blocks to write """
+        num_blocks, data, timeout = self._flash_begin_command(size, offset)
+        await self.check_command("enter Flash download mode", self.ESP_FLASH_BEGIN, data, timeout=timeout)
+        return num_blocks
+
+    async def flash_defl_begin(self, size, compsize, offset):
+        """ Start downloading 'compsize' bytes of compressed data to Flash, returns the number of blocks to write """
+        if not self.IS_STUB and self.chip is not ESP32ROM:
+            raise NotImplementedInROMError(self, self.flash_defl_begin)
+        num_blocks, data, timeout = self._flash_defl_begin_command(size, compsize, offset)
+        await self.check_command("enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN, data, timeout=timeout)
+        return num_blocks
+
+    async def flash_blocks(self, op, blocks, window=ESPLoader.FLASH_PIPELINE_MAX_WINDOW):
+        """ Send flash data blocks, see ESPLoader.flash_blocks_pipelined()
+
+        'blocks' yields (seq, data, timeout) tuples. Up to 'window' blocks are left
+        unacknowledged if the stub is running, the ROM loader gets them in lock-step.
+        Returns the number of data bytes sent.
+        """
+        pipeline = FlashWritePipeline(op, min(window, self.FLASH_PIPELINE_MAX_WINDOW) if self.IS_STUB else 1)
+
+        async def collect():
+            seq, block, timeout, started, pipelined = pipeline.in_flight[0]
+            try:
+                try:
+                    val, data = await self._read_response(op, min(pipeline.deadline(self._port.baudrate), MAX_TIMEOUT))
+                except FatalError as e:
+                    if not pipeline.late():
+                        raise
+                    self.trace("%s while waiting for block %d, continuing in lock-step", e, seq)
+                    val, data = await self._read_response(op, min(timeout, MAX_TIMEOUT))
+                self._check_response("write to target Flash after seq %d" % seq, val, data)
+            except FatalError as e:
+                self._record_block(op, started, len(block))
+                if not pipelined:
+                    raise
+                self.trace("%s, sending the blocks from %d on again", e, seq)
+                # the responses to the other blocks in flight are discarded
+                try:
+                    for _ in range(len(pipeline.in_flight) - 1):
+                        await self._read_response(op, pipeline.RESPONSE_TIMEOUT)
+                except FatalError:
+                    pass
+                self.flush_input()
+                pipeline.resend()
+                return
+            pipeline.acknowledged()
+            self._record_block(op, started, len(block), data)
+
+        started_transfer = time.perf_counter()
+        for item in pipeline.schedule(blocks):
+            if item is None:
+                await collect()
+                continue
+            seq, block, timeout = item
+            await self.command(op, struct.pack('<IIII', len(block), seq, 0, 0), ESPLoader.checksum(block),
+                               wait_response=False, payload=block)
+        self._record_transfer(pipeline.written, started_transfer)
+        return pipeline.written
+
+    async def flash_defl_finish(self, reboot=False):
+        if not reboot and not self.IS_STUB:
+            return  # the ROM loader would exit, see ESPLoader.flash_defl_finish()
+        await self.check_command("leave compressed flash mode", self.ESP_FLASH_DEFL_END, struct.pack('<I', int(not reboot)))
+
+    async def flash_md5sum(self, addr, size):
+        res = await self.check_command('calculate md5sum', self.ESP_SPI_FLASH_MD5, struct.pack('<IIII', addr, size, 0, 0),
+                                       timeout=timeout_per_mb(MD5_TIMEOUT_PER_MB, size))
+        return ESPLoader._md5sum_result(res)
+
+    async def read_flash(self, offset, length, progress_fn=None):
+        """ Read 'length' bytes of flash at 'offset' with the stub, checked against its MD5 digest """
+        if not self.IS_STUB:
+            raise NotImplementedInROMError(self, self.read_flash)
+        buffer = bytearray(length)
+        reader = FlashReadProtocol(offset, length, self.FLASH_SECTOR_SIZE)
+        await self.check_command("read flash", self.ESP_READ_FLASH, reader.request)
+        while reader.received < length:
+            p = await self._transport.read(DEFAULT_TIMEOUT)
+            start = reader.received
+            ack = reader.frame(p)
+            buffer[start:start + len(p)] = p
+            self.write(ack)
+            if progress_fn:
+                progress_fn(reader.received, length)
+        if self._stats is not None:
+            self._stats.entry(self.ESP_READ_FLASH)['bytes_in'] += reader.received
+
+        reader.check_digest(await self._transport.read(DEFAULT_TIMEOUT))
+        return bytes(buffer)
+
+    async def write_flash(self, address, image, compressed=None, progress_fn=None):
+        """ Write 'image' compressed to flash at 'address' and check the flash MD5
+
+        'compressed' is the zlib stream of 'image' if the caller has it already, e.g.
+        because the image is written to several chips. 'progress_fn' is called with the
+        number of bytes of 'image' written so far. Returns the number of bytes sent.
+        """
+        if compressed is None:
+            compressed = zlib.compress(image, 9)
+        blocks = await self.flash_defl_begin(len(image), len(compressed), address)
+        ratio = len(image) / len(compressed)
+
+        def data_blocks():
+            for seq, block in enumerate(iter_blocks(compressed, self.FLASH_WRITE_SIZE)):
+                if progress_fn:
+                    progress_fn(len(image) * (seq + 1) // blocks)
+                # a compressed block inflates to about 'ratio' times its size, more for runs of 0xFF
+                yield seq, block, self.flash_block_timeout(len(block), len(block) * ratio * 2)
+
+        written = await self.flash_blocks(self.ESP_FLASH_DEFL_DATA, data_blocks())
+        res = await self.flash_md5sum(address, len(image))
+        if res != hashlib.md5(image).hexdigest():
+            raise FatalError("MD5 of file does not match data in flash!")
+        if self.IS_STUB:
+            # leave flash mode without running the application, like write_flash()
+            await self.flash_begin(0, 0)
+            await self.flash_defl_finish(False)
+        return written
+
+    async def hard_reset(self):
+        for delay in self._reset_chip():
+            await asyncio.sleep(delay)
+
+
 class ESPBOOTLOADER(object):
     """ These are constants related to software ESP bootloader, working with 'v2' image files """
 
@@ -2051,52 +2679,448 @@ class ELFFile(object):
         return sha256.digest()
 
 
-def slip_reader(port, trace_function):
+def slip_reader(port, trace_function, before_read=None):
     """Generator to read SLIP packets from a serial port.
     Yields one full SLIP packet at a time, raises exception on timeout or invalid data.
 
     Designed to avoid too many calls to serial.read(1), which can bog
-    down on slow systems.
+    down on slow systems. The packets are decoded by a SlipDecoder.
+
+    before_read() is called whenever every packet received so far has been
+    yielded and the port has to be read again.
     """
-    partial_packet = None
-    in_escape = False
+    decoder = SlipDecoder(trace_function)
     while True:
+        if before_read is not None:
+            before_read()
         waiting = port.inWaiting()
         read_bytes = port.read(1 if waiting == 0 else waiting)
         if read_bytes == b'':
-            waiting_for = "header" if partial_packet is None else "content"
+            waiting_for = "content" if decoder.in_packet() else "header"
             trace_function("Timed out waiting for packet %s", waiting_for)
             raise FatalError("Timed out waiting for packet %s" % waiting_for)
         trace_function("Read %d bytes: %s", len(read_bytes), HexFormatter(read_bytes))
-        for b in read_bytes:
-            if type(b) is int:
-                b = bytes([b])  # python 2/3 compat
+        try:
+            for packet in decoder.feed(read_bytes):
+                yield packet
+        except FatalError:
+            trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
+            raise
+
 
+class SlipDecoder(object):
+    """ Incremental SLIP decoder, fed with whatever bytes the serial port delivered
+
+    Received data is split on the 0xC0 frame delimiters and collected
+    still-escaped in a bytearray, so the per-byte work happens in C
+    (find/replace) rather than in a Python loop. Escape sequences are
+    validated as data arrives, the packet is un-escaped once complete.
+    Once feed() has raised FatalError the decoder must not be used again.
+    """
+    def __init__(self, trace_function):
+        self._trace = trace_function
+        self._partial_packet = None  # escaped content of the current packet, None while waiting for a header
+        self._checked = 0  # offset in _partial_packet up to which escape sequences have been validated
+
+    def in_packet(self):
+        """ True if a packet has started but hasn't been completed yet """
+        return self._partial_packet is not None
+
+    def _invalid_data(self, read_bytes, message):
+        self._trace("Read invalid data: %s", HexFormatter(read_bytes))
+        raise FatalError(message)
+
+    def feed(self, read_bytes):
+        """ Generator yielding every packet completed by 'read_bytes' """
+        read_view = memoryview(read_bytes)
+        partial_packet = self._partial_packet
+        pos = 0
+        while pos < len(read_bytes):
             if partial_packet is None:  # waiting for packet header
-                if b == b'\xc0':
-                    partial_packet = b""
-                else:
-                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
-                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
-                    raise FatalError('Invalid head of packet (0x%s)' % hexify(b))
-            elif in_escape:  # part-way through escape sequence
-                in_escape = False
-                if b == b'\xdc':
-                    partial_packet += b'\xc0'
-                elif b == b'\xdd':
-                    partial_packet += b'\xdb'
-                else:
-                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
-                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
-                    raise FatalError('Invalid SLIP escape (0xdb, 0x%s)' % (hexify(b)))
-            elif b == b'\xdb':  # start of escape sequence
-                in_escape = True
-            elif b == b'\xc0':  # end of packet
-                trace_function("Received full packet: %s", HexFormatter(partial_packet))
-                yield partial_packet
-                partial_packet = None
-            else:  # normal byte in packet
-                partial_packet += b
+                if read_bytes[pos] != 0xc0:
+                    self._invalid_data(read_bytes, 'Invalid head of packet (0x%s)' % hexify(read_bytes[pos:pos + 1]))
+                partial_packet = self._partial_packet = bytearray()
+                self._checked = 0
+                pos += 1
+                continue
+
+            end = read_bytes.find(b'\xc0', pos)
+            partial_packet += read_view[pos:len(read_bytes) if end < 0 else end]
+
+            # every 0xdb must be followed by 0xdc or 0xdd, a trailing 0xdb is checked once more data arrives
+            esc = partial_packet.find(b'\xdb', self._checked)
+            while esc != -1 and esc + 1 < len(partial_packet):
+                if partial_packet[esc + 1] not in (0xdc, 0xdd):
+                    self._invalid_data(read_bytes, 'Invalid SLIP escape (0xdb, 0x%s)' % hexify(partial_packet[esc + 1:esc + 2]))
+                esc = partial_packet.find(b'\xdb', esc + 2)
+            self._checked = len(partial_packet) if esc == -1 else esc
+
+            if end < 0:
+                break  # packet continues in the next read
+            if esc != -1:  # escape byte immediately followed by the end of packet
+                self._invalid_data(read_bytes, 'Invalid SLIP escape (0xdb, 0xC0)')
+
+            if partial_packet.find(b'\xdb') != -1:
+                packet = bytes(partial_packet.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb'))
+            else:
+                packet = bytes(partial_packet)
+            self._trace("Received full packet: %s", HexFormatter(packet))
+            partial_packet = self._partial_packet = None
+            pos = end + 1
+            yield packet
+
+
+class SlipEncoder(object):
+    """ SLIP encoder collecting frames to be written to a serial port.
+
+    A frame is escaped with two bytes.replace() calls over the command header
+    and its data, an order of magnitude faster than escaping in a Python loop.
+    Frames are kept as bytes: pyserial copies any other buffer type (bytearray,
+    memoryview) before writing it, so building them in a reusable bytearray
+    only adds a copy.
+
+    While 'batching' is non-zero the caller lets several frames accumulate
+    and sends them with a single flush() (see ESPLoader.batch_writes).
+    """
+    FLUSH_THRESHOLD = 0x10000  # flush a batch early once this many bytes are pending
+
+    def __init__(self):
+        self._frames = []
+        self._len = 0
+        self.batching = 0
+
+    def pending(self):
+        """ Number of encoded bytes waiting to be flushed """
+        return self._len
+
+    def encode(self, packet, payload=b''):
+        """ Queue one frame containing 'packet' followed by 'payload' and return it """
+        frame = b'\xc0' + (packet + payload).replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+        self._frames.append(frame)
+        self._len += len(frame)
+        return frame
+
+    def flush(self, port):
+        """ Write all pending frames to 'port' in one call """
+        if self._frames:
+            frames = self._frames
+            self._frames = []
+            self._len = 0
+            port.write(frames[0] if len(frames) == 1 else b''.join(frames))
+
+
+class AsyncSerialTransport(object):
+    """ SLIP packets over a serial port driven by an asyncio event loop
+
+    The port's file descriptor is switched to non-blocking mode and watched with
+    loop.add_reader(), received data is decoded by a SlipDecoder as it arrives, so
+    any number of ports are served by the one thread running the loop. 'port' is an
+    open pyserial port with a file descriptor (a POSIX serial port or a socket://
+    URL); Windows ports and RFC 2217 connections can't be used. Create the transport
+    from a coroutine running on the loop.
+    """
+    def __init__(self, port, trace_function):
+        try:
+            self._fd = port.fileno()
+        except (AttributeError, NotImplementedError):
+            raise FatalError('Serial port %s has no file descriptor to watch from an event loop' % port.port)
+        self.port = port
+        self._trace = trace_function
+        self._loop = asyncio.get_event_loop()
+        self._packets = collections.deque()
+        self._error = None  # decoding error, raised by read() once the packets before it are consumed
+        self._port_error = None  # the port failed or was closed, raised by read() from then on
+        self._waiter = None
+        self._out = bytearray()
+        self._decoder = SlipDecoder(trace_function)
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _on_readable(self):
+        try:
+            read_bytes = os.read(self._fd, 0x10000)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            read_bytes = None
+            self._port_error = FatalError('Reading from the serial port failed: %s' % e)
+        if not read_bytes:
+            if self._port_error is None:
+                self._port_error = FatalError('Serial port was closed')
+            self._loop.remove_reader(self._fd)
+        elif self._decoder is not None:
+            self._trace("Read %d bytes: %s", len(read_bytes), HexFormatter(read_bytes))
+            try:
+                self._packets.extend(self._decoder.feed(read_bytes))
+            except FatalError as e:
+                # like a failed slip_reader, nothing more is decoded until flush_input()
+                self._decoder = None
+                self._error = e
+        self._wake()
+
+    def _time_out(self, waiter):
+        if not waiter.done():
+            waiting_for = "content" if self._decoder is not None and self._decoder.in_packet() else "header"
+            self._trace("Timed out waiting for packet %s", waiting_for)
+            waiter.set_exception(FatalError("Timed out waiting for packet %s" % waiting_for))
+
+    async def read(self, timeout):
+        """ Return the next SLIP packet, waiting 'timeout' seconds at most """
+        if not self._packets and self._error is None and self._port_error is None:
+            waiter = self._waiter = self._loop.create_future()
+            timer = self._loop.call_later(timeout, self._time_out, waiter)
+            try:
+                await waiter
+            finally:
+                timer.cancel()
+                self._waiter = None
+        if self._packets:
+            return self._packets.popleft()
+        raise self._error or self._port_error
+
+    def write(self, data):
+        """ Send 'data' without blocking, what the port doesn't take yet is sent once it is writable """
+        if not self._out:
+            try:
+                written = os.write(self._fd, data)
+            except BlockingIOError:
+                written = 0
+            if written == len(data):
+                return
+            self._loop.add_writer(self._fd, self._on_writable)
+            data = memoryview(data)[written:]
+        self._out += data
+
+    def _on_writable(self):
+        try:
+            written = os.write(self._fd, self._out)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._out.clear()
+            self._loop.remove_writer(self._fd)
+            self._port_error = FatalError('Writing to the serial port failed: %s' % e)
+            self._wake()
+            return
+        del self._out[:written]
+        if not self._out:
+            self._loop.remove_writer(self._fd)
+
+    def flush_input(self):
+        """ Discard received data and packets, and any decoding error """
+        self.port.reset_input_buffer()
+        self._packets.clear()
+        self._error = None
+        self._decoder = SlipDecoder(self._trace)
+
+    async def close(self):
+        """ Stop watching the port and close it, closing may block (e.g. until the output is drained) so
+        it is done in the loop's default executor """
+        self._loop.remove_reader(self._fd)
+        if self._out:
+            self._loop.remove_writer(self._fd)
+        self._port_error = FatalError('Serial port was closed')
+        self._wake()
+        await self._loop.run_in_executor(None, self.port.close)
+
+
+class FlashWritePipeline(object):
+    """ The host's side of flash data blocks sent without waiting for every response
+
+    Up to 'window' blocks are in flight. The stub answers commands in order, so every
+    response belongs to the oldest block in flight, and it's expected within deadline().
+    A response which is later than that makes the rest of the transfer fall back to
+    lock-step (late()), the response itself is still waited for up to the block's own
+    timeout. If the block isn't acknowledged even then or the stub rejects it, the blocks
+    from the oldest unacknowledged one on are sent again in lock-step (resend()).
+
+    schedule() yields the blocks to send and None whenever the response to the oldest
+    block in flight is to be read, which ends with acknowledged() or resend().
+    """
+    # seconds the stub may take to answer a block once all the blocks in flight are across the wire
+    RESPONSE_TIMEOUT = 1.0
+
+    def __init__(self, op, window):
+        self.op = op
+        self.window = max(1, window)
+        self.in_flight = collections.deque()  # (seq, data, timeout, started, sent while pipelined)
+        self.written = 0
+        self._resend = collections.deque()
+
+    def schedule(self, blocks):
+        """ Yields the (seq, data, timeout) of every block of 'blocks' to send, or None to read a response """
+        blocks = iter(blocks)
+        while True:
+            if len(self.in_flight) >= self.window:
+                yield None
+                continue
+            if self._resend:
+                seq, block, timeout = self._resend.popleft()
+            else:
+                item = next(blocks, None)
+                if item is None:
+                    if not self.in_flight:
+                        return
+                    yield None
+                    continue
+                seq, block, timeout = item
+                self.written += len(block)
+            self.in_flight.append((seq, block, timeout, time.perf_counter(), self.window > 1))
+            yield seq, block, timeout
+
+    def deadline(self, baudrate):
+        """ Seconds to wait for the response to the oldest block in flight """
+        timeout = self.in_flight[0][2]
+        if self.window == 1:
+            return timeout
+        wire_time = sum(len(block) + 16 for _, block, _, _, _ in self.in_flight) * 10.0 / baudrate
+        return min(timeout, wire_time + self.RESPONSE_TIMEOUT)
+
+    def late(self):
+        """ The response to the oldest block missed deadline(), True if it is to be waited for
+        the rest of the block's timeout in lock-step, False if the transfer already is in lock-step
+        """
+        if self.window == 1:
+            return False
+        self.window = 1
+        return True
+
+    def acknowledged(self):
+        """ The oldest block in flight got its response """
+        self.in_flight.popleft()
+
+    def resend(self):
+        """ The oldest block in flight, which was sent while others were in flight, failed. It and
+        the blocks after it are sent again in lock-step, once the responses to them have been discarded
+        """
+        self.window = 1
+        self._resend.extendleft((seq, block, timeout) for seq, block, timeout, _, _ in reversed(self.in_flight))
+        self.in_flight.clear()
+
+
+class FlashReadProtocol(object):
+    """ The host's side of ESP_READ_FLASH, whichever way the frames are waited for
+
+    The stub sends the 'length' bytes at 'offset' in frames of 'sector_size' bytes,
+    keeping up to MAX_UNACKED of them unacknowledged, and then the MD5 digest of the
+    data in a frame of its own. frame() checks a data frame and returns the
+    acknowledgement to send for it, check_digest() checks the digest frame.
+    """
+    MAX_UNACKED = 64
+
+    def __init__(self, offset, length, sector_size):
+        self.length = length
+        self.sector_size = sector_size
+        self.received = 0
+        self.request = struct.pack('<IIII', offset, length, sector_size, self.MAX_UNACKED)
+        self._md5 = hashlib.md5()
+
+    def frame(self, p):
+        """ Account the data frame 'p', returns the packet acknowledging it """
+        if self.received + len(p) > self.length:
+            raise FatalError('Read more than expected')
+        self._md5.update(p)
+        self.received += len(p)
+        if self.received < self.length and len(p) < self.sector_size:
+            raise FatalError('Corrupt data, expected 0x%x bytes but received 0x%x bytes' % (self.sector_size, len(p)))
+        return struct.pack('<I', self.received)
+
+    def check_digest(self, digest_frame):
+        """ Raise FatalError unless 'digest_frame' is the MD5 digest of the frames received """
+        if len(digest_frame) != 16:
+            raise FatalError('Expected digest, got: %s' % hexify(digest_frame))
+        expected_digest = hexify(digest_frame).upper()
+        digest = self._md5.hexdigest().upper()
+        if digest != expected_digest:
+            raise FatalError('Digest mismatch: expected %s, got %s' % (expected_digest, digest))
+
+
+class CommandStats(object):
+    """ Per-opcode counters and latency histograms for ESPLoader.command()
+
+    For every opcode this counts commands, failed commands (timeouts, bad
+    responses), unrelated responses skipped while waiting for the matching
+    one ('retries') and bytes sent/received, and sorts the time between
+    sending a command and reading its response into HISTOGRAM_BUCKETS.
+
+    One instance can be shared by several loaders (ROM and stub) and several
+    esptool runs, see the 'stats' argument of main().
+    """
+    # upper bounds of the latency histogram buckets, in milliseconds
+    HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+    OP_NAMES = dict((getattr(ESPLoader, name), name) for name in (
+        'ESP_FLASH_BEGIN', 'ESP_FLASH_DATA', 'ESP_FLASH_END', 'ESP_MEM_BEGIN', 'ESP_MEM_END', 'ESP_MEM_DATA',
+        'ESP_SYNC', 'ESP_WRITE_REG', 'ESP_READ_REG', 'ESP_SPI_SET_PARAMS', 'ESP_SPI_ATTACH', 'ESP_CHANGE_BAUDRATE',
+        'ESP_FLASH_DEFL_BEGIN', 'ESP_FLASH_DEFL_DATA', 'ESP_FLASH_DEFL_END', 'ESP_SPI_FLASH_MD5',
+        'ESP_ERASE_FLASH', 'ESP_ERASE_REGION', 'ESP_READ_FLASH', 'ESP_RUN_USER_CODE', 'ESP_FLASH_ENCRYPT_DATA'))
+
+    def __init__(self):
+        self.ops = {}
+
+    def entry(self, op):
+        """ Counters of opcode 'op', created on first use """
+        try:
+            return self.ops[op]
+        except KeyError:
+            entry = self.ops[op] = {
+                'count': 0,
+                'failed': 0,
+                'retries': 0,
+                'bytes_out': 0,
+                'bytes_in': 0,
+                'total_s': 0.0,
+                'max_ms': 0.0,
+                'histogram': [0] * len(self.HISTOGRAM_BUCKETS),
+            }
+            return entry
+
+    def record(self, op, elapsed, bytes_out=0, bytes_in=0, failed=False):
+        """ Account one command of opcode 'op' which took 'elapsed' seconds """
+        entry = self.entry(op)
+        entry['count'] += 1
+        if failed:
+            entry['failed'] += 1
+        entry['bytes_out'] += bytes_out
+        entry['bytes_in'] += bytes_in
+        entry['total_s'] += elapsed
+        elapsed_ms = elapsed * 1000
+        if elapsed_ms > entry['max_ms']:
+            entry['max_ms'] = elapsed_ms
+        entry['histogram'][bisect.bisect_left(self.HISTOGRAM_BUCKETS, elapsed_ms)] += 1
+
+    def as_dict(self):
+        """ JSON serializable summary, keyed by command name """
+        result = {}
+        for op, entry in sorted(self.ops.items()):
+            name = self.OP_NAMES.get(op, '0x%02x' % op)
+            count = entry['count']
+            result[name] = {
+                'op': op,
+                'count': count,
+                'failed': entry['failed'],
+                'retries': entry['retries'],
+                'bytes_out': entry['bytes_out'],
+                'bytes_in': entry['bytes_in'],
+                'total_s': round(entry['total_s'], 6),
+                'mean_ms': round(entry['total_s'] * 1000 / count, 3) if count else 0.0,
+                'max_ms': round(entry['max_ms'], 3),
+                'histogram_ms': dict(('<=%g' % bound, n) for bound, n in zip(self.HISTOGRAM_BUCKETS, entry['histogram']) if n),
+            }
+        return result
+
+    def dump(self, filename):
+        """ Write the summary as JSON to 'filename', '-' for stdout """
+        text = json.dumps(self.as_dict(), indent=2)
+        if filename == '-':
+            print(text)
+        else:
+            with open(filename, 'w') as f:
+                f.write(text + '\n')
 
 
 def arg_auto_int(x):
@@ -2180,6 +3204,478 @@ def pad_to(data, alignment, pad_character=b'\xFF'):
     return data
 
 
+def fsync_directory(path):
+    """ Flush the directory entries of 'path' to disk, so a file renamed into it survives a power loss """
+    if os.name == 'nt':
+        return  # directories can't be opened, NTFS journals renames anyway
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def iter_blocks(data, block_size, pad_character=None):
+    """ Yield consecutive 'block_size' blocks of 'data' as memoryviews, without copying the data
+
+    If 'pad_character' is given, a short last block is padded to a full block with it.
+    """
+    view = memoryview(data)
+    for offset in range(0, len(view), block_size):
+        block = view[offset:offset + block_size]
+        if pad_character is not None and len(block) < block_size:
+            block = bytes(block) + pad_character * (block_size - len(block))
+        yield block
+
+
+def zlib_compress_bound(size):
+    """ Upper bound of the zlib compressed size of 'size' bytes, as compressBound() in zlib """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def choose_compress_level(data, link_rate, overlapped, sample_size=0x10000):
+    """ Pick the zlib level that minimises the time to compress and send 'data'
+
+    Every level is timed on the first 'sample_size' bytes, which gives its throughput and
+    compression ratio. From those and 'link_rate' (bytes per second) the time for all of
+    'data' is projected: compressing and sending add up, or if 'overlapped' (compression
+    runs while sending, see BlockCompressor) the slower of both determines it.
+
+    Returns (level, projections), projections maps each level to (ratio, seconds). Empty
+    'data' gets level 9, the default of write_flash --compress-level.
+    """
+    sample = bytes(data[:sample_size])
+    if not sample:
+        return 9, {9: (1.0, 0.0)}
+    projections = {}
+    for level in range(1, 10):
+        t = time.perf_counter()
+        compressed = zlib.compress(sample, level)
+        elapsed = max(time.perf_counter() - t, 1e-6)
+        ratio = len(sample) / len(compressed)
+        compress_time = len(data) * elapsed / len(sample)
+        send_time = len(data) / ratio / link_rate
+        total = max(compress_time, send_time) if overlapped else compress_time + send_time
+        projections[level] = (ratio, total)
+    level = min(projections, key=lambda level: projections[level][1])
+    return level, projections
+
+
+class BlockCompressor(object):
+    """ Compresses data with zlib in a background thread and hands out the stream in blocks
+
+    Iterating yields (block, uncompressed_size) tuples as soon as the compressor has
+    produced a full 'block_size' block of the stream (the last one may be shorter), where
+    'uncompressed_size' is the amount of data the block inflates to. At most 'max_queued'
+    blocks are kept ready, so compression runs just ahead of the consumer, which doesn't
+    have to wait for the whole image to be compressed before sending the first block.
+    zlib releases the GIL while it works, so both really run at the same time.
+
+    Leaving the iteration early stops the thread.
+    """
+    CHUNK_SIZE = 0x8000  # input fed to the compressor at a time
+
+    def __init__(self, data, level, block_size, max_queued=8):
+        self.data = data
+        self.level = level
+        self.block_size = block_size
+        self.max_queued = max_queued
+
+    def __iter__(self):
+        blocks = queue.Queue(self.max_queued)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._compress, args=(blocks, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = blocks.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def _compress(self, blocks, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            compressor = zlib.compressobj(self.level)
+            inflater = zlib.decompressobj()
+            pending = bytearray()
+            for chunk in iter_blocks(self.data, self.CHUNK_SIZE):
+                pending += compressor.compress(chunk)
+                full = len(pending) - len(pending) % self.block_size
+                for start in range(0, full, self.block_size):
+                    block = bytes(pending[start:start + self.block_size])
+                    if not put((block, len(inflater.decompress(block)))):
+                        return
+                del pending[:full]
+            pending += compressor.flush()
+            for start in range(0, len(pending), self.block_size):
+                block = bytes(pending[start:start + self.block_size])
+                if not put((block, len(inflater.decompress(block)))):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
+
+
+class SectorHashCache(object):
+    """ Local record of the MD5 of the flash sectors last written or read, per device
+
+    Devices are identified by their MAC address and detected flash size. For every sector
+    the number of bytes known (a written image may end inside its last sector) and their
+    MD5 are kept in a JSON file, so a differential write_flash can be planned without
+    asking the stub to hash the flash sector by sector. The MD5 of every region written
+    or read as a whole is kept too: before a plan from the cache is used, the flash is
+    hashed region by region (see changed_ranges()), and a device whose flash turned out
+    to differ is forgotten.
+    """
+    VERSION = 2
+    _save_lock = threading.Lock()  # instances in several threads may share the file
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.devices = {}
+        self._changed = set()  # devices whose entry save() writes back
+        try:
+            with open(filename) as f:
+                content = json.load(f)
+            if content.get('version') == self.VERSION:
+                self.devices = dict(content['devices'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass  # missing or unreadable, start with an empty cache
+
+    @staticmethod
+    def device_key(esp):
+        mac = ''.join('%02x' % x for x in esp.read_mac())
+        flash_size = DETECTED_FLASH_SIZES.get((esp.flash_id() >> 16) & 0xff, 'unknown')
+        return '%s/%s' % (mac, flash_size)
+
+    def changed_ranges(self, device, address, image):
+        """ Like _changed_ranges(), but from the cache
+
+        Returns (ranges, regions), 'regions' being the (address, length, md5) of the regions
+        recorded which cover 'image', the flash must match all of them for 'ranges' to hold.
+        Returns None if the cache doesn't know every sector 'image' covers at 'address'.
+        """
+        sector_size = ESPLoader.FLASH_SECTOR_SIZE
+        entry = self.devices.get(device)
+        if entry is None or address % sector_size:
+            return None
+        sectors = entry['sectors']
+        regions = []
+        covered = address
+        for start, (length, md5) in sorted((int(key, 16), region) for key, region in entry['regions'].items()):
+            if start < address + len(image) and start + length > address:
+                if start > covered:
+                    return None  # a gap, what the flash holds there can't be checked
+                regions.append((start, length, md5))
+                covered = start + length
+        if covered < address + len(image):
+            return None
+        ranges = []
+        for sector in range(0, len(image), sector_size):
+            sector_end = min(sector + sector_size, len(image))
+            known = sectors.get('%x' % (address + sector))
+            if known is None:
+                return None
+            if known == [sector_end - sector, hashlib.md5(image[sector:sector_end]).hexdigest()]:
+                continue
+            if ranges and sum(ranges[-1]) == sector:
+                ranges[-1] = (ranges[-1][0], sector_end - ranges[-1][0])
+            else:
+                ranges.append((sector, sector_end - sector))
+        return ranges, regions
+
+    def update(self, device, address, data):
+        """ Record that the flash at 'address' now holds 'data' """
+        self.update_chunks(device, address, [data])
+
+    def update_chunks(self, device, address, chunks):
+        """ Record that the flash at 'address' now holds the data of 'chunks', which are all
+        a multiple of FLASH_SECTOR_SIZE long but the last one
+        """
+        sector_size = ESPLoader.FLASH_SECTOR_SIZE
+        if address % sector_size:
+            self.discard(device, address, sum(len(chunk) for chunk in chunks))
+            return
+        entry = self.devices.setdefault(device, {'sectors': {}, 'regions': {}})
+        self._changed.add(device)
+        sectors = entry['sectors']
+        md5 = hashlib.md5()
+        length = 0
+        for chunk in chunks:
+            md5.update(chunk)
+            for sector in range(0, len(chunk), sector_size):
+                content = chunk[sector:sector + sector_size]
+                sectors['%x' % (address + length + sector)] = [len(content), hashlib.md5(content).hexdigest()]
+            length += len(chunk)
+        self._discard_regions(entry, address, length)
+        entry['regions']['%x' % address] = [length, md5.hexdigest()]
+
+    def discard(self, device, address, length):
+        """ Forget the sectors overlapping 'length' bytes at 'address' """
+        entry = self.devices.get(device)
+        if entry is None:
+            return
+        self._changed.add(device)
+        sector_size = ESPLoader.FLASH_SECTOR_SIZE
+        start = address - address % sector_size
+        for sector in range(start, address + length, sector_size):
+            entry['sectors'].pop('%x' % sector, None)
+        self._discard_regions(entry, address, length)
+
+    @staticmethod
+    def _discard_regions(entry, address, length):
+        """ Forget the regions of the device 'entry' overlapping 'length' bytes at 'address' """
+        regions = entry['regions']
+        for key, (region_length, _) in list(regions.items()):
+            if int(key, 16) < address + length and int(key, 16) + region_length > address:
+                del regions[key]
+
+    def invalidate(self, device):
+        """ Forget everything about 'device' """
+        self.devices.pop(device, None)
+        self._changed.add(device)
+
+    def save(self):
+        """ Write the entries of the devices changed here into the file, keeping the other
+        devices as they are in the file now, so flashing several devices at once doesn't
+        lose what the others saved meanwhile
+        """
+        with self._save_lock:
+            devices = SectorHashCache(self.filename).devices
+            for device in self._changed:
+                if device in self.devices:
+                    devices[device] = self.devices[device]
+                else:
+                    devices.pop(device, None)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.filename)),
+                                             prefix='.', suffix='.part', delete=False) as f:
+                try:
+                    json.dump({'version': self.VERSION, 'devices': devices}, f, sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())
+                except BaseException:
+                    f.close()
+                    os.remove(f.name)
+                    raise
+            os.replace(f.name, self.filename)
+
+
+class FlashDiff(object):
+    """ Compares data read back from flash with the image it should hold, chunk by chunk
+
+    Chunks of CHUNK_SIZE bytes which are equal are passed over with one bytes comparison.
+    In the others the differing bytes are found by XOR, translate() and find(), all done
+    in C. Differences less than MERGE_GAP equal bytes apart are merged into one range.
+
+    Only the first PRINT_LIMIT ranges and some counters are kept, every range is written
+    to 'diff_file' (a text file, optional) as a line of JSON as soon as it is complete,
+    so memory use doesn't depend on how much differs.
+    """
+    CHUNK_SIZE = 0x100
+    MERGE_GAP = 16
+    PRINT_LIMIT = 32
+
+    # maps equal bytes (XOR result 0) to 0 and differing ones to 1
+    MASK_TABLE = b'\x00' + b'\x01' * 255
+
+    def __init__(self, image, address, filename, diff_file=None):
+        self.image = memoryview(image)
+        self.address = address
+        self.filename = filename
+        self.diff_file = diff_file
+        self.ranges = []  # the first PRINT_LIMIT (offset, length, differing) ranges
+        self.range_count = 0
+        self.differing = 0
+        self.compared = 0
+        self.dirty_chunks = 0
+        self.largest = 0
+        self._current = None  # [offset, end, differing] of the range still growing
+
+    def feed(self, offset, data):
+        """ Compare 'data' read from flash with the image at 'offset' """
+        data = memoryview(data)
+        for start in range(0, len(data), self.CHUNK_SIZE):
+            flash = data[start:start + self.CHUNK_SIZE]
+            position = offset + start
+            image = self.image[position:position + len(flash)]
+            if flash == image:
+                continue
+            self.dirty_chunks += 1
+            xor = int.from_bytes(flash, 'big') ^ int.from_bytes(image, 'big')
+            mask = xor.to_bytes(len(flash), 'big').translate(self.MASK_TABLE)
+            run_start = mask.find(1)
+            while run_start >= 0:
+                run_end = mask.find(0, run_start)
+                if run_end < 0:
+                    run_end = len(mask)
+                self._add(position + run_start, position + run_end)
+                run_start = mask.find(1, run_end)
+        self.compared += len(data)
+
+    def _add(self, start, end):
+        self.differing += end - start
+        current = self._current
+        if current is not None and start - current[1] < self.MERGE_GAP:
+            current[1] = end
+            current[2] += end - start
+        else:
+            self._close()
+            self._current = [start, end, end - start]
+
+    def _close(self):
+        if self._current is None:
+            return
+        offset, end, differing = self._current
+        self._current = None
+        self.range_count += 1
+        self.largest = max(self.largest, end - offset)
+        if len(self.ranges) < self.PRINT_LIMIT:
+            self.ranges.append((offset, end - offset, differing))
+        if self.diff_file is not None:
+            self.diff_file.write(json.dumps({'type': 'range', 'file': self.filename, 'address': self.address + offset,
+                                             'length': end - offset, 'differing': differing}) + '\n')
+
+    def finish(self):
+        """ Complete the last range, and write the summary to the diff file """
+        self._close()
+        if self.diff_file is not None:
+            self.diff_file.write(json.dumps({'type': 'summary', 'file': self.filename, 'address': self.address,
+                                             'size': len(self.image), 'compared': self.compared,
+                                             'differing': self.differing, 'ranges': self.range_count,
+                                             'dirty_chunks': self.dirty_chunks, 'largest_range': self.largest}) + '\n')
+
+
+class BackupArchive(object):
+    """ Flash backup made of independently compressed blocks, with an index of them at the end
+
+    The file holds HEADER, the zlib streams of the BLOCK_SIZE blocks of the backup (the
+    last one may be shorter), one INDEX_ENTRY per block and TRAILER. Blocks of only 0xFF
+    aren't stored and a block equal to an earlier one points at that one's stream, so the
+    unused flash and repeated firmware of a backup take next to no space. The index has the
+    MD5 of every block, so a region can be read or compared with the flash without
+    inflating anything but the blocks it covers.
+    """
+    MAGIC = b'TZBACKUP'
+    VERSION = 1
+    BLOCK_SIZE = 0x10000
+    HEADER = struct.Struct('<8sIIII')  # magic, version, block size, flash address, size
+    INDEX_ENTRY = struct.Struct('<II16s')  # offset of the zlib stream, its length (0 for a block of 0xFF), MD5
+    TRAILER = struct.Struct('<II8s')  # offset of the index, number of blocks, magic
+
+    def __init__(self, f):
+        """ Read the index of the archive in the binary file object 'f' """
+        self._file = f
+        self.name = f.name
+        try:
+            f.seek(0)
+            magic, version, self.block_size, self.address, self.size = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC or version != self.VERSION:
+                raise FatalError('%s is not a version %d backup archive' % (f.name, self.VERSION))
+            f.seek(-self.TRAILER.size, os.SEEK_END)
+            index_offset, count, magic = self.TRAILER.unpack(f.read(self.TRAILER.size))
+            if magic != self.MAGIC or count != div_roundup(self.size, self.block_size):
+                raise FatalError('Backup archive %s is truncated or corrupt' % f.name)
+            f.seek(index_offset)
+            index = f.read(count * self.INDEX_ENTRY.size)
+            self.index = [self.INDEX_ENTRY.unpack_from(index, i * self.INDEX_ENTRY.size) for i in range(count)]
+        except struct.error:
+            raise FatalError('Backup archive %s is truncated or corrupt' % f.name)
+
+    @classmethod
+    def is_archive(cls, f):
+        """ True if the binary file object 'f' starts like an archive, its position is kept """
+        position = f.tell()
+        magic = f.read(len(cls.MAGIC))
+        f.seek(position)
+        return magic == cls.MAGIC
+
+    @classmethod
+    def write(cls, f, address, size, chunks, level=9):
+        """ Write the 'size' bytes of flash at 'address', yielded by 'chunks' in pieces of any
+        length, into the binary file object 'f' as an archive
+        """
+        f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.BLOCK_SIZE, address, size))
+        blank = b'\xff' * cls.BLOCK_SIZE
+        stored = {}  # MD5 -> (offset, length) of the streams already written
+        index = []
+
+        def add(block):
+            digest = hashlib.md5(block).digest()
+            if block == blank[:len(block)]:
+                entry = (0, 0)
+            elif digest in stored:
+                entry = stored[digest]
+            else:
+                stream = zlib.compress(block, level)
+                entry = stored[digest] = (f.tell(), len(stream))
+                f.write(stream)
+            index.append(cls.INDEX_ENTRY.pack(entry[0], entry[1], digest))
+
+        pending = bytearray()
+        for chunk in chunks:
+            pending += chunk
+            while len(pending) >= cls.BLOCK_SIZE:
+                add(bytes(pending[:cls.BLOCK_SIZE]))
+                del pending[:cls.BLOCK_SIZE]
+        if pending:
+            add(bytes(pending))
+        if len(index) != div_roundup(size, cls.BLOCK_SIZE):
+            raise FatalError('Backup archive needs 0x%x bytes, got 0x%x' % (size, (len(index) - 1) * cls.BLOCK_SIZE + len(pending)))
+        index_offset = f.tell()
+        f.write(b''.join(index))
+        f.write(cls.TRAILER.pack(index_offset, len(index), cls.MAGIC))
+
+    def block(self, i):
+        """ Inflated content of block 'i', checked against its MD5 """
+        stream_offset, stream_length, digest = self.index[i]
+        length = min(self.block_size, self.size - i * self.block_size)
+        if not stream_length:
+            return b'\xff' * length
+        self._file.seek(stream_offset)
+        try:
+            data = zlib.decompress(self._file.read(stream_length))
+        except zlib.error:
+            data = None
+        if data is None or len(data) != length or hashlib.md5(data).digest() != digest:
+            raise FatalError('Block 0x%x of backup archive %s is corrupt' % (i * self.block_size, self.name))
+        return data
+
+    def read(self, offset, length):
+        """ Yields the 'length' bytes of the backup at 'offset' in pieces, inflating only the blocks they are in """
+        if offset < 0 or offset + length > self.size:
+            raise FatalError('0x%x bytes at 0x%x are not in the backup of 0x%x bytes' % (length, offset, self.size))
+        end = offset + length
+        while offset < end:
+            i, start = divmod(offset, self.block_size)
+            data = self.block(i)[start:start + end - offset]
+            yield data
+            offset += len(data)
+
+    def md5(self, offset, length):
+        """ MD5 hex digest of the 'length' bytes of the backup at 'offset' """
+        i, start = divmod(offset, self.block_size)
+        if start == 0 and length == min(self.block_size, self.size - offset):
+            return hexify(self.index[i][2], uppercase=False)
+        md5 = hashlib.md5()
+        for data in self.read(offset, length):
+            md5.update(data)
+        return md5.hexdigest()
+
+
 class FatalError(RuntimeError):
     """
     Wrapper class for runtime errors that aren't caused by internal bugs, but by
@@ -2217,6 +3713,101 @@ class NotSupportedError(FatalError):
 # argument.
 
 
+ProbeResult = collections.namedtuple('ProbeResult', 'port chip mac esp')
+
+
+def probe_ports(ports, baud=ESPLoader.ESP_ROM_BAUD, connect_mode='default_reset', chip='auto', trace_enabled=False,
+                stats=None, timeout=PROBE_TIMEOUT, session=None):
+    """ Reset and sync with the chips on all 'ports' at the same time
+
+    Every port is probed in its own thread, which gives up when the chip hasn't answered
+    'timeout' seconds after probing started. Returns a ProbeResult with the chip name, MAC
+    and connected ROM loader for every port a chip answered on, in the order of 'ports'.
+    Ports without a chip are closed again and their error is printed. All loaders share
+    'session'.
+    """
+    results = [None] * len(ports)
+    deadline = time.time() + timeout
+
+    def probe_port(i, port):
+        esp = None
+        try:
+            if chip == 'auto':
+                esp = ESPLoader.detect_chip(port, baud, connect_mode, trace_enabled, stats, deadline, session)
+            else:
+                esp = {'esp8266': ESP8266ROM, 'esp32': ESP32ROM}[chip](port, baud, trace_enabled, stats, session)
+                esp.connect(connect_mode, deadline)
+            mac = ':'.join('%02x' % b for b in esp.read_mac())
+            results[i] = ProbeResult(port, esp.CHIP_NAME, mac, esp)
+        except (FatalError, OSError) as err:
+            print('%s failed to connect: %s' % (port, err))
+            if esp is not None:
+                esp._port.close()
+
+    threads = [threading.Thread(target=probe_port, args=(i, port), daemon=True) for i, port in enumerate(ports)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [result for result in results if result is not None]
+
+
+async def async_flash_port(port, address, image, compressed=None, baud=ESPLoader.ESP_ROM_BAUD, connect_mode='default_reset',
+                           chip='auto', after='hard_reset', trace_enabled=False, stats=None, progress_fn=None):
+    """ Connect to the chip on 'port' with an AsyncESPLoader, run the stub and write 'image' to flash at 'address'
+
+    'compressed' and 'progress_fn' are passed to AsyncESPLoader.write_flash(). The chip is
+    hard reset afterwards if 'after' is 'hard_reset' and left in the stub otherwise. The
+    port is closed when done. Returns the number of bytes sent.
+    """
+    initial_baud = min(ESPLoader.ESP_ROM_BAUD, baud)  # don't sync faster than the default baud rate
+    esp = AsyncESPLoader(port, {'auto': None, 'esp8266': ESP8266ROM, 'esp32': ESP32ROM}[chip], initial_baud,
+                         trace_enabled, stats)
+    try:
+        await esp.connect(connect_mode)
+        if chip == 'auto':
+            await esp.detect_chip()
+        await esp.run_stub()
+        if baud > initial_baud:
+            await esp.change_baud(baud)
+        written = await esp.write_flash(address, image, compressed, progress_fn)
+        if after == 'hard_reset':
+            await esp.hard_reset()
+        return written
+    finally:
+        await esp.close()
+
+
+def write_flash_ports(ports, address, image, baud=ESPLoader.ESP_ROM_BAUD, connect_mode='default_reset', chip='auto',
+                      after='hard_reset', trace_enabled=False, stats=None, progress_fn=None):
+    """ Write 'image' to flash at 'address' on all 'ports' at the same time, from one thread
+
+    The image is compressed once and every port is flashed by async_flash_port() on
+    a new event loop, unlike probe_ports() no thread is started per port. 'progress_fn'
+    is called with the port and the number of bytes of 'image' it has written. Returns
+    a dict with the FatalError or OSError of every port, None if it was written and
+    its MD5 verified.
+    """
+    compressed = zlib.compress(image, 9)
+
+    async def flash(port):
+        port_progress = None if progress_fn is None else lambda written: progress_fn(port, written)
+        try:
+            await async_flash_port(port, address, image, compressed, baud, connect_mode, chip, after, trace_enabled,
+                                   stats, port_progress)
+        except (FatalError, OSError) as err:
+            return err
+
+    async def flash_all():
+        return await asyncio.gather(*[flash(port) for port in ports])
+
+    loop = asyncio.new_event_loop()
+    try:
+        return dict(zip(ports, loop.run_until_complete(flash_all())))
+    finally:
+        loop.close()
+
+
 def load_ram(esp, args):
     image = LoadFirmwareImage(esp.CHIP_NAME, args.filename)
 
@@ -2353,11 +3944,15 @@ def write_flash(esp, args):
     if args.flash_size != 'keep':  # TODO: check this even with 'keep'
         flash_end = flash_size_bytes(args.flash_size)
         for address, argfile in args.addr_filename:
-            argfile.seek(0,2)  # seek to end
-            if address + argfile.tell() > flash_end:
+            if BackupArchive.is_archive(argfile):
+                length = BackupArchive(argfile).size
+            else:
+                argfile.seek(0,2)  # seek to end
+                length = argfile.tell()
+            if address + length > flash_end:
                 raise FatalError(("File %s (length %d) at offset %d will not fit in %d bytes of flash. " +
                                   "Use --flash-size argument, or change flashing address.")
-                                 % (argfile.name, argfile.tell(), address, flash_end))
+                                 % (argfile.name, length, address, flash_end))
             argfile.seek(0)
 
     if args.erase_all:
@@ -2368,9 +3963,24 @@ def write_flash(esp, args):
         print('Will flash uncompressed')
         args.compress = False
 
+    hash_cache = None
+    if args.hash_cache:
+        hash_cache = SectorHashCache(args.hash_cache)
+        device = SectorHashCache.device_key(esp)
+
     for address, argfile in args.addr_filename:
         if args.no_stub:
             print('Erasing flash...')
+        if BackupArchive.is_archive(argfile):
+            if args.encrypt:
+                raise FatalError('Backup archive %s can not be written encrypted' % argfile.name)
+            archive = BackupArchive(argfile)
+            if hash_cache:
+                hash_cache.discard(device, address, archive.size)
+                hash_cache.save()
+            _write_flash_archive(esp, args, address, archive)
+            argfile.seek(0)
+            continue
         image = pad_to(argfile.read(), 32 if args.encrypt else 4)
         if len(image) == 0:
             print('WARNING: File %s is empty' % argfile.name)
@@ -2378,50 +3988,116 @@ def write_flash(esp, args):
         image = _update_image_flash_params(esp, address, args, image)
         calcmd5 = hashlib.md5(image).hexdigest()
         uncsize = len(image)
-        if args.compress:
-            uncimage = image
-            image = zlib.compress(uncimage, 9)
-            ratio = uncsize / len(image)
-            blocks = esp.flash_defl_begin(uncsize, len(image), address)
-        else:
-            ratio = 1.0
-            blocks = esp.flash_begin(uncsize, address)
         argfile.seek(0)  # in case we need it again
-        seq = 0
-        written = 0
-        t = time.time()
-        while sw.continueFlag() and len(image) > 0:
-            # print('\rWriting at 0x%08x... (%d %%)' % (address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks), end='')
-            # sys.stdout.flush()
-            sw.progress.emit('write', 100 * (seq + 1) // blocks)
-            block = image[0:esp.FLASH_WRITE_SIZE]
-            if args.compress:
-                esp.flash_defl_block(block, seq, timeout=DEFAULT_TIMEOUT * ratio * 2)
+
+        ranges = [(0, uncsize)]  # (offset, length) parts of the image to write
+        cached_plan = False  # ranges come from the hash cache rather than the flash
+        if args.diff_flash:
+            if not esp.IS_STUB or args.encrypt or address % esp.FLASH_SECTOR_SIZE:
+                print('WARNING: Writing all of %s, differential flashing needs the stub, no encryption '
+                      'and a sector aligned address' % argfile.name)
             else:
-                # Pad the last block
-                block = block + b'\xff' * (esp.FLASH_WRITE_SIZE - len(block))
-                if args.encrypt:
-                    esp.flash_encrypt_block(block, seq)
+                cached = hash_cache.changed_ranges(device, address, image) if hash_cache else None
+                ranges = None
+                if cached is not None:
+                    ranges, regions = cached
+                    # something else may have written the flash, so it has to match what the cache
+                    # recorded before the sectors the cache considers unchanged are skipped
+                    if ranges and any(esp.flash_md5sum(start, length) != md5 for start, length, md5 in regions):
+                        print('WARNING: Flash at 0x%08x does not match the cached hashes, hashing its sectors' % address)
+                        hash_cache.invalidate(device)
+                        ranges = None
+                cached_plan = ranges is not None
+                if not ranges:
+                    if esp.flash_md5sum(address, uncsize) == calcmd5:
+                        print('Flash at 0x%08x already contains %s, skipped %d bytes' % (address, argfile.name, uncsize))
+                        if hash_cache:
+                            hash_cache.update(device, address, image)
+                            hash_cache.save()
+                        continue
+                    if cached_plan:
+                        print('WARNING: Flash at 0x%08x does not match the cached sector hashes' % address)
+                        hash_cache.invalidate(device)
+                        cached_plan = False
+                    ranges = _changed_ranges(esp, address, image)
                 else:
-                    esp.flash_block(block, seq)
-            image = image[esp.FLASH_WRITE_SIZE:]
-            seq += 1
-            written += len(block)
-        if sw.continueFlag():
+                    print('Planned from cached sector hashes, checked against %d cached region hashes' % len(regions))
+        if hash_cache:
+            # until the result is verified the cache knows nothing about these sectors
+            hash_cache.discard(device, address, uncsize)
+            hash_cache.save()
+
+        if args.compress:
+            if args.compress_level == 'auto':
+                link_rate = esp.link_throughput()
+                level, projections = choose_compress_level(image, link_rate, esp.IS_STUB)
+                print('Compression level %d chosen for a link taking %d bytes/s: ratio %.2f, projected %.1f seconds (%.1f seconds less than level 9)'
+                      % (level, link_rate, projections[level][0], projections[level][1], projections[9][1] - projections[level][1]))
+            else:
+                level = int(args.compress_level)
+        else:
+            level = None
+
+        def write_ranges(ranges):
+            """ Write the (offset, length) ranges of the image
+
+            Returns the number of bytes sent, written and erased instead of being written.
+            """
+            erase_ranges = []
+            if esp.IS_STUB and not args.encrypt and address % esp.FLASH_SECTOR_SIZE == 0:
+                ranges, erase_ranges = _split_erased_ranges(image, ranges, esp.FLASH_SECTOR_SIZE)
+            to_write = sum(length for offset, length in ranges)
+            to_erase = sum(length for offset, length in erase_ranges)
+            done = 0
+
+            def write_progress(range_done):
+                esp.session.progress.emit('write', 100 * (done + range_done) // (to_write + to_erase))
+
+            for offset, length in erase_ranges:
+                esp.erase_region(address + offset, length + (-length) % esp.FLASH_SECTOR_SIZE)
+                done += length
+                write_progress(0)
+                if not esp.session.continueFlag():
+                    return 0, 0, done
+            written = 0
+            with memoryview(image) as view:
+                for offset, length in ranges:
+                    written += _write_flash_range(esp, args, address + offset, view[offset:offset + length], level, write_progress)
+                    done += length
+                    if not esp.session.continueFlag():
+                        break
+            return written, to_write, to_erase
+
+        t = time.time()
+        written, to_write, erased = write_ranges(ranges)
+        if esp.session.continueFlag():
             t = time.time() - t
             speed_msg = ""
             if args.compress:
                 if t > 0.0:
-                    speed_msg = " (effective %.1f kbit/s)" % (uncsize / t * 8 / 1000)
-                print('\rWrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % (uncsize, written, address, t, speed_msg))
+                    speed_msg = " (effective %.1f kbit/s)" % (to_write / t * 8 / 1000)
+                print('\rWrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % (to_write, written, address, t, speed_msg))
             else:
                 if t > 0.0:
                     speed_msg = " (%.1f kbit/s)" % (written / t * 8 / 1000)
                 print('\rWrote %d bytes at 0x%08x in %.1f seconds%s...' % (written, address, t, speed_msg))
+            if erased:
+                print('Erased %d bytes of the image which are all 0xFF instead of writing them' % erased)
+            if to_write + erased < uncsize:
+                print('Skipped %d of %d bytes which were already in flash, wrote %d ranges'
+                      % (uncsize - to_write - erased, uncsize, len(ranges)))
 
             if not args.encrypt:
                 try:
                     res = esp.flash_md5sum(address, uncsize)
+                    if res != calcmd5 and cached_plan:
+                        # the flash was changed behind the cache's back, compare with the flash itself
+                        print('WARNING: Flash at 0x%08x does not match the cached sector hashes, '
+                              'writing the sectors which differ' % address)
+                        hash_cache.invalidate(device)
+                        hash_cache.save()
+                        write_ranges(_changed_ranges(esp, address, image))
+                        res = esp.flash_md5sum(address, uncsize)
                     if res != calcmd5:
                         print('File  md5: %s' % calcmd5)
                         print('Flash md5: %s' % res)
@@ -2429,6 +4105,9 @@ def write_flash(esp, args):
                         raise FatalError("MD5 of file does not match data in flash!")
                     else:
                         print('Hash of data verified.')
+                        if hash_cache:
+                            hash_cache.update(device, address, image)
+                            hash_cache.save()
                 except NotImplementedInROMError:
                     pass
 
@@ -2449,6 +4128,252 @@ def write_flash(esp, args):
         verify_flash(esp, args)
 
 
+def _changed_ranges(esp, address, image):
+    """ Find the sectors of 'image' whose content differs from the flash at 'address'
+
+    The stub hashes the flash per 64 KB region, and the regions which differ once more per
+    sector. When most regions differ the sector hashes would save little, so the differing
+    regions are written whole. Returns a list of (offset, length) runs relative to
+    'address', the last one ending with the image. Bytes past the end of the image in its
+    last sector are left as they are if that sector is unchanged.
+    """
+    region_size = 0x10000
+    sector_size = esp.FLASH_SECTOR_SIZE
+    ranges = []
+
+    def differs(start, end):
+        return esp.flash_md5sum(address + start, end - start) != hashlib.md5(image[start:end]).hexdigest()
+
+    def add(start, end):
+        if ranges and sum(ranges[-1]) == start:
+            ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
+        else:
+            ranges.append((start, end - start))
+
+    regions = [(region, min(region + region_size, len(image))) for region in range(0, len(image), region_size)]
+    changed = [(start, end) for start, end in regions if differs(start, end)]
+    if len(changed) * 2 > len(regions):
+        for start, end in changed:
+            add(start, end)
+        return ranges
+    for region, region_end in changed:
+        for sector in range(region, region_end, sector_size):
+            sector_end = min(sector + sector_size, region_end)
+            if differs(sector, sector_end):
+                add(sector, sector_end)
+    return ranges
+
+
+def _split_erased_ranges(image, ranges, sector_size):
+    """ Split the (offset, length) ranges of 'image' into ranges to write and runs of 0xFF sectors
+
+    Returns (write_ranges, erase_ranges). The sectors of an erase range only need erasing,
+    their content doesn't have to be sent. A last sector which is 0xFF up to the end of the
+    image is erased as a whole, which writing it would have done as well.
+    """
+    blank = b'\xff' * sector_size
+    write_ranges = []
+    erase_ranges = []
+    for offset, length in ranges:
+        end = offset + length
+        for sector in range(offset, end, sector_size):
+            sector_end = min(sector + sector_size, end)
+            target = erase_ranges if image.startswith(blank[:sector_end - sector], sector) else write_ranges
+            if target and sum(target[-1]) == sector:
+                target[-1] = (target[-1][0], sector_end - target[-1][0])
+            else:
+                target.append((sector, sector_end - sector))
+    return write_ranges, erase_ranges
+
+
+def _bisect_changed_ranges(esp, address, image, max_hashes=None):
+    """ Find the sectors of 'image' whose content differs from the flash at 'address' by bisection
+
+    The image as a whole is known to differ. The stub hashes the first half of a differing
+    part, and the second half too if the first one differs as well, down to single
+    sectors, so a few bad sectors of a large image take a few dozen flash_md5sum() calls.
+    Once 'max_hashes' hashes were made the parts left are taken as differing, which keeps
+    an image differing everywhere from costing two hashes per sector.
+    Returns a list of (offset, length) runs of differing sectors relative to 'address'.
+    """
+    sector_size = esp.FLASH_SECTOR_SIZE
+    ranges = []
+    hashes = [0]
+
+    def differs(start, end):
+        hashes[0] += 1
+        return esp.flash_md5sum(address + start, end - start) != hashlib.md5(image[start:end]).hexdigest()
+
+    def bisect(start, end):
+        if end - start <= sector_size or (max_hashes is not None and hashes[0] >= max_hashes):
+            if ranges and sum(ranges[-1]) == start:
+                ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
+            else:
+                ranges.append((start, end - start))
+            return
+        mid = start + (end - start + sector_size - 1) // sector_size // 2 * sector_size
+        if differs(start, mid):
+            bisect(start, mid)
+            if differs(mid, end):
+                bisect(mid, end)
+        else:
+            bisect(mid, end)
+
+    bisect(0, len(image))
+    return ranges
+
+
+def _write_flash_range(esp, args, address, data, level, progress_fn, size=None):
+    """ Write 'data' to flash at 'address' in one flash_begin / flash_defl_begin transfer
+
+    'level' is the zlib level if args.compress is set. 'progress_fn' is called with the
+    number of bytes of 'data' written so far. If 'size' is given, 'data' is a zlib stream
+    inflating to 'size' bytes already and args.compress must be set. Returns the number of
+    bytes sent.
+    """
+    compressed = size is not None
+    if not compressed:
+        size = len(data)
+    # the stub gets the data compressed while it is sent, the ROM loader needs the
+    # compressed size up front
+    streamed = args.compress and esp.IS_STUB and not compressed
+    if streamed:
+        esp.flash_defl_begin(size, None, address)
+    elif args.compress:
+        if not compressed:
+            data = zlib.compress(data, level)
+        ratio = size / len(data)
+        blocks = esp.flash_defl_begin(size, len(data), address)
+    else:
+        blocks = esp.flash_begin(size, address)
+
+    def data_blocks():
+        """ Yields (seq, block, timeout) for every block to send """
+        if streamed:
+            done = 0
+            for seq, (block, block_size) in enumerate(BlockCompressor(data, level, esp.FLASH_WRITE_SIZE)):
+                if not esp.session.continueFlag():
+                    break
+                done += block_size
+                progress_fn(done)
+                yield seq, block, esp.flash_block_timeout(len(block), block_size)
+            return
+        # the last block of uncompressed data is padded, the compressed stream just ends
+        pad_character = None if args.compress else b'\xff'
+        for seq, block in enumerate(iter_blocks(data, esp.FLASH_WRITE_SIZE, pad_character)):
+            if not esp.session.continueFlag():
+                break
+            # print('\rWriting at 0x%08x... (%d %%)' % (address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks), end='')
+            # sys.stdout.flush()
+            progress_fn(size * (seq + 1) // blocks)
+            # a compressed block inflates to about 'ratio' times its size, more for runs of 0xFF
+            write_size = len(block) * ratio * 2 if args.compress else len(block)
+            yield seq, block, esp.flash_block_timeout(len(block), write_size)
+
+    if args.pipeline_window > 1 and esp.IS_STUB:
+        if args.compress:
+            op = esp.ESP_FLASH_DEFL_DATA
+        else:
+            op = esp.ESP_FLASH_ENCRYPT_DATA if args.encrypt else esp.ESP_FLASH_DATA
+        return esp.flash_blocks_pipelined(op, data_blocks(), args.pipeline_window)
+    written = 0
+    for seq, block, timeout in data_blocks():
+        if args.compress:
+            esp.flash_defl_block(block, seq, timeout=timeout)
+        elif args.encrypt:
+            esp.flash_encrypt_block(block, seq, timeout=timeout)
+        else:
+            esp.flash_block(block, seq, timeout=timeout)
+        written += len(block)
+    return written
+
+
+def _write_flash_archive(esp, args, address, archive):
+    """ Restore the BackupArchive 'archive' to flash at 'address'
+
+    The blocks are inflated and every run of consecutive blocks to write is sent in one
+    transfer, compressed again as a single stream if args.compress is set. Runs of blocks
+    of 0xFF are erased with the stub. With args.diff_flash blocks whose MD5 matches the
+    flash are skipped. Every run is checked once, against the MD5 of its blocks.
+    """
+    diff = args.diff_flash and esp.IS_STUB
+    if args.diff_flash and not diff:
+        print('WARNING: Writing all of %s, differential flashing needs the stub' % archive.name)
+    can_erase = esp.IS_STUB and address % esp.FLASH_SECTOR_SIZE == 0
+    can_verify = True
+    sent = written = erased = skipped = 0
+    run = []  # (length, data) of the blocks of the current run, 'data' is None in a run to erase
+    run_offset = 0
+    t = time.time()
+
+    def restore_run():
+        """ Write or erase the blocks of 'run' at 'run_offset' """
+        nonlocal sent, written, erased, can_verify
+        run_address = address + run_offset
+        length = sum(block_length for block_length, _ in run)
+        md5 = hashlib.md5()
+        if run[0][1] is None:
+            esp.erase_region(run_address, length + (-length) % esp.FLASH_SECTOR_SIZE)
+            erased += length
+            for block_length, _ in run:
+                md5.update(b'\xff' * block_length)
+        else:
+            data = b''.join(data for _, data in run)
+            md5.update(data)
+            sent += _write_flash_range(esp, args, run_address, data, 9 if args.compress else None,
+                                       lambda done: esp.session.progress.emit('write', 100 * (run_offset + done) // archive.size))
+            written += length
+        del run[:]
+        esp.session.progress.emit('write', 100 * (run_offset + length) // archive.size)
+        if can_verify and esp.session.continueFlag():
+            try:
+                if esp.flash_md5sum(run_address, length) != md5.hexdigest():
+                    raise FatalError('MD5 of the flash at 0x%08x does not match 0x%x bytes at 0x%x of %s'
+                                     % (run_address, length, run_address - address, archive.name))
+            except NotImplementedInROMError:
+                can_verify = False
+
+    for i, (_, stream_length, digest) in enumerate(archive.index):
+        if not esp.session.continueFlag():
+            return
+        offset = i * archive.block_size
+        length = min(archive.block_size, archive.size - offset)
+        expected = hexify(digest, uppercase=False)
+        data = None
+        if i == 0:
+            # flash parameters in the header of a bootloader image are set like for other files
+            original = archive.block(0)
+            data = _update_image_flash_params(esp, address, args, original)
+            if data != original:
+                expected = hashlib.md5(data).hexdigest()
+                stream_length = len(data)  # no longer a block of 0xFF
+        if diff and esp.flash_md5sum(address + offset, length) == expected:
+            if run:
+                restore_run()
+            skipped += length
+            esp.session.progress.emit('write', 100 * (offset + length) // archive.size)
+            continue
+        erase = not stream_length and can_erase
+        if run and erase != (run[0][1] is None):
+            restore_run()
+        if not run:
+            run_offset = offset
+        if erase:
+            data = None
+        elif data is None:
+            data = archive.block(i)
+        run.append((length, data))
+    if run:
+        restore_run()
+    if not esp.session.continueFlag():
+        return
+    t = time.time() - t
+    print('Restored %s at 0x%08x in %.1f seconds: wrote %d bytes (%d sent), erased %d bytes, skipped %d bytes which were already in flash'
+          % (archive.name, address, t, written, sent, erased, skipped))
+    if can_verify:
+        print('Hash of data verified.')
+
+
 def image_info(args):
     image = LoadFirmwareImage(args.chip, args.filename)
     print('Image version: %d' % image.version)
@@ -2537,13 +4462,17 @@ def chip_id(esp, args):
 
 
 def erase_flash(esp, args):
-    if sw.continueFlag():
-        sw.progress.emit('erase', 50)
+    if esp.session.continueFlag():
+        esp.session.progress.emit('erase', 50)
         print('Erasing flash (this may take a while)...')
         t = time.time()
         esp.erase_flash()
         print('Chip erase completed successfully in %.1fs' % (time.time() - t))
-        sw.progress.emit('erase', 100)
+        if args.hash_cache:
+            hash_cache = SectorHashCache(args.hash_cache)
+            hash_cache.invalidate(SectorHashCache.device_key(esp))
+            hash_cache.save()
+        esp.session.progress.emit('erase', 100)
 
 
 def erase_region(esp, args):
@@ -2551,6 +4480,10 @@ def erase_region(esp, args):
     t = time.time()
     esp.erase_region(args.address, args.size)
     print('Erase completed successfully in %.1f seconds.' % (time.time() - t))
+    if args.hash_cache:
+        hash_cache = SectorHashCache(args.hash_cache)
+        hash_cache.discard(SectorHashCache.device_key(esp), args.address, args.size)
+        hash_cache.save()
 
 
 def run(esp, args):
@@ -2570,7 +4503,7 @@ def read_flash(esp, args):
         flash_progress = None
     else:
         def flash_progress(progress, length):
-            sw.progress.emit('backup', progress * 100.0 // length)
+            esp.session.progress.emit('backup', progress * 100.0 // length)
             # msg = '%d (%d %%)' % (progress, progress * 100.0 / length)
             # padding = '\b' * len(msg)
             # if progress == length:
@@ -2578,52 +4511,220 @@ def read_flash(esp, args):
             # sys.stdout.write(msg + padding)
             # sys.stdout.flush()
     t = time.time()
-    data = esp.read_flash(args.address, args.size, flash_progress)
+    # Stream the data into a temporary file next to the destination, which is only moved
+    # into place once the stub's digest matched. Memory use doesn't depend on the flash
+    # size, and a failed or aborted read never leaves a truncated file behind.
+    directory = os.path.dirname(os.path.abspath(args.filename))
+    resume_from = 0
+    if args.resume:
+        # keep what was received if the read fails, under a name tied to the device and
+        # region so the next attempt for them can pick up where this one stopped
+        mac = ''.join('%02x' % x for x in esp.read_mac())
+        temp_name = os.path.join(directory, '.read_flash_%s_%x_%x.part' % (mac, args.address, args.size))
+        _remove_stale_checkpoints(directory, '.read_flash_%s_' % mac, temp_name)
+        if os.path.exists(temp_name):
+            resume_from = _resumable_length(esp, temp_name, args.address, args.size)
+            if resume_from:
+                print('Resuming at 0x%x, 0x%x bytes already read and verified' % (args.address + resume_from, resume_from))
+    else:
+        temp_name = args.filename + '.part'
+    if flash_progress and resume_from:
+        read_progress = flash_progress
+
+        def flash_progress(progress, length):
+            read_progress(resume_from + progress, args.size)
+    try:
+        with open(temp_name, 'r+b' if resume_from else 'wb') as f:
+            f.seek(resume_from)
+            f.truncate()
+            if resume_from < args.size:
+                esp.read_flash(args.address + resume_from, args.size - resume_from, flash_progress, sink=f.write)
+            f.flush()
+            os.fsync(f.fileno())
+        if args.hash_cache:
+            # the backup just verified is what the flash holds, so a following write can be
+            # planned against it without hashing the flash again
+            hash_cache = SectorHashCache(args.hash_cache)
+            device = SectorHashCache.device_key(esp)
+            with open(temp_name, 'rb') as f:
+                hash_cache.update_chunks(device, args.address, iter(lambda: f.read(0x10000), b''))
+            hash_cache.save()
+        if args.archive:
+            _pack_backup(temp_name, args.filename, args.address, args.size)
+        else:
+            os.replace(temp_name, args.filename)
+    except BaseException:
+        if not args.resume and os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    fsync_directory(directory)
     t = time.time() - t
     print('\rRead %d bytes at 0x%x in %.1f seconds (%.1f kbit/s)...'
-          % (len(data), args.address, t, len(data) / t * 8 / 1000))
-    with open(args.filename, 'wb') as f:
-        f.write(data)
+          % (args.size - resume_from, args.address + resume_from, t, (args.size - resume_from) / t * 8 / 1000))
 
 
-def verify_flash(esp, args):
-    differences = False
+def _pack_backup(raw_name, filename, address, size):
+    """ Pack the raw backup in 'raw_name' into a BackupArchive, moved into place as 'filename',
+    and remove 'raw_name'
+    """
+    packing_name = filename + '.packing'
+    try:
+        with open(raw_name, 'rb') as raw, open(packing_name, 'wb') as f:
+            BackupArchive.write(f, address, size, iter(lambda: raw.read(BackupArchive.BLOCK_SIZE), b''))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(packing_name, filename)
+    except BaseException:
+        if os.path.exists(packing_name):
+            os.remove(packing_name)
+        raise
+    os.remove(raw_name)
+    print('Packed into a backup archive of %d bytes' % os.path.getsize(filename))
+
+
+def _remove_stale_checkpoints(directory, prefix, keep):
+    """ Delete the files of interrupted reads in 'directory' whose name starts with 'prefix',
+    but 'keep'. Only the checkpoint of the region being read is kept for a device, one of
+    another region is left over from a backup which was given up and would stay forever.
+    """
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(prefix) and name.endswith('.part') and path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # e.g. removed by a parallel backup of the same device
 
-    for address, argfile in args.addr_filename:
-        image = pad_to(argfile.read(), 4)
-        argfile.seek(0)  # rewind in case we need it again
 
-        image = _update_image_flash_params(esp, address, args, image)
+def _resumable_length(esp, filename, address, size):
+    """ Length of the data kept from an interrupted read_flash that still matches the flash
 
-        image_size = len(image)
-        print('Verifying 0x%x (%d) bytes @ 0x%08x in flash against %s...' % (image_size, image_size, address, argfile.name))
-        # Try digest first, only read if there are differences.
-        digest = esp.flash_md5sum(address, image_size)
-        expected_digest = hashlib.md5(image).hexdigest()
-        if digest == expected_digest:
-            print('-- verify OK (digest matched)')
-            continue
-        else:
-            differences = True
-            if getattr(args, 'diff', 'no') != 'yes':
-                print('-- verify FAILED (digest mismatch)')
+    Only whole sectors are kept, the MD5 of the kept part is checked against the flash.
+    Returns 0 if the read has to start over.
+    """
+    length = min(os.path.getsize(filename), size)
+    length -= length % esp.FLASH_SECTOR_SIZE
+    if length == 0:
+        return 0
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        remaining = length
+        while remaining:
+            chunk = f.read(min(remaining, 0x10000))
+            md5.update(chunk)
+            remaining -= len(chunk)
+    if esp.flash_md5sum(address, length) != md5.hexdigest():
+        print('Data kept from the previous attempt does not match the flash, reading everything again')
+        return 0
+    return length
+
+
+def verify_flash(esp, args):
+    differences = False
+    show_diff = getattr(args, 'diff', 'no') == 'yes' or getattr(args, 'diff_file', None) is not None
+
+    with contextlib.ExitStack() as stack:
+        diff_file = stack.enter_context(open(args.diff_file, 'w')) if getattr(args, 'diff_file', None) else None
+        for address, argfile in args.addr_filename:
+            if BackupArchive.is_archive(argfile):
+                differences |= _verify_flash_archive(esp, args, address, BackupArchive(argfile), show_diff, diff_file)
+                argfile.seek(0)
+                continue
+            image = pad_to(argfile.read(), 4)
+            argfile.seek(0)  # rewind in case we need it again
+
+            image = _update_image_flash_params(esp, address, args, image)
+
+            image_size = len(image)
+            print('Verifying 0x%x (%d) bytes @ 0x%08x in flash against %s...' % (image_size, image_size, address, argfile.name))
+            # Try digest first, only read if there are differences.
+            digest = esp.flash_md5sum(address, image_size)
+            expected_digest = hashlib.md5(image).hexdigest()
+            if digest == expected_digest:
+                print('-- verify OK (digest matched)')
                 continue
+            else:
+                differences = True
+                if not show_diff:
+                    print('-- verify FAILED (digest mismatch)')
+                    continue
 
-        flash = esp.read_flash(address, image_size)
-        assert flash != image
-        diff = [i for i in range(image_size) if flash[i] != image[i]]
-        print('-- verify FAILED: %d differences, first @ 0x%08x' % (len(diff), address + diff[0]))
-        for d in diff:
-            flash_byte = flash[d]
-            image_byte = image[d]
-            if PYTHON2:
-                flash_byte = ord(flash_byte)
-                image_byte = ord(image_byte)
-            print('   %08x %02x %02x' % (address + d, flash_byte, image_byte))
+            # only the sectors found by bisection are read back, and compared as they arrive
+            diff = FlashDiff(image, address, argfile.name, diff_file)
+            for offset, length in _bisect_changed_ranges(esp, address, image, VERIFY_BISECT_MAX_HASHES):
+                received = [offset]
+
+                def compare(data):
+                    diff.feed(received[0], data)
+                    received[0] += len(data)
+                esp.read_flash(address + offset, length, sink=compare)
+            diff.finish()
+            _print_flash_diff(diff)
     if differences:
         raise FatalError("Verify failed.")
 
 
+def _verify_flash_archive(esp, args, address, archive, show_diff, diff_file):
+    """ Compare the flash at 'address' with the BackupArchive 'archive', one block at a time
+
+    Every block is compared by the MD5 in the index, so nothing is inflated unless a block
+    differs and a diff was asked for; then only the differing blocks are read back.
+    Returns True if the flash differs.
+    """
+    print('Verifying 0x%x (%d) bytes @ 0x%08x in flash against %s...' % (archive.size, archive.size, address, archive.name))
+
+    def block(i):
+        data = archive.block(i)
+        if i == 0:
+            # the flash parameters were set in the bootloader header when it was written
+            data = _update_image_flash_params(esp, address, args, data)
+        return data
+
+    differing = []
+    for i, (_, _, digest) in enumerate(archive.index):
+        offset = i * archive.block_size
+        length = min(archive.block_size, archive.size - offset)
+        expected = hashlib.md5(block(0)).hexdigest() if i == 0 else hexify(digest, uppercase=False)
+        if esp.flash_md5sum(address + offset, length) != expected:
+            differing.append(i)
+    if not differing:
+        print('-- verify OK (digest matched)')
+        return False
+    if not show_diff:
+        print('-- verify FAILED (digest mismatch in %d of %d blocks)' % (len(differing), len(archive.index)))
+        return True
+
+    for i in differing:
+        offset = i * archive.block_size
+        diff = FlashDiff(block(i), address + offset, archive.name, diff_file)
+        received = [0]
+
+        def compare(data):
+            diff.feed(received[0], data)
+            received[0] += len(data)
+        esp.read_flash(address + offset, len(diff.image), sink=compare)
+        diff.finish()
+        print('Block 0x%x of %s:' % (offset, archive.name))
+        _print_flash_diff(diff)
+    return True
+
+
+def _print_flash_diff(diff):
+    """ Print the result of the FlashDiff 'diff' of flash which didn't match its digest """
+    address = diff.address
+    if not diff.differing:
+        print('-- verify FAILED (digest mismatch, but no differing sector found)')
+        return
+    print('-- verify FAILED: %d differences in %d ranges, first @ 0x%08x'
+          % (diff.differing, diff.range_count, address + diff.ranges[0][0]))
+    for offset, length, differing in diff.ranges:
+        print('   0x%08x-0x%08x (%d bytes, %d differ)' % (address + offset, address + offset + length - 1, length, differing))
+    if diff.range_count > len(diff.ranges):
+        print('   ... and %d more ranges' % (diff.range_count - len(diff.ranges)))
+    print('   read back 0x%x bytes, %d of %d chunks of %d bytes differ, largest range %d bytes'
+          % (diff.compared, diff.dirty_chunks, div_roundup(diff.compared, diff.CHUNK_SIZE), diff.CHUNK_SIZE, diff.largest))
+
+
 def read_flash_status(esp, args):
     print('Status value: 0x%04x' % esp.read_status(args.bytes))
 
@@ -2637,6 +4738,49 @@ def write_flash_status(esp, args):
     print(('After flash status:   ' + fmt) % esp.read_status(args.bytes))
 
 
+def extract_backup(args):
+    with open(args.archive, 'rb') as f:
+        archive = BackupArchive(f)
+        offset = args.address - archive.address
+        md5 = hashlib.md5()
+        with open(args.filename, 'wb') as out:
+            for data in archive.read(offset, args.size):
+                md5.update(data)
+                out.write(data)
+    print('Extracted 0x%x bytes at 0x%x from %s, MD5 %s' % (args.size, args.address, args.archive, md5.hexdigest()))
+
+
+def flash_ports(args):
+    if args.ports:
+        ports = args.ports
+    else:
+        ports = [args.port] if args.port else sorted(p.device for p in list_ports.comports())
+    image = pad_to(args.filename.read(), 4)
+    stats = CommandStats() if args.stats is not None else None
+    print('Writing %d bytes at 0x%08x to %d serial ports at once...' % (len(image), args.address, len(ports)))
+    t = time.time()
+    results = write_flash_ports(ports, args.address, image, args.baud, args.before, args.chip, args.after, args.trace, stats)
+    t = time.time() - t
+    for port, err in results.items():
+        print('%s: %s' % (port, 'Hash of data verified.' if err is None else err))
+    failed = sum(err is not None for err in results.values())
+    print('Wrote %d ports in %.1f seconds' % (len(ports) - failed, t))
+    if stats is not None:
+        stats.dump(args.stats)
+    if failed:
+        raise FatalError('%d of %d ports failed' % (failed, len(ports)))
+
+
+def probe(args):
+    ports = [args.port] if args.port else sorted(p.device for p in list_ports.comports())
+    print('Probing %d serial ports...' % len(ports))
+    found = probe_ports(ports, min(ESPLoader.ESP_ROM_BAUD, args.baud), args.before, args.chip, args.trace)
+    for result in found:
+        print('%s: %s, MAC %s' % (result.port, result.chip, result.mac))
+        result.esp._port.close()
+    print('Found %d chips' % len(found))
+
+
 def version(args):
     print(__version__)
 
@@ -2645,13 +4789,19 @@ def version(args):
 #
 
 
-def main(custom_commandline=None):
+def main(custom_commandline=None, stats=None, session=None):
     """
     Main function for esptool
 
     custom_commandline - Optional override for default arguments parsing (that uses sys.argv), can be a list of custom arguments
     as strings. Arguments and their values need to be added as individual items to the list e.g. "-b 115200" thus
     becomes ['-b', '115200'].
+
+    stats - Optional CommandStats instance the commands sent to the chip are accounted in, so a caller can
+    collect them over several runs.
+
+    session - Optional Session the loader reports progress to and which cancels the operation, so several
+    runs in one process can be told apart and stopped on their own.
     """
     parser = argparse.ArgumentParser(description='esptool.py v%s - ESP8266 ROM Bootloader Utility' % __version__, prog='esptool')
 
@@ -2693,6 +4843,17 @@ def main(custom_commandline=None):
         help="Enable trace-level output of esptool.py interactions.",
         action='store_true')
 
+    parser.add_argument(
+        '--stats',
+        help="Write per-command counters and latency histograms as JSON to this file when done ('-' for stdout).",
+        metavar='FILE')
+
+    parser.add_argument(
+        '--hash-cache',
+        help="Keep the MD5 of the flash sectors written or read per device in this file, "
+             "so write_flash --diff-flash can skip hashing the flash.",
+        metavar='FILE')
+
     parser.add_argument(
         '--override-vddsdio',
         help="Override ESP32 VDDSDIO internal voltage regulator (use with care)",
@@ -2773,9 +4934,19 @@ def main(custom_commandline=None):
     parser_write_flash.add_argument('--ignore-flash-encryption-efuse-setting', help='Ignore flash encryption efuse settings ',
                                     action='store_true')
 
+    parser_write_flash.add_argument('--diff-flash', help='Only erase and write the sectors whose content differs from the flash, ' +
+                                    'found by comparing MD5 hashes (stub only)', action='store_true')
+
+    parser_write_flash.add_argument('--pipeline-window', help='Number of flash data blocks to keep in flight without waiting for ' +
+                                    'their response (stub only, capped to what the stub can buffer, 1 = lock-step)',
+                                    type=arg_auto_int, default=1)
+
     compress_args = parser_write_flash.add_mutually_exclusive_group(required=False)
     compress_args.add_argument('--compress', '-z', help='Compress data in transfer (default unless --no-stub is specified)',action="store_true", default=None)
     compress_args.add_argument('--no-compress', '-u', help='Disable data compression during transfer (default if --no-stub is specified)',action="store_true")
+    parser_write_flash.add_argument('--compress-level', help='zlib compression level, or "auto" to pick the level with the shortest ' +
+                                    'projected write time from the measured compression and link speeds',
+                                    choices=['auto'] + [str(level) for level in range(1, 10)], default='9')
 
     subparsers.add_parser(
         'run',
@@ -2844,6 +5015,12 @@ def main(custom_commandline=None):
     parser_read_flash.add_argument('size', help='Size of region to dump', type=arg_auto_int)
     parser_read_flash.add_argument('filename', help='Name of binary dump')
     parser_read_flash.add_argument('--no-progress', '-p', help='Suppress progress output', action="store_true")
+    parser_read_flash.add_argument('--resume', help='Keep the data read so far if reading fails, and continue from it ' +
+                                   'when the same region of the same device is read into the same directory again. ' +
+                                   'Data kept for other regions of the device is deleted',
+                                   action="store_true")
+    parser_read_flash.add_argument('--archive', help='Write a compressed backup archive with an index of 64 KB blocks '
+                                   'instead of the raw data, write_flash restores it', action="store_true")
 
     parser_verify_flash = subparsers.add_parser(
         'verify_flash',
@@ -2852,6 +5029,8 @@ def main(custom_commandline=None):
                                      action=AddrFilenamePairAction)
     parser_verify_flash.add_argument('--diff', '-d', help='Show differences',
                                      choices=['no', 'yes'], default='no')
+    parser_verify_flash.add_argument('--diff-file', help='Write the differing ranges and a summary as JSON lines to this file '
+                                     '(implies --diff yes)', metavar='FILE')
     add_spi_flash_subparsers(parser_verify_flash, is_elf2image=False)
 
     parser_erase_flash = subparsers.add_parser(
@@ -2866,6 +5045,27 @@ def main(custom_commandline=None):
     parser_erase_region.add_argument('address', help='Start address (must be multiple of 4096)', type=arg_auto_int)
     parser_erase_region.add_argument('size', help='Size of region to erase (must be multiple of 4096)', type=arg_auto_int)
 
+    parser_extract_backup = subparsers.add_parser(
+        'extract_backup',
+        help='Extract a region of a backup archive written by read_flash --archive')
+    parser_extract_backup.add_argument('archive', help='Backup archive')
+    parser_extract_backup.add_argument('address', help='Flash address of the region', type=arg_auto_int)
+    parser_extract_backup.add_argument('size', help='Size of the region', type=arg_auto_int)
+    parser_extract_backup.add_argument('filename', help='Name of the binary file to write')
+
+    parser_flash_ports = subparsers.add_parser(
+        'flash_ports',
+        help='Write a binary blob to flash on several chips at once, all served by one event loop '
+             '(the stub is always used and the image is written as is)')
+    parser_flash_ports.add_argument('address', help='Address to write the image at', type=arg_auto_int)
+    parser_flash_ports.add_argument('filename', help='Firmware image', type=argparse.FileType('rb'))
+    parser_flash_ports.add_argument('--ports', help='Serial ports to flash (default: --port, or all serial ports)',
+                                    nargs='+', metavar='PORT')
+
+    subparsers.add_parser(
+        'probe',
+        help='Reset and sync all serial ports (or --port) at once and list the chips which answered')
+
     subparsers.add_parser(
         'version', help='Print esptool version')
 
@@ -2895,6 +5095,9 @@ def main(custom_commandline=None):
         operation_args = inspect.getfullargspec(operation_func).args
 
     if operation_args[0] == 'esp':  # operation function takes an ESPLoader connection object
+        if stats is None and args.stats is not None:
+            stats = CommandStats()
+
         if args.before != "no_reset_no_sync":
             initial_baud = min(ESPLoader.ESP_ROM_BAUD, args.baud)  # don't sync faster than the default baud rate
         else:
@@ -2902,30 +5105,27 @@ def main(custom_commandline=None):
 
         if args.port is None:
             ser_list = sorted(ports.device for ports in list_ports.comports())
-            print("Found %d serial ports" % len(ser_list))
+            print("Found %d serial ports, probing them all at once" % len(ser_list))
+            found = probe_ports(list(reversed(ser_list)), initial_baud, args.before, args.chip, args.trace, stats, session=session)
+            if not found:
+                raise FatalError("Could not connect to an Espressif device on any of the %d available serial ports." % len(ser_list))
+            for result in found:
+                print("%s on %s, MAC %s" % (result.chip, result.port, result.mac))
+            for result in found[1:]:
+                result.esp._port.close()
+            esp = found[0].esp
+            print("Serial port %s" % found[0].port)
         else:
-            ser_list = [args.port]
-        esp = None
-        for each_port in reversed(ser_list):
-            print("Serial port %s" % each_port)
-            try:
-                if args.chip == 'auto':
-                    esp = ESPLoader.detect_chip(each_port, initial_baud, args.before, args.trace)
-                else:
-                    chip_class = {
-                        'esp8266': ESP8266ROM,
-                        'esp32': ESP32ROM,
-                    }[args.chip]
-                    esp = chip_class(each_port, initial_baud, args.trace)
-                    esp.connect(args.before)
-                break
-            except (FatalError, OSError) as err:
-                if args.port is not None:
-                    raise
-                print("%s failed to connect: %s" % (each_port, err))
-                esp = None
-        if esp is None:
-            raise FatalError("Could not connect to an Espressif device on any of the %d available serial ports." % len(ser_list))
+            print("Serial port %s" % args.port)
+            if args.chip == 'auto':
+                esp = ESPLoader.detect_chip(args.port, initial_baud, args.before, args.trace, stats, session=session)
+            else:
+                chip_class = {
+                    'esp8266': ESP8266ROM,
+                    'esp32': ESP32ROM,
+                }[args.chip]
+                esp = chip_class(args.port, initial_baud, args.trace, stats, session)
+                esp.connect(args.before)
 
         chip = esp.get_chip_description()
         print("Chip is %s" % (chip))
@@ -2936,7 +5136,7 @@ def main(custom_commandline=None):
 
         mac = read_mac(esp, args)
 
-        sw.connection_state.emit(f'Connected to {chip} [{mac}]')
+        esp.session.connection_state.emit(f'Connected to {chip} [{mac}]')
 
         if not args.no_stub:
             esp = esp.run_stub()
@@ -2947,8 +5147,13 @@ def main(custom_commandline=None):
         if args.baud > initial_baud:
             try:
                 esp.change_baud(args.baud)
+                if esp.IS_STUB:
+                    esp.check_link()
             except NotImplementedInROMError:
                 print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
+            except FatalError:
+                esp._port.close()  # so that a retry at a lower rate can open the port again
+                raise
 
         # override common SPI flash parameter stuff if configured to do so
         if hasattr(args, "spi_connection") and args.spi_connection is not None:
@@ -2969,12 +5174,17 @@ def main(custom_commandline=None):
 
         try:
             operation_func(esp, args)
+        except BaseException:
+            esp._port.close()  # so that a retry can open the port again
+            raise
         finally:
             try:  # Clean up AddrFilenamePairAction files
                 for address, argfile in args.addr_filename:
                     argfile.close()
             except AttributeError:
                 pass
+            if args.stats is not None:
+                stats.dump(args.stats)
 
         # Handle post-operation behaviour (reset or other)
         if operation_func == load_ram:
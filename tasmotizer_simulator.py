@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+#
+# Software ESP8266/ESP32 bootloader simulator for Tasmotizer
+#
+# Speaks the ROM and flasher stub serial protocol closely enough for
+# tasmotizer_esptool to connect, upload the stub and read/write/verify flash,
+# so flashing can be exercised and timed without a physical board.
+#
+# The simulated device is served over a pty (pass its path as --port, together
+# with --before no_reset, as a pty has no DTR/RTS lines) or over TCP, reachable
+# as a pyserial 'socket://host:port' URL.
+
+import argparse
+import hashlib
+import os
+import queue
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from tasmotizer_esptool import ESPLoader, ESP8266ROM, ESP32ROM, DETECTED_FLASH_SIZES, \
+    arg_auto_int, flash_size_bytes
+
+CHIPS = {
+    'esp8266': ESP8266ROM,
+    'esp32': ESP32ROM,
+}
+
+XTAL_MHZ = {
+    'esp8266': 26,
+    'esp32': 40,
+}
+
+# error codes sent in the second status byte
+ERR_INVALID_MESSAGE = 0x05
+ERR_BAD_DATA_CHECKSUM = 0x07
+ERR_BAD_SEQUENCE = 0x08
+
+SPI_CMD_USR = (1 << 18)
+SPIFLASH_RDID = 0x9F
+SPIFLASH_MANUFACTURER = 0xEF  # Winbond
+SPIFLASH_DEVICE = 0x40
+
+# commands only available once the stub is running
+STUB_ONLY = (ESPLoader.ESP_ERASE_FLASH, ESPLoader.ESP_ERASE_REGION, ESPLoader.ESP_READ_FLASH,
+             ESPLoader.ESP_RUN_USER_CODE)
+# commands missing from the ESP8266 ROM loader
+ESP8266_STUB_ONLY = (ESPLoader.ESP_SPI_ATTACH, ESPLoader.ESP_CHANGE_BAUDRATE, ESPLoader.ESP_FLASH_DEFL_BEGIN,
+                     ESPLoader.ESP_FLASH_DEFL_DATA, ESPLoader.ESP_FLASH_DEFL_END, ESPLoader.ESP_SPI_FLASH_MD5)
+
+
+def parse_mac(mac):
+    return tuple(int(b, 16) for b in mac.split(':'))
+
+
+class SimulatedESP(object):
+    """ Protocol state machine of a simulated chip
+
+    handle() takes one decoded SLIP frame sent by the host and returns the
+    list of frames the device sends back. Flash is an in-memory image.
+    """
+    def __init__(self, chip='esp8266', flash_size='4MB', mac='18:fe:34:00:00:01', image=None):
+        self.chip = chip
+        self.rom = CHIPS[chip]
+        self.flash = bytearray(b'\xff' * flash_size_bytes(flash_size))
+        if image:
+            self.flash[:len(image)] = image
+        self.size_id = {v: k for k, v in DETECTED_FLASH_SIZES.items()}[flash_size]
+        self.mac = parse_mac(mac)
+        self.baud = ESPLoader.ESP_ROM_BAUD
+        self.regs = {}
+        self.reset()
+
+        self._handlers = {
+            ESPLoader.ESP_SYNC: self._sync,
+            ESPLoader.ESP_READ_REG: self._read_reg,
+            ESPLoader.ESP_WRITE_REG: self._write_reg,
+            ESPLoader.ESP_MEM_BEGIN: self._mem_begin,
+            ESPLoader.ESP_MEM_DATA: self._mem_data,
+            ESPLoader.ESP_MEM_END: self._mem_end,
+            ESPLoader.ESP_FLASH_BEGIN: self._flash_begin,
+            ESPLoader.ESP_FLASH_DATA: self._flash_data,
+            ESPLoader.ESP_FLASH_ENCRYPT_DATA: self._flash_data,
+            ESPLoader.ESP_FLASH_END: self._flash_end,
+            ESPLoader.ESP_FLASH_DEFL_BEGIN: self._flash_begin,
+            ESPLoader.ESP_FLASH_DEFL_DATA: self._flash_defl_data,
+            ESPLoader.ESP_FLASH_DEFL_END: self._flash_end,
+            ESPLoader.ESP_SPI_FLASH_MD5: self._flash_md5,
+            ESPLoader.ESP_SPI_SET_PARAMS: self._ok,
+            ESPLoader.ESP_SPI_ATTACH: self._ok,
+            ESPLoader.ESP_CHANGE_BAUDRATE: self._change_baud,
+            ESPLoader.ESP_ERASE_FLASH: self._erase_flash,
+            ESPLoader.ESP_ERASE_REGION: self._erase_region,
+            ESPLoader.ESP_READ_FLASH: self._read_flash,
+            ESPLoader.ESP_RUN_USER_CODE: self._run_user_code,
+        }
+
+    def reset(self):
+        """ Reset into the ROM loader """
+        self.stub = False
+        self.ram_download = None
+        self.flash_write = None
+        self.flash_read = None
+
+    @property
+    def status_length(self):
+        return 4 if self.chip == 'esp32' and not self.stub else 2
+
+    def response(self, op, val=0, data=b'', error=0):
+        status = bytes([1 if error else 0, error]) + b'\x00' * (self.status_length - 2)
+        body = data + status
+        return struct.pack('<BBHI', 1, op, len(body), val) + body
+
+    def handle(self, frame):
+        if self.flash_read is not None and len(frame) == 4:
+            return self._read_flash_ack(frame)
+        if len(frame) < 8 or frame[0] != 0:
+            return []  # not a command, the real loaders ignore these too
+        _, op, size, chk = struct.unpack('<BBHI', frame[:8])
+        data = frame[8:8 + size]
+        handler = self._handlers.get(op)
+        if handler is None or (not self.stub and (op in STUB_ONLY or (self.chip == 'esp8266' and op in ESP8266_STUB_ONLY))):
+            return [self.response(op, error=ERR_INVALID_MESSAGE)]
+        return handler(op, data, chk)
+
+    # registers
+
+    def read_register(self, addr):
+        rom = self.rom
+        if addr == ESPLoader.UART_DATA_REG_ADDR:
+            return rom.DATE_REG_VALUE
+        if addr == rom.UART_CLKDIV_REG:
+            return int(XTAL_MHZ[self.chip] * 1e6 * rom.XTAL_CLK_DIVIDER / self.baud)
+        mac = self.mac
+        if self.chip == 'esp8266':
+            otp = {
+                rom.ESP_OTP_MAC0: mac[5] << 24,
+                rom.ESP_OTP_MAC1: (mac[3] << 8) | mac[4],
+                rom.ESP_OTP_MAC3: (mac[0] << 16) | (mac[1] << 8) | mac[2],
+            }
+        else:
+            otp = {
+                rom.EFUSE_REG_BASE + 4: (mac[2] << 24) | (mac[3] << 16) | (mac[4] << 8) | mac[5],
+                rom.EFUSE_REG_BASE + 8: (mac[0] << 8) | mac[1],
+            }
+        if addr in otp:
+            return otp[addr]
+        return self.regs.get(addr, 0)
+
+    def write_register(self, addr, value, mask=0xFFFFFFFF):
+        self.regs[addr] = (self.regs.get(addr, 0) & ~mask) | (value & mask)
+        base = self.rom.SPI_REG_BASE
+        if addr == base and value & SPI_CMD_USR:
+            # run the "user" SPI flash command set up in SPI_USR2_REG, results go to W0
+            command = self.regs.get(base + 0x24, 0) & 0xFF
+            result = 0
+            if command == SPIFLASH_RDID:
+                result = SPIFLASH_MANUFACTURER | (SPIFLASH_DEVICE << 8) | (self.size_id << 16)
+            self.regs[base + self.rom.SPI_W0_OFFS] = result
+            self.regs[base] = value & ~SPI_CMD_USR
+
+    # command handlers
+
+    def _ok(self, op, data, chk):
+        return [self.response(op)]
+
+    def _sync(self, op, data, chk):
+        # a sync always finds the ROM loader, as if the board had just been reset into it
+        self.reset()
+        return [self.response(op)] * 8
+
+    def _read_reg(self, op, data, chk):
+        addr, = struct.unpack('<I', data[:4])
+        return [self.response(op, val=self.read_register(addr))]
+
+    def _write_reg(self, op, data, chk):
+        addr, value, mask, _ = struct.unpack('<IIII', data[:16])
+        self.write_register(addr, value, mask)
+        return [self.response(op)]
+
+    def _mem_begin(self, op, data, chk):
+        size, blocks, blocksize, offset = struct.unpack('<IIII', data[:16])
+        self.ram_download = {'size': size, 'received': 0, 'seq': 0}
+        return [self.response(op)]
+
+    def _mem_data(self, op, data, chk):
+        length, seq, _, _ = struct.unpack('<IIII', data[:16])
+        block = data[16:16 + length]
+        if self.ram_download is None or seq != self.ram_download['seq']:
+            return [self.response(op, error=ERR_BAD_SEQUENCE)]
+        if ESPLoader.checksum(block) != chk:
+            return [self.response(op, error=ERR_BAD_DATA_CHECKSUM)]
+        self.ram_download['seq'] += 1
+        self.ram_download['received'] += len(block)
+        return [self.response(op)]
+
+    def _mem_end(self, op, data, chk):
+        no_entry, entry = struct.unpack('<II', data[:8])
+        frames = [self.response(op)]
+        if not self.stub and not no_entry and self.ram_download is not None:
+            # treat whatever was uploaded as the flasher stub and start it
+            self.stub = True
+            frames.append(b'OHAI')
+        self.ram_download = None
+        return frames
+
+    def _erase(self, offset, size):
+        sector = ESPLoader.FLASH_SECTOR_SIZE
+        start = offset - offset % sector
+        end = min(len(self.flash), (offset + size + sector - 1) // sector * sector)
+        self.flash[start:end] = b'\xff' * (end - start)
+
+    def _flash_begin(self, op, data, chk):
+        size, blocks, blocksize, offset = struct.unpack('<IIII', data[:16])
+        if offset + min(size, blocks * blocksize) > len(self.flash):
+            return [self.response(op, error=ERR_INVALID_MESSAGE)]
+        self._erase(offset, blocks * blocksize if op == ESPLoader.ESP_FLASH_BEGIN else size)
+        self.flash_write = {
+            'offset': offset,
+            'pos': offset,
+            'seq': 0,
+            'inflater': zlib.decompressobj() if op == ESPLoader.ESP_FLASH_DEFL_BEGIN else None,
+        }
+        return [self.response(op)]
+
+    def _write_block(self, op, data, chk, decompress):
+        length, seq, _, _ = struct.unpack('<IIII', data[:16])
+        block = data[16:16 + length]
+        state = self.flash_write
+        if state is None or seq != state['seq'] or decompress != (state['inflater'] is not None):
+            return [self.response(op, error=ERR_BAD_SEQUENCE)]
+        if ESPLoader.checksum(block) != chk:
+            return [self.response(op, error=ERR_BAD_DATA_CHECKSUM)]
+        if decompress:
+            block = state['inflater'].decompress(block)
+        pos = state['pos']
+        block = block[:len(self.flash) - pos]
+        self.flash[pos:pos + len(block)] = block
+        state['pos'] += len(block)
+        state['seq'] += 1
+        return [self.response(op)]
+
+    def _flash_data(self, op, data, chk):
+        return self._write_block(op, data, chk, decompress=False)
+
+    def _flash_defl_data(self, op, data, chk):
+        return self._write_block(op, data, chk, decompress=True)
+
+    def _flash_end(self, op, data, chk):
+        stay_in_loader, = struct.unpack('<I', data[:4])
+        self.flash_write = None
+        frames = [self.response(op)]
+        if not stay_in_loader:
+            self.reset()  # leaves the loader and runs the application
+        return frames
+
+    def _flash_md5(self, op, data, chk):
+        addr, size, _, _ = struct.unpack('<IIII', data[:16])
+        digest = hashlib.md5(self.flash[addr:addr + size])
+        if self.stub:
+            return [self.response(op, data=digest.digest())]
+        return [self.response(op, data=digest.hexdigest().encode())]
+
+    def _change_baud(self, op, data, chk):
+        new_baud, _ = struct.unpack('<II', data[:8])
+        frames = [self.response(op)]
+        self.baud = new_baud
+        return frames
+
+    def _erase_flash(self, op, data, chk):
+        self._erase(0, len(self.flash))
+        return [self.response(op)]
+
+    def _erase_region(self, op, data, chk):
+        offset, size = struct.unpack('<II', data[:8])
+        if offset % ESPLoader.FLASH_SECTOR_SIZE or size % ESPLoader.FLASH_SECTOR_SIZE:
+            return [self.response(op, error=ERR_INVALID_MESSAGE)]
+        self._erase(offset, size)
+        return [self.response(op)]
+
+    def _read_flash(self, op, data, chk):
+        offset, length, block_size, max_in_flight = struct.unpack('<IIII', data[:16])
+        self.flash_read = {
+            'data': bytes(self.flash[offset:offset + length]),
+            'block_size': block_size,
+            'max_in_flight': max_in_flight,
+            'sent': 0,
+            'acked': 0,
+        }
+        return [self.response(op)] + self._read_flash_send()
+
+    def _read_flash_send(self):
+        state = self.flash_read
+        frames = []
+        while state['sent'] < len(state['data']) and \
+                state['sent'] - state['acked'] < state['max_in_flight'] * state['block_size']:
+            frames.append(state['data'][state['sent']:state['sent'] + state['block_size']])
+            state['sent'] += len(frames[-1])
+        return frames
+
+    def _read_flash_ack(self, frame):
+        state = self.flash_read
+        state['acked'], = struct.unpack('<I', frame)
+        if state['acked'] >= len(state['data']):
+            self.flash_read = None
+            return [hashlib.md5(state['data']).digest()]
+        return self._read_flash_send()
+
+    def _run_user_code(self, op, data, chk):
+        self.reset()
+        return []
+
+
+class SimulatorLink(object):
+    """ Serves a SimulatedESP over a pty or TCP connection
+
+    Link timing is modelled with a virtual clock: every frame takes 10 bits
+    per byte at the current baud rate on the wire in each direction, and
+    responses are delivered 'latency' seconds after the request was fully
+    received (e.g. 0.016 for the default FTDI latency timer). Set 'throttle'
+    to False to run as fast as possible. Replies sent above 'max_baud' are
+    garbled, like those of an adapter or cable which can't keep up.
+    """
+    def __init__(self, device, latency=0.0, throttle=True, max_baud=None):
+        self.device = device
+        self.latency = latency
+        self.throttle = throttle
+        self.max_baud = max_baud
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _wire_time(self, length):
+        return length * 10.0 / self.device.baud if self.throttle else 0.0
+
+    @staticmethod
+    def _sleep_until(deadline):
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    @staticmethod
+    def encode(frame):
+        return b'\xc0' + frame.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+    def serve(self, read_fn, write_fn):
+        """ Process frames from read_fn() until it returns b'' or stop() is called """
+        outbox = queue.Queue()
+
+        def send():
+            while True:
+                item = outbox.get()
+                if item is None:
+                    return
+                deliver_at, data = item
+                self._sleep_until(deliver_at)
+                write_fn(data)
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+
+        rx_clock = tx_clock = 0.0
+        buf = b''
+        try:
+            while not self._stopped.is_set():
+                data = read_fn()
+                if not data:
+                    return
+                buf += data
+                *frames, buf = buf.split(b'\xc0')
+                for raw in frames:
+                    if not raw:
+                        continue
+                    # request fully received once its bytes have crossed the wire
+                    rx_clock = max(rx_clock, time.monotonic()) + self._wire_time(len(raw) + 2)
+                    frame = raw.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+                    baud = self.device.baud  # replies go out at the rate in use when the request arrived
+                    with self._lock:
+                        replies = self.device.handle(frame)
+                    # each reply frame is delivered once it has crossed the wire, a long
+                    # read_flash answer mustn't hold back the response before it
+                    tx_clock = max(tx_clock, rx_clock + self.latency)
+                    for reply in replies:
+                        out = self.encode(reply)
+                        if self.max_baud and baud > self.max_baud:
+                            out = bytes(b ^ 0x55 for b in out)
+                        tx_clock += len(out) * 10.0 / baud if self.throttle else 0.0
+                        outbox.put((tx_clock, out))
+        finally:
+            outbox.put(None)
+            sender.join()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _fd_reader(self, fd):
+        def read():
+            while not self._stopped.is_set():
+                ready, _, _ = select.select([fd], [], [], 0.1)
+                if ready:
+                    try:
+                        return os.read(fd, 0x10000)
+                    except OSError:
+                        return b''
+            return b''
+        return read
+
+    def serve_pty(self):
+        """ Open a pty and serve it from a background thread, returns the device path for --port """
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        path = os.ttyname(slave)
+
+        def run():
+            try:
+                self.serve(self._fd_reader(master), lambda data: os.write(master, data))
+            finally:
+                os.close(master)
+                os.close(slave)
+        threading.Thread(target=run, daemon=True).start()
+        return path
+
+    def serve_tcp(self, port=0, host='localhost'):
+        """ Listen on TCP and serve connections one at a time, returns the 'socket://' URL """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(1)
+        url = 'socket://%s:%d' % server.getsockname()[:2]
+
+        def run():
+            with server:
+                while not self._stopped.is_set():
+                    ready, _, _ = select.select([server], [], [], 0.1)
+                    if not ready:
+                        continue
+                    conn, _ = server.accept()
+                    with conn:
+                        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        with self._lock:
+                            self.device.reset()
+                            self.device.baud = ESPLoader.ESP_ROM_BAUD
+                        self.serve(self._fd_reader(conn.fileno()), conn.sendall)
+        threading.Thread(target=run, daemon=True).start()
+        return url
+
+
+def main(custom_commandline=None):
+    parser = argparse.ArgumentParser(description='Simulated ESP8266/ESP32 bootloader for hardware-free flashing tests',
+                                     prog='tasmotizer_simulator')
+    parser.add_argument('--chip', '-c', choices=sorted(CHIPS), default='esp8266')
+    parser.add_argument('--flash-size', '-fs', choices=list(DETECTED_FLASH_SIZES.values()), default='4MB')
+    parser.add_argument('--mac', help='MAC address reported by the device', default='18:fe:34:00:00:01')
+    parser.add_argument('--image', help='Initial flash contents', type=argparse.FileType('rb'))
+    parser.add_argument('--latency', help='Response latency in seconds (USB adapter latency timer)', type=float, default=0.0)
+    parser.add_argument('--no-throttle', help='Do not emulate the serial link speed', action='store_true')
+    parser.add_argument('--max-baud', help='Garble replies sent faster than this baud rate', type=arg_auto_int)
+    parser.add_argument('--tcp', help='Serve on this TCP port instead of a pty (0 picks a free port)', type=arg_auto_int)
+    args = parser.parse_args(custom_commandline)
+
+    image = args.image.read() if args.image else None
+    device = SimulatedESP(args.chip, args.flash_size, args.mac, image)
+    link = SimulatorLink(device, args.latency, throttle=not args.no_throttle, max_baud=args.max_baud)
+
+    if args.tcp is not None:
+        port = link.serve_tcp(args.tcp)
+    else:
+        port = link.serve_pty()
+        print('pty has no reset lines, use --before no_reset with tasmotizer_esptool')
+    print('Simulated %s with %s flash on %s' % (device.rom.CHIP_NAME, args.flash_size, port))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        link.stop()
+
+
+if __name__ == '__main__':
+    main()
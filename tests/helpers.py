@@ -0,0 +1,98 @@
+""" Simulated devices (see tasmotizer_simulator), serial port stand-ins and SLIP helpers
+shared by the tests and benchmarks
+"""
+import contextlib
+import io
+import struct
+
+import tasmotizer_esptool as esptool
+from tasmotizer_simulator import SimulatedESP, SimulatorLink
+
+
+def slip_encode(frame):
+    """ 'frame' SLIP encoded, as the ROM and the stub send it """
+    return b'\xc0' + frame.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+@contextlib.contextmanager
+def simulated_devices(chips, flash_size='4MB', latency=0.0, throttle=False, image=None):
+    """ Serve a SimulatedESP for every chip name in 'chips' over TCP
+
+    Yields a list of (device, 'socket://' URL) pairs, every device with its own MAC.
+    The link speed isn't emulated unless 'throttle' is set.
+    """
+    links = []
+    try:
+        for i, chip in enumerate(chips):
+            device = SimulatedESP(chip, flash_size, '18:fe:34:00:%02x:%02x' % (i >> 8, i & 0xff), image)
+            links.append(SimulatorLink(device, latency, throttle))
+        yield [(link.device, link.serve_tcp(0)) for link in links]
+    finally:
+        for link in links:
+            link.stop()
+
+
+def flaky_blocks(dev, fault):
+    """ Let 'fault(seq, handle, frame)' answer the first flash data block of every seq instead of 'dev' """
+    handle = dev.handle
+    seen = set()
+
+    def handle_block(frame):
+        if len(frame) >= 16 and frame[1] in (esptool.ESPLoader.ESP_FLASH_DATA, esptool.ESPLoader.ESP_FLASH_DEFL_DATA):
+            seq = struct.unpack('<I', frame[12:16])[0]
+            if seq not in seen:
+                seen.add(seq)
+                return fault(seq, handle, frame)
+        return handle(frame)
+    dev.handle = handle_block
+
+
+def run_esptool(*args):
+    """ Run tasmotizer_esptool.main() with the command line 'args', returns what it printed """
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        esptool.main(list(args))
+    return out.getvalue()
+
+
+class ChunkPort(object):
+    """ Serial port stand-in delivering 'chunks' one read at a time, then timing out """
+    def __init__(self, chunks):
+        self._chunks = list(chunks)
+        self._next = 0
+
+    def inWaiting(self):
+        return len(self._chunks[self._next]) if self._next < len(self._chunks) else 0
+
+    def read(self, size=1):
+        if self._next >= len(self._chunks):
+            return b''
+        chunk = self._chunks[self._next]
+        self._next += 1
+        return chunk
+
+
+def slip_decode(reader, chunks):
+    """ Packets slip_reader() function 'reader' yields for 'chunks', and the error message it ends with """
+    packets = []
+    try:
+        for packet in reader(ChunkPort(chunks), lambda *args: None):
+            packets.append(bytes(packet))
+    except esptool.FatalError as e:
+        return packets, str(e)
+
+
+class NullPort(object):
+    """ Serial port stand-in for an ESPLoader which keeps what is written to it, or only counts it """
+    def __init__(self, keep=True):
+        self.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+        self.timeout = None
+        self.write_timeout = None
+        self.written = bytearray() if keep else None
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.written is not None:
+            self.written += data
+        return len(data)
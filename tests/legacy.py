@@ -0,0 +1,95 @@
+""" The implementations the faster ones in tasmotizer_esptool replaced, as they were
+
+The tests check the new code returns the same results and raises the same errors,
+the benchmarks compare their speed.
+"""
+import struct
+
+from tasmotizer_esptool import DEFAULT_TIMEOUT, MAX_TIMEOUT, ESPLoader, FatalError, HexFormatter, hexify
+
+
+def slip_reader(port, trace_function):
+    """ slip_reader() decoding one byte at a time """
+    partial_packet = None
+    in_escape = False
+    while True:
+        waiting = port.inWaiting()
+        read_bytes = port.read(1 if waiting == 0 else waiting)
+        if read_bytes == b'':
+            waiting_for = "header" if partial_packet is None else "content"
+            trace_function("Timed out waiting for packet %s", waiting_for)
+            raise FatalError("Timed out waiting for packet %s" % waiting_for)
+        trace_function("Read %d bytes: %s", len(read_bytes), HexFormatter(read_bytes))
+        for b in read_bytes:
+            if type(b) is int:
+                b = bytes([b])  # python 2/3 compat
+
+            if partial_packet is None:  # waiting for packet header
+                if b == b'\xc0':
+                    partial_packet = b""
+                else:
+                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
+                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
+                    raise FatalError('Invalid head of packet (0x%s)' % hexify(b))
+            elif in_escape:  # part-way through escape sequence
+                in_escape = False
+                if b == b'\xdc':
+                    partial_packet += b'\xc0'
+                elif b == b'\xdd':
+                    partial_packet += b'\xdb'
+                else:
+                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
+                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
+                    raise FatalError('Invalid SLIP escape (0xdb, 0x%s)' % (hexify(b)))
+            elif b == b'\xdb':  # start of escape sequence
+                in_escape = True
+            elif b == b'\xc0':  # end of packet
+                trace_function("Received full packet: %s", HexFormatter(partial_packet))
+                yield partial_packet
+                partial_packet = None
+            else:  # normal byte in packet
+                partial_packet += b
+
+
+def command_frame(op, data, chk):
+    """ The SLIP frame command() and write() built for a request, concatenating its parts """
+    pkt = struct.pack(b'<BBHI', 0x00, op, len(data), chk) + data
+    return b'\xc0' + (pkt.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc')) + b'\xc0'
+
+
+def send_command(port, trace_function, op, data, chk, timeout=DEFAULT_TIMEOUT):
+    """ ESPLoader.command() with wait_response=False, followed by ESPLoader.write() """
+    saved_timeout = port.timeout
+    new_timeout = min(timeout, MAX_TIMEOUT)
+    if new_timeout != saved_timeout:
+        port.timeout = new_timeout
+    try:
+        trace_function("command op=0x%02x data len=%s wait_response=%d timeout=%.3f data=%s",
+                       op, len(data), 0, timeout, HexFormatter(data))
+        buf = command_frame(op, data, chk)
+        trace_function("Write %d bytes: %s", len(buf), HexFormatter(buf))
+        port.write(buf)
+    finally:
+        if new_timeout != saved_timeout:
+            port.timeout = saved_timeout
+
+
+def checksum(data, state=ESPLoader.ESP_CHECKSUM_MAGIC):
+    """ ESPLoader.checksum() XORing one byte at a time """
+    for b in data:
+        if type(b) is int:  # python 2/3 compat
+            state ^= b
+        else:
+            state ^= ord(b)
+
+    return state
+
+
+def iter_blocks(image, block_size, pad_character=None):
+    """ The blocks of the write_flash loop, which cut every block off the front of the image """
+    while len(image) > 0:
+        block = image[0:block_size]
+        if pad_character is not None:
+            block = block + pad_character * (block_size - len(block))
+        yield block
+        image = image[block_size:]
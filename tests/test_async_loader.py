@@ -0,0 +1,55 @@
+import asyncio
+import os
+import socket
+
+import tasmotizer_esptool as esptool
+from tasmotizer_simulator import ERR_BAD_DATA_CHECKSUM
+from tests.helpers import flaky_blocks, simulated_devices
+
+
+def test_write_flash_ports():
+    image = os.urandom(0x20000) + b'\xff' * 0x10000
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        refused = 'socket://127.0.0.1:%d' % s.getsockname()[1]
+    with simulated_devices(['esp8266', 'esp32']) as devices:
+        ports = [url for _, url in devices] + [refused]
+        results = esptool.write_flash_ports(ports, 0x1000, image, 921600)
+        for device, url in devices:
+            assert results[url] is None
+            assert bytes(device.flash[0x1000:0x1000 + len(image)]) == image
+    assert isinstance(results[refused], (esptool.FatalError, OSError))
+
+
+def test_write_flash_ports_resends_rejected_block():
+    image = os.urandom(0x30000)
+    with simulated_devices(['esp8266', 'esp32']) as devices:
+        for device, _ in devices:
+            flaky_blocks(device, lambda seq, handle, frame, device=device:
+                         [device.response(frame[1], error=ERR_BAD_DATA_CHECKSUM)] if seq == 3 else handle(frame))
+        results = esptool.write_flash_ports([url for _, url in devices], 0, image, 921600)
+        for device, url in devices:
+            assert results[url] is None
+            assert bytes(device.flash[:len(image)]) == image
+
+
+def test_read_flash():
+    with simulated_devices(['esp8266', 'esp32']) as devices:
+        for device, url in devices:
+            device.flash[0x3000:0x13001] = os.urandom(0x10001)
+
+            async def read():
+                esp = esptool.AsyncESPLoader(url)
+                try:
+                    await esp.connect()
+                    await esp.detect_chip()
+                    await esp.run_stub()
+                    return await esp.read_flash(0x3000, 0x10001)
+                finally:
+                    await esp.close()
+
+            loop = asyncio.new_event_loop()
+            try:
+                assert loop.run_until_complete(read()) == bytes(device.flash[0x3000:0x13001])
+            finally:
+                loop.close()
@@ -0,0 +1,15 @@
+import os
+
+import pytest
+
+from tasmotizer_esptool import iter_blocks
+from tests import legacy
+
+
+@pytest.mark.parametrize('pad_character', [None, b'\xff'])
+def test_blocks_match_legacy(pad_character):
+    for length in (0, 1, 0x3ff, 0x400, 0x401, 0x4000 + 7):
+        image = os.urandom(length)
+        for block_size in (0x400, 0x4000):
+            blocks = [bytes(block) for block in iter_blocks(image, block_size, pad_character)]
+            assert blocks == list(legacy.iter_blocks(image, block_size, pad_character))
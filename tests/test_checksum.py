@@ -0,0 +1,27 @@
+import os
+import random
+
+from tasmotizer_esptool import ESPLoader
+from tests import legacy
+
+
+def test_short_buffers():
+    for length in range(0, 200):
+        data = os.urandom(length)
+        assert ESPLoader.checksum(data) == legacy.checksum(data)
+
+
+def test_random_buffers_and_states():
+    rng = random.Random(6)
+    for _ in range(300):
+        data = os.urandom(rng.randint(0, 0x5000))
+        state = rng.randint(0, 0xff)
+        assert ESPLoader.checksum(data, state) == legacy.checksum(data, state)
+
+
+def test_buffer_types():
+    data = os.urandom(0x1801)
+    expected = legacy.checksum(data)
+    assert ESPLoader.checksum(bytearray(data)) == expected
+    assert ESPLoader.checksum(memoryview(data)[1:]) == legacy.checksum(data[1:])
+    assert ESPLoader.checksum(b'\xff' * 0x4000) == legacy.checksum(b'\xff' * 0x4000)
@@ -0,0 +1,13 @@
+import os
+
+from tasmotizer_esptool import choose_compress_level
+
+
+def test_empty_data():
+    assert choose_compress_level(b'', 11520, True) == (9, {9: (1.0, 0.0)})
+
+
+def test_levels_projected():
+    level, projections = choose_compress_level(os.urandom(0x8000) + b'\xff' * 0x8000, 11520, False)
+    assert sorted(projections) == list(range(1, 10))
+    assert projections[level][1] == min(total for ratio, total in projections.values())
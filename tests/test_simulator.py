@@ -0,0 +1,226 @@
+import contextlib
+import hashlib
+import io
+import os
+import threading
+import time
+
+import pytest
+from PyQt5.QtCore import Qt
+
+import tasmotizer_esptool as esptool
+from tasmotizer_simulator import ERR_BAD_DATA_CHECKSUM
+from tests.helpers import flaky_blocks, simulated_devices, run_esptool
+
+
+@pytest.fixture(params=['esp8266', 'esp32'])
+def device(request):
+    with simulated_devices([request.param]) as devices:
+        yield request.param, devices[0]
+
+
+def test_write_read_verify(device, tmp_path):
+    chip, (dev, url) = device
+    image = os.urandom(0x30000) + b'\xff' * 0x20000 + os.urandom(0x10001)
+    image_file = tmp_path / 'image.bin'
+    image_file.write_bytes(image)
+    backup_file = tmp_path / 'backup.bin'
+    common = ['--chip', chip, '--port', url, '--baud', '921600']
+
+    assert 'Hash of data verified.' in run_esptool(*common, 'write_flash', '0x1000', str(image_file))
+    padded = esptool.pad_to(image, 4)
+    assert bytes(dev.flash[0x1000:0x1000 + len(padded)]) == padded
+
+    run_esptool(*common, 'read_flash', '0x1000', str(len(image)), str(backup_file))
+    assert backup_file.read_bytes() == image
+
+    assert '-- verify OK' in run_esptool(*common, 'verify_flash', '0x1000', str(image_file))
+    dev.flash[0x1000 + 0x12345] ^= 0x01
+    with pytest.raises(esptool.FatalError):
+        run_esptool(*common, 'verify_flash', '0x1000', str(image_file))
+
+
+@pytest.mark.parametrize('compress', ['--compress', '--no-compress'])
+def test_pipelined_write_resends_rejected_block(tmp_path, compress):
+    with simulated_devices(['esp8266']) as devices:
+        dev, url = devices[0]
+        flaky_blocks(dev, lambda seq, handle, frame: [dev.response(frame[1], error=ERR_BAD_DATA_CHECKSUM)] if seq == 3
+                     else handle(frame))
+        image = os.urandom(0x30000)
+        image_file = tmp_path / 'image.bin'
+        image_file.write_bytes(image)
+        output = run_esptool('--port', url, '--baud', '921600', 'write_flash', '--pipeline-window', '2', compress,
+                             '0', str(image_file))
+        assert 'sending the blocks from 3 on again' in output
+        assert 'Hash of data verified.' in output
+        assert bytes(dev.flash[:len(image)]) == image
+
+
+def test_pipelined_write_waits_for_late_response(tmp_path, monkeypatch):
+    monkeypatch.setattr(esptool.FlashWritePipeline, 'RESPONSE_TIMEOUT', 0.05)
+    with simulated_devices(['esp8266']) as devices:
+        dev, url = devices[0]
+
+        def late(seq, handle, frame):
+            if seq == 3:
+                time.sleep(0.5)
+            return handle(frame)
+        flaky_blocks(dev, late)
+        image = os.urandom(0x30000)
+        image_file = tmp_path / 'image.bin'
+        image_file.write_bytes(image)
+        output = run_esptool('--port', url, '--baud', '921600', 'write_flash', '--pipeline-window', '2', '0', str(image_file))
+        assert 'while waiting for block 3, continuing in lock-step' in output
+        assert 'again' not in output
+        assert bytes(dev.flash[:len(image)]) == image
+
+
+def test_read_flash_removes_stale_checkpoints(tmp_path):
+    with simulated_devices(['esp8266']) as devices:
+        dev, url = devices[0]
+        stale = tmp_path / '.read_flash_18fe34000000_0_100000.part'
+        other_device = tmp_path / '.read_flash_18fe34000001_0_100000.part'
+        for checkpoint in (stale, other_device):
+            checkpoint.write_bytes(b'\xff' * 0x1000)
+        run_esptool('--port', url, '--baud', '921600', 'read_flash', '--resume', '0', '0x10000', str(tmp_path / 'backup.bin'))
+        assert (tmp_path / 'backup.bin').read_bytes() == bytes(dev.flash[:0x10000])
+    assert not stale.exists()
+    assert other_device.exists()
+
+
+def test_sessions_are_independent(tmp_path):
+    """ Cancelling the session of one of two concurrent reads stops only that read """
+    sessions = [esptool.Session(), esptool.Session()]
+    progress = [[], []]
+    for i, session in enumerate(sessions):
+        session.progress.connect(lambda action, value, i=i: progress[i].append(action), Qt.DirectConnection)
+    sessions[0].progress.connect(lambda action, value: sessions[0].setContinueFlag(False), Qt.DirectConnection)
+    errors = [None, None]
+
+    with simulated_devices(['esp8266', 'esp32']) as devices:
+        def read(i):
+            try:
+                esptool.main(['--port', devices[i][1], '--baud', '921600', 'read_flash', '0', '0x40000',
+                              str(tmp_path / ('%d.bin' % i))], session=sessions[i])
+            except esptool.FatalError as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=read, args=(i,)) for i in range(2)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert (tmp_path / '1.bin').read_bytes() == bytes(devices[1][0].flash[:0x40000])
+
+    assert isinstance(errors[0], esptool.FatalError) and errors[1] is None
+    assert not (tmp_path / '0.bin').exists()
+    assert progress[0] and len(progress[1]) > len(progress[0])
+    assert esptool.sw.continueFlag()
+
+
+def test_diff_flash_checks_hash_cache(tmp_path):
+    image = bytearray(os.urandom(0x20000))
+    image_file = tmp_path / 'image.bin'
+    with simulated_devices(['esp8266']) as devices:
+        dev, url = devices[0]
+        common = ['--port', url, '--baud', '921600', '--hash-cache', str(tmp_path / 'hashes.json'),
+                  'write_flash', '--diff-flash', '0', str(image_file)]
+
+        def write():
+            image_file.write_bytes(image)
+            output = run_esptool(*common)
+            assert bytes(dev.flash[:len(image)]) == image
+            return output
+
+        write()
+        image[0x3000] ^= 0x01
+        assert 'Planned from cached sector hashes' in write()
+
+        dev.flash[0x5000] ^= 0x01  # behind the cache's back
+        image[0x10000] ^= 0x01
+        output = write()
+        assert 'does not match the cached hashes' in output
+        assert 'Planned from cached sector hashes' not in output
+
+
+class HashingFlash(object):
+    """ Answers flash_md5sum from a bytearray and counts the hashes """
+    FLASH_SECTOR_SIZE = 0x1000
+
+    def __init__(self, flash):
+        self.flash = flash
+        self.hashes = 0
+
+    def flash_md5sum(self, addr, size):
+        self.hashes += 1
+        return hashlib.md5(self.flash[addr:addr + size]).hexdigest()
+
+
+def test_changed_ranges_hashes_sectors_of_few_changed_regions():
+    image = os.urandom(0x40000)
+    esp = HashingFlash(bytearray(image))
+    esp.flash[0x12345] ^= 0x01
+    assert esptool._changed_ranges(esp, 0, image) == [(0x12000, 0x1000)]
+    assert esp.hashes == 4 + 16
+
+
+def test_changed_ranges_skips_sectors_when_most_regions_differ():
+    image = os.urandom(0x40000)
+    esp = HashingFlash(bytearray(image))
+    for region in (0x00000, 0x10000, 0x30000):
+        esp.flash[region + 0x10] ^= 0x01
+    assert esptool._changed_ranges(esp, 0, image) == [(0x00000, 0x20000), (0x30000, 0x10000)]
+    assert esp.hashes == 4
+
+
+def test_verify_archive(device, tmp_path):
+    chip, (dev, url) = device
+    image = os.urandom(0x18000) + b'\xff' * 0x20000 + os.urandom(0x8001)
+    dev.flash[0x10000:0x10000 + len(image)] = image
+    archive_file = tmp_path / 'backup.tzb'
+    common = ['--chip', chip, '--port', url, '--baud', '921600']
+
+    run_esptool(*common, 'read_flash', '0x10000', str(len(image)), str(archive_file), '--archive')
+    assert '-- verify OK' in run_esptool(*common, 'verify_flash', '0x10000', str(archive_file))
+
+    dev.flash[0x10000 + 0x12345] ^= 0x01
+    with pytest.raises(esptool.FatalError):
+        run_esptool(*common, 'verify_flash', '0x10000', str(archive_file))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), pytest.raises(esptool.FatalError):
+        esptool.main(common + ['verify_flash', '--diff', 'yes', '0x10000', str(archive_file)])
+    assert '1 differences in 1 ranges, first @ 0x00022345' in output.getvalue()
+
+
+def test_restore_archive(device, tmp_path):
+    chip, (dev, url) = device
+    image = os.urandom(0x18000) + b'\xff' * 0x20000 + os.urandom(0x8001)
+    dev.flash[0x10000:0x10000 + len(image)] = image
+    archive_file = tmp_path / 'backup.tzb'
+    common = ['--chip', chip, '--port', url, '--baud', '921600']
+    run_esptool(*common, 'read_flash', '0x10000', str(len(image)), str(archive_file), '--archive')
+
+    transfers = []
+    handle = dev.handle
+
+    def count_transfers(frame):
+        begin = len(frame) >= 24 and frame[0] == 0 and frame[1] in (esptool.ESPLoader.ESP_FLASH_BEGIN,
+                                                                    esptool.ESPLoader.ESP_FLASH_DEFL_BEGIN)
+        if begin and frame[8:12] != bytes(4):  # write_flash ends with an empty flash_begin
+            transfers.append(frame[1])
+        return handle(frame)
+    dev.handle = count_transfers
+
+    dev.flash[0x10000:0x10000 + len(image)] = os.urandom(len(image))
+    assert 'Hash of data verified.' in run_esptool(*common, 'write_flash', '0x10000', str(archive_file))
+    assert bytes(dev.flash[0x10000:0x10000 + len(image)]) == image
+    # the blocks before and after the one of 0xFF, which is erased
+    assert len(transfers) == 2
+
+    del transfers[:]
+    dev.flash[0x10000 + 0x3fff0] ^= 0x01
+    output = run_esptool(*common, 'write_flash', '--diff-flash', '0x10000', str(archive_file))
+    assert 'skipped %d bytes' % (len(image) - 0x10000) in output
+    assert bytes(dev.flash[0x10000:0x10000 + len(image)]) == image
+    assert len(transfers) == 1
@@ -0,0 +1,223 @@
+import asyncio
+import os
+import random
+import socket
+import struct
+
+import pytest
+
+import tasmotizer_esptool as esptool
+from tests import legacy
+from tests.helpers import NullPort, slip_decode, slip_encode
+
+
+def split(data, rng, max_chunk=64):
+    """ 'data' cut into chunks of random length, as reads from a serial port return it """
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        n = rng.randint(1, max_chunk)
+        chunks.append(data[pos:pos + n])
+        pos += n
+    return chunks
+
+
+def check_same(chunks):
+    expected = slip_decode(legacy.slip_reader, chunks)
+    assert slip_decode(esptool.slip_reader, chunks) == expected
+    return expected
+
+
+def test_random_frames():
+    rng = random.Random(1)
+    for _ in range(200):
+        # bias the payload towards the bytes SLIP has to escape
+        frames = [bytes(rng.choice(b'\xc0\xdb\xdc\xdd\x00\x55') for _ in range(rng.randint(0, 40)))
+                  for _ in range(rng.randint(1, 5))]
+        stream = b''.join(slip_encode(frame) for frame in frames)
+        packets, error = check_same(split(stream, rng, 16))
+        assert packets == frames
+        assert error == 'Timed out waiting for packet header'
+
+
+def test_large_frames():
+    rng = random.Random(2)
+    frames = [os.urandom(0x1000) for _ in range(16)]
+    stream = b''.join(slip_encode(frame) for frame in frames)
+    packets, error = check_same(split(stream, rng, 5000))
+    assert packets == frames
+
+
+@pytest.mark.parametrize('chunks, error', [
+    ([b'\x00\xc0\x01\xc0'], 'Invalid head of packet (0x00)'),
+    ([b'\xc0\x01\xc0', b'\x02'], 'Invalid head of packet (0x02)'),
+    ([b'\xc0\x01\xdb\x02\xc0'], 'Invalid SLIP escape (0xdb, 0x02)'),
+    ([b'\xc0\x01\xdb\xc0'], 'Invalid SLIP escape (0xdb, 0xC0)'),
+    ([b'\xc0\x01\xdb', b'\x02\xc0'], 'Invalid SLIP escape (0xdb, 0x02)'),
+    ([b'\xc0\x01\xc0\xc0\xdb\xdd\xdb\x00'], 'Invalid SLIP escape (0xdb, 0x00)'),
+    ([b'\xc0\x01\x02'], 'Timed out waiting for packet content'),
+    ([b'\xc0\x01\xc0'], 'Timed out waiting for packet header'),
+    ([], 'Timed out waiting for packet header'),
+])
+def test_errors(chunks, error):
+    assert check_same(chunks)[1] == error
+
+
+def test_escape_split_across_reads():
+    stream = slip_encode(b'\x01\xc0\xdb\x02')
+    for cut in range(1, len(stream)):
+        packets, error = check_same([stream[:cut], stream[cut:]])
+        assert packets == [b'\x01\xc0\xdb\x02']
+
+
+class SocketPort(object):
+    """ The parts of a pyserial port AsyncSerialTransport uses, over one end of a socket pair """
+    port = 'socketpair'
+
+    def __init__(self, sock):
+        self._socket = sock
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self._socket.close()
+
+
+def transport_decode(chunks, timeout=0.2):
+    """ Packets AsyncSerialTransport reads from 'chunks' sent one at a time, and the error it ends with """
+    async def run():
+        ours, theirs = socket.socketpair()
+        transport = esptool.AsyncSerialTransport(SocketPort(ours), lambda *args: None)
+        packets = []
+        try:
+            for chunk in chunks:
+                theirs.sendall(chunk)
+                await asyncio.sleep(0.001)
+            while True:
+                packets.append(await transport.read(timeout))
+        except esptool.FatalError as e:
+            return packets, str(e)
+        finally:
+            await transport.close()
+            theirs.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('chunks', [
+    [slip_encode(b'\x01\xc0\xdb\x02') * 3],
+    [b'\xc0\x01\xdb', b'\xdc\xc0', b'\xc0\x02\xc0'],
+    [b'\xc0\x01\xc0\x00\xc0\x02\xc0'],
+    [b'\xc0\x01\xdb', b'\x02\xc0'],
+    [b'\xc0\x01\x02'],
+])
+def test_transport_matches_slip_reader(chunks):
+    assert transport_decode(chunks) == check_same(chunks)
+
+
+def test_transport_flush_input_recovers():
+    async def run():
+        ours, theirs = socket.socketpair()
+        transport = esptool.AsyncSerialTransport(SocketPort(ours), lambda *args: None)
+        theirs.sendall(b'garbage')
+        with pytest.raises(esptool.FatalError, match='Invalid head of packet'):
+            await transport.read(1)
+        transport.flush_input()
+        theirs.sendall(slip_encode(b'\x01'))
+        assert await transport.read(1) == b'\x01'
+        await transport.close()
+        theirs.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_encoder_matches_legacy():
+    rng = random.Random(3)
+    port = NullPort()
+    esp = esptool.ESP8266ROM(port)
+    expected = b''
+    for seq in range(50):
+        block = bytes(rng.choice(b'\xc0\xdb\x01') for _ in range(rng.randint(0, 0x4000)))
+        header = struct.pack('<IIII', len(block), seq, 0, 0)
+        chk = esp.checksum(block)
+        esp.command(esp.ESP_FLASH_DATA, header, chk, wait_response=False, payload=memoryview(block))
+        expected += legacy.command_frame(esp.ESP_FLASH_DATA, header + block, chk)
+    assert port.written == expected
+    assert port.writes == 50
+
+
+def test_batched_writes():
+    port = NullPort()
+    esp = esptool.ESP8266ROM(port)
+    with esp.batch_writes():
+        for seq in range(3):
+            esp.command(esp.ESP_MEM_DATA, struct.pack('<IIII', 2, seq, 0, 0), 0, wait_response=False, payload=b'\xc0\xdb')
+    assert port.writes == 1
+    assert port.written == b''.join(legacy.command_frame(esp.ESP_MEM_DATA, struct.pack('<IIII', 2, seq, 0, 0) + b'\xc0\xdb', 0)
+                                    for seq in range(3))
+
+
+def test_encoder_random_flushes():
+    rng = random.Random(4)
+    encoder = esptool.SlipEncoder()
+    port = NullPort()
+    frames = []
+    for _ in range(300):
+        packet = bytes(rng.choice(b'\xc0\xdb\x01') for _ in range(rng.randint(0, 30)))
+        payload = bytes(rng.choice(b'\xc0\xdb\x01') for _ in range(rng.randint(0, 30)))
+        assert encoder.encode(packet, memoryview(payload)) == slip_encode(packet + payload)
+        frames.append(slip_encode(packet + payload))
+        if rng.random() < 0.3:
+            encoder.flush(port)
+            assert encoder.pending() == 0
+    encoder.flush(port)
+    assert port.written == b''.join(frames)
+
+
+class AnsweringPort(NullPort):
+    """ Port stand-in answering every frame written to it with a successful response to 'op' """
+    def __init__(self, op):
+        NullPort.__init__(self)
+        self._response = slip_encode(struct.pack('<BBHI', 1, op, 2, 0) + b'\x00\x00')
+        self._pending = b''
+
+    def write(self, data):
+        self._pending += self._response * (bytes(data).count(b'\xc0') // 2)
+        return NullPort.write(self, data)
+
+    def inWaiting(self):
+        return len(self._pending)
+
+    def read(self, size=1):
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+def test_batched_writes_flushed_before_read():
+    port = AnsweringPort(esptool.ESPLoader.ESP_MEM_DATA)
+    esp = esptool.ESP8266ROM(port)
+    with esp.batch_writes():
+        for seq in range(3):
+            esp.command(esp.ESP_MEM_DATA, struct.pack('<IIII', 0, seq, 0, 0), 0, wait_response=False)
+        assert port.writes == 0
+        # the response can't arrive before the requests are sent
+        esp.command(esp.ESP_MEM_DATA, struct.pack('<IIII', 0, 3, 0, 0), 0, timeout=0.1)
+        assert port.writes == 1
+        for seq in range(3):
+            esp.read()
+        esp.command(esp.ESP_MEM_DATA, struct.pack('<IIII', 0, 4, 0, 0), 0, wait_response=False)
+    assert port.writes == 2
+    assert port.written == b''.join(legacy.command_frame(esp.ESP_MEM_DATA, struct.pack('<IIII', 0, seq, 0, 0), 0)
+                                    for seq in range(5))